@@ -1,5 +1,65 @@
 
-from util import get_en_idx
+import os
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+from util import LanguageIndex, SourceIndex
+
+
+def write_subgraphs(graph_df, row_sets, out_paths, processes=None):
+    """
+    Writes graph_df.iloc[rows] for each rows of row_sets (sorted row positions) to its out path.
+    For several subgraphs the rows of graph_df are formatted once and the files are written by worker processes.
+    """
+    lines = _csv_lines(graph_df) if len(row_sets) > 1 else None
+    if lines is None:  # one subgraph, or fields with line breaks
+        for rows, out_path in zip(row_sets, out_paths):
+            graph_df.iloc[rows].to_csv(out_path, sep='\t', index=False, header=False, encoding="utf-8")
+        return
+    tasks = list(zip(row_sets, out_paths))
+    if processes is None:
+        processes = os.cpu_count()
+    processes = max(min(processes, len(tasks)), 1)
+    if processes == 1:
+        _init_line_writer(lines)
+        for task in tasks:
+            _write_lines(task)
+    else:
+        with multiprocessing.Pool(processes, initializer=_init_line_writer, initargs=(lines,)) as pool:
+            pool.map(_write_lines, tasks, chunksize=1)
+
+
+_line_writer_lines = None
+
+
+def _init_line_writer(lines):
+    global _line_writer_lines
+    _line_writer_lines = lines
+
+
+def _write_lines(args):
+    rows, out_path = args
+    with open(out_path, 'w', encoding='utf-8', newline='') as out_file:
+        out_file.writelines(line + '\n' for line in _line_writer_lines[rows])
+    return out_path
+
+
+def get_subgraphs(graph_df, source_names, out_template, processes=None, source_index=None):
+    """
+    Get the subgraph of each of source_names (edges with a source that starts with it, e.g. '/d/wordnet/' or
+    '/d/verbosity') from the inverted index of one SourceIndex (SourceIndex.prefix)
+    and write them in parallel to out_template, formatted with the source name and the number of edges.
+    source_index: SourceIndex of graph_df to reuse across calls, built here if not given
+    Unions, intersections and differences of sources: build the rows with a SourceIndex and use write_subgraphs.
+    get_subgraphs(graph_df=conceptnet, source_names=['/d/wiktionary/', '/d/wordnet/'], out_template='cn_{}_{}.csv')
+    """
+    if source_index is None:
+        source_index = SourceIndex(graph_df)
+    row_sets = [source_index.rows(source_index.prefix(source_name)) for source_name in source_names]
+    out_paths = [out_template.format(source_name.split('/')[2], len(rows))
+                 for source_name, rows in zip(source_names, row_sets)]
+    write_subgraphs(graph_df, row_sets, out_paths, processes=processes)
 
 
 def get_subgraph(graph_df, source_name, out_template):
@@ -7,51 +67,291 @@ def get_subgraph(graph_df, source_name, out_template):
     Get subgraph with source_name and write to out_template
     get_subgraph(graph=conceptnet, names=['/d/wiktionary/', '/d/wordnet/'])
     """
-    subgraph = graph_df[graph_df['sources'].str.contains(source_name)]
-    name = source_name.split('/')[2]
-    g_size = subgraph.shape
-    subgraph.to_csv(out_template.format(name, str(g_size[0])), sep='\t', index=False, header=False, encoding="utf-8")
+    get_subgraphs(graph_df, [source_name], out_template)
+
+
+def prunable_mask(graph_df, lang_index=None):
+    """
+    Edges that REWEIGHT changes and the ablations prune: English-English, except /r/dbpedia and /r/Entails
+    lang_index: LanguageIndex of graph_df to reuse, built here if not given
+    """
+    if lang_index is None:
+        lang_index = LanguageIndex(graph_df)
+    return (~lang_index.relation_contains('/r/dbpedia') & ~lang_index.relation_contains('/r/Entails') &
+            lang_index.both('en'))
+
+
+class ThresholdAblation:
+    """
+    Pruned variants of graph_df for many thresholds: score set to 0 on prunable edges whose deciding score is
+    <= threshold (>= threshold with above=True). The prunable mask and the order of the deciding scores are computed
+    once, each threshold is then one binary search. graph_df and decide_df are not changed.
+    decide_df: graph whose scores decide (default graph_df), row aligned with graph_df
+    lang_index: LanguageIndex of decide_df to reuse, built here if not given
+    ablation = ThresholdAblation(graph_df=cn_new)
+    ablation.write(thresholds=[5, 10, 20], out_template='cn_new_threshold_{}.csv')
+    """
+
+    def __init__(self, graph_df, decide_df=None, above=False, lang_index=None):
+        decide_df = graph_df if decide_df is None else decide_df
+        if len(decide_df) != len(graph_df):
+            raise ValueError('decide_df has {} rows, graph_df {}'.format(len(decide_df), len(graph_df)))
+        self.graph_df = graph_df
+        self.above = above
+        self.eligible = np.flatnonzero(prunable_mask(decide_df, lang_index))
+        keys = decide_df['score'].to_numpy(dtype=np.float64)[self.eligible]
+        keys = -keys if above else keys
+        order = np.argsort(keys, kind='stable')  # NaN scores sort last and are never pruned
+        self.sorted_keys = keys[order]
+        # position of each eligible edge in pruning order, the first num_pruned(threshold) positions are pruned
+        self.rank = np.empty(len(self.eligible), dtype=np.int64)
+        self.rank[order] = np.arange(len(order))
+
+    def num_pruned(self, threshold):
+        return int(np.searchsorted(self.sorted_keys, -threshold if self.above else threshold, side='right'))
+
+    def pruned_rows(self, threshold):
+        """Row positions of the edges pruned at threshold, in graph order"""
+        return self.eligible[self.rank < self.num_pruned(threshold)]
+
+    def graph(self, threshold):
+        """
+        The pruned graph as a new DataFrame. Only the score column is new,
+        the other columns are shared with graph_df until either is modified (copy-on-write).
+        """
+        scores = self.graph_df['score'].copy()
+        scores.iloc[self.pruned_rows(threshold)] = 0
+        return self.graph_df.assign(score=scores)
+
+    def graphs(self, thresholds):
+        """(threshold, pruned graph) for each threshold, created when iterated"""
+        for threshold in thresholds:
+            yield threshold, self.graph(threshold)
+
+    def write(self, thresholds, out_template, chunksize=1000000):
+        """
+        Writes the pruned graph of every threshold to out_template.format(threshold) in one pass over graph_df:
+        each chunk of rows is formatted once, the variants only replace the lines of their pruned edges.
+        Same files as graph(threshold).to_csv(..., sep='\t', index=False, header=False).
+        """
+        out_files = [open(out_template.format(threshold), 'w', encoding='utf-8', newline='')
+                     for threshold in thresholds]
+        limits = [self.num_pruned(threshold) for threshold in thresholds]
+        try:
+            for start in range(0, max(len(self.graph_df), 1), chunksize):
+                chunk = self.graph_df.iloc[start:start + chunksize]
+                lo, hi = np.searchsorted(self.eligible, [start, start + len(chunk)])
+                local = self.eligible[lo:hi] - start
+                pruned_chunk = chunk.iloc[local].copy()
+                pruned_chunk.loc[:, 'score'] = 0  # keeps the dtype, as setting the pruned rows does
+                lines = _csv_lines(chunk)
+                pruned_lines = _csv_lines(pruned_chunk)
+                if lines is None or pruned_lines is None:  # fields with line breaks, format each variant
+                    for out_file, limit in zip(out_files, limits):
+                        variant = chunk.copy()
+                        variant.iloc[local[self.rank[lo:hi] < limit], variant.columns.get_loc('score')] = 0
+                        variant.to_csv(out_file, sep='\t', index=False, header=False, lineterminator='\n')
+                    continue
+                for out_file, limit in zip(out_files, limits):
+                    variant = lines.copy()
+                    selected = self.rank[lo:hi] < limit
+                    variant[local[selected]] = pruned_lines[selected]
+                    out_file.write('\n'.join(variant))
+                    out_file.write('\n' if len(variant) else '')
+        finally:
+            for out_file in out_files:
+                out_file.close()
+
+
+def _csv_lines(graph_df):
+    """Tab-separated lines of graph_df as an object array, None if a field contains a line break"""
+    text = graph_df.to_csv(sep='\t', index=False, header=False, lineterminator='\n')
+    lines = np.array(text.split('\n')[:-1], dtype=object)
+    return lines if len(lines) == len(graph_df) else None
+
+
+def _fixed_template(path):
+    """Template for path whose format() returns path unchanged"""
+    return path.replace('{', '{{').replace('}', '}}')
+
+
+def get_pruned_graphs(graph_df, thresholds, out_template):
+    """
+    Threshold sweep of get_pruned_graph in one pass, graph_df is not changed.
+    get_pruned_graphs(graph_df=conceptnet, thresholds=[5, 10, 20], out_template='cn_new_threshold_{}.csv')
+    """
+    ThresholdAblation(graph_df).write(thresholds, out_template)
 
 
 def get_pruned_graph(graph_df, threshold, out_template):
     """
     Set all relations with score <= threshold to 0 on all relation that REWEIGHT changes.
-    Used for ablation study on reweighted graph.
+    Used for ablation study on reweighted graph. graph_df is not changed.
     get_pruned_graph(graph_df=conceptnet, threshold=20, out_template='cn_new_threshold_{}.csv')
     """
-    pattern = "\/c\/en\/"
-    graph_df.loc[((graph_df.score <= threshold) & ((~graph_df['relation'].str.contains('/r/dbpedia')) & (
-        ~graph_df['relation'].str.contains('/r/Entails'))) & (graph_df['word1'].str.contains(pattern)) & (
-                      graph_df['word2'].str.contains(pattern))), 'score'] = 0
-    graph_df.to_csv(out_template.format(threshold),
-                    sep='\t', index=False, header=False, encoding="utf-8")
+    get_pruned_graphs(graph_df, [threshold], out_template)
 
 
-def get_original_pruned_graph(original_graph_df, weighted_graph_df, threshold, out_name):
+def get_original_pruned_graphs(original_graph_df, weighted_graph_df, thresholds, out_name):
     """
-    Set all relation scores in the original graph to 0 that would have score <= threshold in the weighted version
-    get_pruned_graph(original_graph_df=cn_orig, weighted_graph_df=cn_new, threshold=20, out_template='cn_orig_threshold_{}.csv')
-    """
-    pattern = "\/c\/en\/"
-    original_graph_df.loc[
-        ((weighted_graph_df.score >= threshold) & ((~weighted_graph_df['relation'].str.contains('/r/dbpedia'))
-                                                   & (~weighted_graph_df['relation'].str.contains('/r/Entails'))) &
-         (weighted_graph_df['word1'].str.contains(pattern))
-         & (weighted_graph_df['word2'].str.contains(pattern))), 'score'] = 0
-    original_graph_df.to_csv('./Thresholds/{}_{}.csv'.format(out_name, threshold),
-                             sep='\t', index=False, header=False, encoding="utf-8")
+    Threshold sweep of get_original_pruned_graph in one pass, the graphs are not changed.
+    get_original_pruned_graphs(original_graph_df=cn_orig, weighted_graph_df=cn_new, thresholds=[5, 10, 20], out_name='cn_orig_threshold')
+    """
+    ablation = ThresholdAblation(original_graph_df, decide_df=weighted_graph_df, above=True)
+    ablation.write(thresholds, './Thresholds/' + _fixed_template(out_name) + '_{}.csv')
     print('Prunning Done')
 
 
+def get_original_pruned_graph(original_graph_df, weighted_graph_df, threshold, out_name):
+    """
+    Set all relation scores in the original graph to 0 that would have score >= threshold in the weighted version
+    get_original_pruned_graph(original_graph_df=cn_orig, weighted_graph_df=cn_new, threshold=20, out_name='cn_orig_threshold')
+    """
+    get_original_pruned_graphs(original_graph_df, weighted_graph_df, [threshold], out_name)
+
+
+class ShuffleBaselines:
+    """
+    Random baselines of graph_df with cols_to_shuffle permuted, for many seeds from one graph.
+    english: only permute among the English-English edges, the other rows keep their values.
+    lang_index: LanguageIndex of graph_df to reuse with english, built here if not given
+    Permutations are the ones DataFrame.sample(frac=1, random_state=seed) draws, so a seed gives the same graph
+    as the single-seed functions. graph_df is not changed.
+    baselines = ShuffleBaselines(graph_df=cn, cols_to_shuffle=['score'], english=True)
+    baselines.write(seeds=range(100), out_template='cn_en_shuffled_{}.csv', processes=8)
+    for seed, permutation in baselines.permutations(range(100)):
+        scores = cn['score'].to_numpy()[baselines.rows][permutation]  # without building the graph
+    """
+
+    def __init__(self, graph_df, cols_to_shuffle, english=False, lang_index=None):
+        self.graph_df = graph_df
+        self.columns = [cols_to_shuffle] if isinstance(cols_to_shuffle, str) else list(cols_to_shuffle)
+        # positions of the rows that are permuted among each other
+        if english:
+            lang_index = LanguageIndex(graph_df) if lang_index is None else lang_index
+            self.rows = np.flatnonzero(lang_index.both('en'))
+        else:
+            self.rows = np.arange(len(graph_df))
+
+    def permutation(self, seed):
+        """Index array into rows: row rows[i] gets the values of row rows[permutation[i]]"""
+        return np.random.RandomState(seed).permutation(len(self.rows))
+
+    def permutations(self, seeds):
+        """(seed, permutation) for each seed, drawn when iterated"""
+        for seed in seeds:
+            yield seed, self.permutation(seed)
+
+    def graph(self, seed):
+        """The shuffled graph as a new DataFrame, the columns that are not shuffled are shared with graph_df"""
+        permutation = self.permutation(seed)
+        shuffled = {}
+        for column in self.columns:
+            values = self.graph_df[column].to_numpy(copy=True)
+            values[self.rows] = values[self.rows][permutation]
+            shuffled[column] = values
+        return self.graph_df.assign(**shuffled)
+
+    def write(self, seeds, out_template, processes=None, chunksize=1000000):
+        """
+        Writes the shuffled graph of every seed to out_template.format(seed), one seed per worker process.
+        The fields are formatted once, each seed only permutes the formatted fields of cols_to_shuffle.
+        Same files as graph(seed).to_csv(..., sep='\t', index=False, header=False).
+        """
+        tasks = [(seed, out_template.format(seed)) for seed in seeds]
+        # formatting the fields once only pays off for several seeds, fields with line breaks need to_csv
+        segments = _field_segments(self.graph_df, self.columns) if len(tasks) > 1 else None
+        if segments is None:
+            for seed, out_path in tasks:
+                self.graph(seed).to_csv(out_path, sep='\t', index=False, header=False, encoding='utf-8',
+                                        lineterminator='\n')
+            return
+        if processes is None:
+            processes = os.cpu_count()
+        processes = max(min(processes, len(tasks)), 1)
+        initargs = (segments, self.rows, chunksize)
+        if processes == 1:
+            _init_shuffle_writer(*initargs)
+            for task in tasks:
+                _write_shuffled(task)
+        else:
+            with multiprocessing.Pool(processes, initializer=_init_shuffle_writer, initargs=initargs) as pool:
+                pool.map(_write_shuffled, tasks, chunksize=1)
+
+
+def _field_strings(graph_df, columns):
+    """The fields of columns as to_csv formats them, tab-joined, one string per row. None if one has a line break"""
+    frame = graph_df[columns].copy(deep=False)
+    frame.columns = range(len(columns))
+    frame[len(columns)] = '#'  # end marker, a row of one empty field would be written as ""
+    lines = frame.to_csv(sep='\t', index=False, header=False, lineterminator='\n').split('\n')[:-1]
+    if len(lines) != len(graph_df):
+        return None
+    return pd.Series(lines, dtype=object).str[:-2].to_numpy(dtype=object)
+
+
+def _field_segments(graph_df, columns):
+    """
+    [(shuffled, strings)] in column order: one per column in columns and one per run of the other columns,
+    see _field_strings. None if a field contains a line break.
+    """
+    runs = []
+    for column in graph_df.columns:
+        if column in columns:
+            runs.append((True, [column]))
+        elif runs and not runs[-1][0]:
+            runs[-1][1].append(column)
+        else:
+            runs.append((False, [column]))
+    segments = []
+    for shuffled, run in runs:
+        strings = _field_strings(graph_df, run)
+        if strings is None:
+            return None
+        segments.append((shuffled, strings))
+    return segments
+
+
+_shuffle_writer = None
+
+
+def _init_shuffle_writer(segments, rows, chunksize):
+    global _shuffle_writer
+    _shuffle_writer = (segments, rows, chunksize)
+
+
+def _write_shuffled(args):
+    seed, out_path = args
+    segments, rows, chunksize = _shuffle_writer
+    permutation = np.random.RandomState(seed).permutation(len(rows))
+    fields = []
+    for shuffled, strings in segments:
+        if shuffled:
+            strings = strings.copy()
+            strings[rows] = strings[rows][permutation]
+        fields.append(strings)
+    num_rows = len(fields[0]) if fields else 0
+    with open(out_path, 'w', encoding='utf-8', newline='') as out_file:
+        for start in range(0, num_rows, chunksize):
+            out_file.writelines(line + '\n' for line in map('\t'.join, zip(*[strings[start:start + chunksize]
+                                                                             for strings in fields])))
+    return out_path
+
+
+def get_shuffled_graphs(graph_df, cols_to_shuffle, out_template, seeds, english=False, processes=None):
+    """
+    Random baselines for many seeds at once, written in parallel, graph_df is not changed.
+    get_shuffled_graphs(graph_df=cn, cols_to_shuffle=['word2'], out_template='cn_new_shuffled_{}.csv', seeds=range(100))
+    """
+    ShuffleBaselines(graph_df, cols_to_shuffle, english=english).write(seeds, out_template, processes=processes)
+
+
 def get_shuffled_graph(graph_df, cols_to_shuffle, out_name, seed):
     """
     Destroys graph by shuffling cols_to_shuffle only, for checking if improvements are better than random
     get_shuffled_graph(graph_df=cn, cols_to_shuffle=['word2'],'cn_new_shuffled.csv')
     """
-    shuffled = graph_df[cols_to_shuffle].sample(frac=1, random_state=seed)
-    shuffled = shuffled.reset_index(drop=True)
-    graph_df[cols_to_shuffle] = shuffled
-    graph_df.to_csv(out_name, sep='\t', index=False, header=False, encoding="utf-8")
+    get_shuffled_graphs(graph_df, cols_to_shuffle, _fixed_template(out_name), [seed], processes=1)
 
 
 def get_shuffled_english_graph(graph_df, cols_to_shuffle, out_name, seed):
@@ -59,8 +359,4 @@ def get_shuffled_english_graph(graph_df, cols_to_shuffle, out_name, seed):
     Destroys English graph by shuffling cols_to_shuffle only, for checking if improvements are better than random
     get_shuffled_graph(graph_df=cn, cols_to_shuffle=['word2'],'cn_en_new_shuffled.csv')
     """
-    en_scores = graph_df.iloc[get_en_idx(graph_df)][cols_to_shuffle]
-    shuffled = en_scores.sample(frac=1, random_state=seed)
-    shuffled = shuffled.reset_index(drop=True).tolist()
-    graph_df.iloc[get_en_idx(graph_df), graph_df.columns.get_loc(cols_to_shuffle)] = shuffled
-    graph_df.to_csv(out_name, sep='\t', index=False, header=False, encoding="utf-8")
+    get_shuffled_graphs(graph_df, cols_to_shuffle, _fixed_template(out_name), [seed], english=True, processes=1)
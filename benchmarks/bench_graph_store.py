@@ -0,0 +1,50 @@
+import os
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+
+from graph_store import tsv_to_graph_store
+from util import load_df, load_graph, get_en_idx
+
+"""
+Benchmark: graph startup from TSV (load_df) vs. graph store (load_graph)
+python -m benchmarks.bench_graph_store
+"""
+
+
+def write_random_graph(path, n_edges, n_concepts, seed=0):
+    """Writes a headerless ConceptNet-format TSV with random English/German edges"""
+    rand = np.random.RandomState(seed)
+    lang = np.where(rand.rand(n_concepts) < 0.8, 'en', 'de')
+    concepts = pd.Series(['/c/{}/concept_{}'.format(l, i) for i, l in enumerate(lang)])
+    relations = np.array(['/r/RelatedTo', '/r/IsA', '/r/Synonym', '/r/HasA', '/r/Causes', '/r/AtLocation'])
+    graph_df = pd.DataFrame({'word1': concepts.to_numpy()[rand.randint(0, n_concepts, n_edges)],
+                             'word2': concepts.to_numpy()[rand.randint(0, n_concepts, n_edges)],
+                             'score': rand.choice([1.0, 2.0, 0.5], n_edges),
+                             'sources': rand.choice(['/d/wiktionary/en', '/d/wordnet/3.1', '/d/verbosity'], n_edges),
+                             'relation': relations[rand.randint(0, len(relations), n_edges)]})
+    graph_df.to_csv(path, sep='\t', index=False, header=False)
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    columns = ['word1', 'word2', 'score', 'sources', 'relation']
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_edges in [1000000, 5000000]:
+            tsv_path = os.path.join(tmp_dir, 'graph.csv')
+            store_dir = os.path.join(tmp_dir, 'graph_store')
+            write_random_graph(tsv_path, n_edges, n_concepts=n_edges // 4)
+            tsv_df, tsv_s = timed(load_df, tsv_path, columns=columns)
+            _, convert_s = timed(tsv_to_graph_store, tsv_path, store_dir)
+            store_df, store_s = timed(load_graph, store_dir)
+            tsv_en, tsv_en_s = timed(get_en_idx, tsv_df)
+            store_en, store_en_s = timed(get_en_idx, store_df)
+            assert tsv_en == store_en
+            print('{} edges: load_df {:.2f}s, load_graph(store) {:.2f}s (one-time conversion {:.2f}s), '
+                  'get_en_idx {:.2f}s vs {:.2f}s'.format(n_edges, tsv_s, store_s, convert_s, tsv_en_s, store_en_s))
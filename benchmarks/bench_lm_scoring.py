@@ -0,0 +1,43 @@
+import os
+import time
+import tempfile
+import numpy as np
+
+from graph_reweighting.lm_scoring import score_sentence_file
+from graph_reweighting.perplexities_to_scores import load_perplexity_chunks
+
+"""
+Benchmark: throughput of the scoring stage with the stand-in model, one vs. several worker processes
+python -m benchmarks.bench_lm_scoring
+"""
+
+
+def write_random_sentences(path, n_sentences, seed=0):
+    """Writes sentences shaped like get_all_sentences output with 1-3 words per concept"""
+    rand = np.random.RandomState(seed)
+    templates = ['is related to', 'is a', 'is a part of', 'is used for', 'is located at', 'is similar to']
+    with open(path, 'w') as text_file:
+        for _ in range(n_sentences):
+            w1 = ' '.join('word{}'.format(w) for w in rand.randint(0, 10000, rand.randint(1, 4)))
+            w2 = ' '.join('word{}'.format(w) for w in rand.randint(0, 10000, rand.randint(1, 4)))
+            text_file.write('a {} {} a {}\n'.format(w1, templates[rand.randint(len(templates))], w2))
+
+
+if __name__ == '__main__':
+    n_sentences = 400000
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sentence_txt = os.path.join(tmp_dir, 'sentences.txt')
+        write_random_sentences(sentence_txt, n_sentences)
+        results = {}
+        many = max(os.cpu_count(), 2)
+        for processes in [1, many]:
+            out_dir = os.path.join(tmp_dir, 'results_{}'.format(processes))
+            start = time.perf_counter()
+            score_sentence_file(sentence_txt, out_dir, chunk_size=50000, processes=processes)
+            seconds = time.perf_counter() - start
+            results[processes] = load_perplexity_chunks(out_dir, processes=1)[0]
+            print('{} processes: {:.2f}s, {:.0f} sentences/s'.format(processes, seconds, n_sentences / seconds))
+        assert np.array_equal(results[1], results[many])
+        start = time.perf_counter()
+        score_sentence_file(sentence_txt, os.path.join(tmp_dir, 'results_1'), chunk_size=50000)
+        print('resume with all chunks done: {:.2f}s'.format(time.perf_counter() - start))
@@ -0,0 +1,80 @@
+import os
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+
+from benchmarks.bench_lm_scoring import write_random_sentences
+from graph_reweighting.lm_scoring import score_sentence_file
+from graph_reweighting.perplexities_to_scores import get_perplexity_from_multiple_files
+from graph_reweighting.perplexity_cache import PerplexityCache, export_uncached_sentences, \
+    expand_cached_perplexities, load_sentences
+
+"""
+Benchmark: LM scoring of all sentences vs. a cold and a warm perplexity cache, on sentences with duplicates
+python -m benchmarks.bench_perplexity_cache
+"""
+
+
+def write_sentence_csv(path, sentences):
+    """Sentence .csv like get_all_sentences writes it, edge index = row"""
+    pd.DataFrame({0: np.arange(len(sentences)), 1: sentences}).to_csv(path, sep='\t')
+
+
+def cached_run(sentence_csv, cache_path, work_dir):
+    """export -> score the uncached sentences -> expand, returns the perplexity of every sentence row"""
+    os.makedirs(work_dir, exist_ok=True)
+    new_txt = os.path.join(work_dir, 'uncached.txt')
+    lm_dir = os.path.join(work_dir, 'lm_results')
+    export_uncached_sentences(sentence_csv, cache_path, new_txt)
+    score_sentence_file(new_txt, lm_dir, chunk_size=50000, processes=1)
+    perplex = get_perplexity_from_multiple_files(lm_dir, processes=1)
+    return expand_cached_perplexities(load_sentences(sentence_csv), cache_path, new_txt, perplex)
+
+
+def check_empty_sentence(tmp_dir):
+    """
+    An empty sentence has no tokens, so the LM gives NaN: it passes through expand as NaN like without cache,
+    is not stored (put_many skips NaN) and is exported again on the next run
+    """
+    sentences = ['a dog is a animal', '', 'a cat is a animal', 'a dog is a animal', '']
+    sentence_csv = os.path.join(tmp_dir, 'check_sentences.csv')
+    write_sentence_csv(sentence_csv, sentences)
+    cache_path = os.path.join(tmp_dir, 'check_cache.sqlite')
+    for run in ['cold', 'warm']:
+        perplex = cached_run(sentence_csv, cache_path, os.path.join(tmp_dir, 'check_' + run))
+        assert np.isnan(perplex[[1, 4]]).all() and not np.isnan(perplex[[0, 2, 3]]).any(), \
+            '{} run: only the empty sentences should have NaN perplexities, got {}'.format(run, perplex)
+        assert perplex[0] == perplex[3]
+    with open(os.path.join(tmp_dir, 'check_warm', 'uncached.txt')) as text_file:
+        assert text_file.read() == '\n', 'the warm run should only export the empty sentence'
+    cache = PerplexityCache(cache_path)
+    cache.put_many(['', 'a bird can fly'], [np.nan, 5.0])
+    assert len(cache) == 3
+    cache.close()
+
+
+if __name__ == '__main__':
+    n_sentences = 200000
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        check_empty_sentence(tmp_dir)
+        sentence_txt = os.path.join(tmp_dir, 'sentences.txt')
+        write_random_sentences(sentence_txt, n_sentences // 4)
+        with open(sentence_txt) as text_file:
+            distinct = [line.rstrip('\n') for line in text_file]
+        # every sentence about 4 times, like symmetric relations and duplicate sources in ConceptNet
+        sentences = np.random.RandomState(0).choice(distinct, n_sentences)
+        sentence_csv = os.path.join(tmp_dir, 'sentences.csv')
+        write_sentence_csv(sentence_csv, sentences)
+        all_txt = os.path.join(tmp_dir, 'all.txt')
+        with open(all_txt, 'w') as text_file:
+            text_file.writelines(sentence + '\n' for sentence in sentences)
+
+        start = time.perf_counter()
+        score_sentence_file(all_txt, os.path.join(tmp_dir, 'all_results'), chunk_size=50000, processes=1)
+        print('{} sentences without cache: {:.2f}s'.format(n_sentences, time.perf_counter() - start))
+        cache_path = os.path.join(tmp_dir, 'cache.sqlite')
+        for run in ['cold', 'warm']:
+            start = time.perf_counter()
+            cached_run(sentence_csv, cache_path, os.path.join(tmp_dir, run))
+            print('{} sentences, {} cache: {:.2f}s'.format(n_sentences, run, time.perf_counter() - start))
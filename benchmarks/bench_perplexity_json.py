@@ -0,0 +1,52 @@
+import os
+import json
+import time
+import random
+import tempfile
+import tracemalloc
+import numpy as np
+
+from graph_reweighting.perplexities_to_scores import get_perplexity_from_json, get_perplexity_array_from_json
+
+"""
+Benchmark: json.load vs. block-wise 'ppl' scan of a BERT_LM test_results.json
+python -m benchmarks.bench_perplexity_json
+"""
+
+
+def write_fake_test_results(path, n_sentences, tokens_per_sentence=8, seed=0):
+    """Writes a test_results.json shaped like the BERT_LM output with random token probabilities"""
+    rand = random.Random(seed)
+    with open(path, 'w') as json_file:
+        json_file.write('[\n')
+        for i in range(n_sentences):
+            tokens = [{'token': 'word{}'.format(rand.randint(0, 5000)), 'prob': rand.random()}
+                      for _ in range(tokens_per_sentence)]
+            sentence = {'tokens': tokens, 'ppl': rand.uniform(1, 10000)}
+            json_file.write(json.dumps(sentence, indent=2))
+            json_file.write(',\n' if i < n_sentences - 1 else '\n')
+        json_file.write(']\n')
+
+
+def measure(func, path):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(path)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_sentences in [10000, 200000]:
+            path = os.path.join(tmp_dir, 'test_results.json')
+            write_fake_test_results(path, n_sentences)
+            size_mb = os.path.getsize(path) / 2 ** 20
+            old, old_s, old_peak = measure(get_perplexity_from_json, path)
+            new, new_s, new_peak = measure(get_perplexity_array_from_json, path)
+            assert np.array_equal(np.array(old), new), 'ppl values differ between readers'
+            print('{} sentences ({:.0f} MB): json.load {:.2f}s / {:.0f} MB peak, '
+                  'scan {:.2f}s / {:.0f} MB peak'.format(n_sentences, size_mb, old_s, old_peak / 2 ** 20,
+                                                        new_s, new_peak / 2 ** 20))
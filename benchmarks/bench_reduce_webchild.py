@@ -0,0 +1,83 @@
+import os
+import time
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from sentence_construction.WebChild_to_sentence import reduce_webchild, reduce_webchild_file, \
+    WEBCHILD_FILES_TO_REDUCE
+
+"""
+Benchmark: per-file sort/drop_duplicates/append loop vs. single groupby-max reduce_webchild
+python -m benchmarks.bench_reduce_webchild
+"""
+
+
+def legacy_reduce_webchild(graph_df, filenames_to_reduce):
+    """The loop reduce_webchild used before the single groupby, with pd.concat for the removed DataFrame.append"""
+    for filename in filenames_to_reduce:
+        reduce_index = graph_df['filename'] == filename
+        reduce_df = graph_df[reduce_index]
+        reduce_df = reduce_df.sort_values(['score'], ascending=False, kind='stable')
+        reduce_df = reduce_df.drop_duplicates(['word1', 'word2'], keep='first')
+        graph_df = graph_df[~reduce_index]
+        graph_df = pd.concat([graph_df, reduce_df], ignore_index=True)
+        graph_df = graph_df.reset_index(drop=True)
+    return graph_df
+
+
+def random_webchild(n_edges, n_words=20000, seed=0):
+    """Synthetic merged WebChild graph in ConceptNet format with a filename column and many duplicate pairs"""
+    rand = np.random.RandomState(seed)
+    words = np.array(['/c/en/word{}'.format(i) for i in range(n_words)], dtype=object)
+    filenames = np.array(WEBCHILD_FILES_TO_REDUCE + ['WebChild/ConceptNet_Format/webchild_partwhole.csv'],
+                         dtype=object)
+    return pd.DataFrame({'word1': words[rand.zipf(1.3, n_edges) % n_words],
+                         'word2': words[rand.zipf(1.3, n_edges) % n_words],
+                         'score': rand.rand(n_edges).round(6),
+                         'sources': 'webchild',
+                         'relation': rand.choice(['/r/taller', '/r/bigger', '/r/is_located_in'], n_edges),
+                         'filename': filenames[rand.randint(0, len(filenames), n_edges)]})
+
+
+def check_nan_scores():
+    """Groups with only NaN scores keep one row, NaN scores lose against any score, like in the loop"""
+    file = WEBCHILD_FILES_TO_REDUCE[0]
+    graph_df = pd.DataFrame({'word1': ['/c/en/a', '/c/en/a', '/c/en/b', '/c/en/b', '/c/en/c'],
+                             'word2': ['/c/en/x', '/c/en/x', '/c/en/y', '/c/en/y', '/c/en/z'],
+                             'score': [np.nan, np.nan, np.nan, 0.5, 0.1],
+                             'sources': 'webchild', 'relation': '/r/taller', 'filename': file})
+    old = legacy_reduce_webchild(graph_df, WEBCHILD_FILES_TO_REDUCE)
+    new = reduce_webchild(graph_df)
+    assert old.reset_index(drop=True).equals(new.reset_index(drop=True)), 'reduced graphs with NaN scores differ'
+
+
+def measure(func, *args, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+if __name__ == '__main__':
+    columns = ['word1', 'word2', 'score', 'sources', 'relation', 'filename']
+    check_nan_scores()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_edges in [1000000, 4000000]:
+            graph_df = random_webchild(n_edges)
+            old, old_s, old_peak = measure(legacy_reduce_webchild, graph_df, WEBCHILD_FILES_TO_REDUCE)
+            new, new_s, new_peak = measure(reduce_webchild, graph_df)
+            key = ['filename', 'word1', 'word2', 'score']
+            assert old.sort_values(key).reset_index(drop=True)[key].equals(
+                new.sort_values(key).reset_index(drop=True)[key]), 'reduced graphs differ'
+            graph_path = os.path.join(tmp_dir, 'wc.csv')
+            graph_df.to_csv(graph_path, sep='\t', index=False, header=False)
+            _, file_s, file_peak = measure(reduce_webchild_file, graph_path, os.path.join(tmp_dir, 'wc_reduced.csv'),
+                                           columns, chunksize=500000)
+            print('{} edges: loop {:.2f}s / {:.0f} MB, groupby {:.2f}s / {:.0f} MB, '
+                  'chunked file {:.2f}s / {:.0f} MB (incl. csv i/o)'.format(
+                      n_edges, old_s, old_peak / 2 ** 20, new_s, new_peak / 2 ** 20, file_s, file_peak / 2 ** 20))
@@ -0,0 +1,60 @@
+import time
+import numpy as np
+import pandas as pd
+
+from graph_reweighting.perplexities_to_scores import perplexities_to_scores, score_statistics, SCORE_FUNCTIONS
+
+"""
+Benchmark: np.vectorize reweight vs. the array score functions, whole and chunked
+python -m benchmarks.bench_scores
+"""
+
+
+def legacy_partial_scale(val, max):
+    if val > 1:
+        val -= 1
+        val = val / (max - 1)
+        val = val * 49
+        val += 1
+    return val
+
+
+def legacy_reweight(ppl):
+    scale_good = np.vectorize(legacy_partial_scale)
+    ppl = np.log10(ppl)
+    max = ppl.max()
+    ppl = ppl * -1 + max
+    ppl = ppl / (max - 2)
+    scale_max = ppl.max()
+    ppl = scale_good(ppl, scale_max)
+    return ppl
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def chunked_scores(perplex, score_type, relations, n_chunks):
+    chunks = np.array_split(perplex, n_chunks)
+    relation_chunks = np.array_split(relations, n_chunks)
+    stats = score_statistics(score_type, chunks, relation_chunks)
+    return np.concatenate([perplexities_to_scores(chunk, score_type, relations=rels, stats=stats)
+                           for chunk, rels in zip(chunks, relation_chunks)])
+
+
+if __name__ == '__main__':
+    rand = np.random.RandomState(0)
+    for n_sentences in [1000000, 5000000]:
+        perplex = pd.Series(np.exp(rand.randn(n_sentences) * 2 + 5))
+        relations = rand.choice(['/r/IsA', '/r/HasA', '/r/Causes', '/r/AtLocation'], n_sentences).astype(object)
+        old, old_s = timed(legacy_reweight, perplex)
+        new, new_s = timed(perplexities_to_scores, perplex, 'reweight')
+        assert np.array_equal(old, new), 'reweight scores differ'
+        print('{} sentences: np.vectorize reweight {:.2f}s, array reweight {:.2f}s'.format(n_sentences, old_s, new_s))
+        for score_type in list(SCORE_FUNCTIONS):
+            whole, whole_s = timed(perplexities_to_scores, perplex, score_type, relations=relations)
+            chunked, chunked_s = timed(chunked_scores, perplex.to_numpy(), score_type, relations, 10)
+            assert np.allclose(whole, chunked, equal_nan=True), '{} differs when chunked'.format(score_type)
+            print('  {}: {:.2f}s whole, {:.2f}s in 10 chunks'.format(score_type, whole_s, chunked_s))
@@ -0,0 +1,58 @@
+import os
+import time
+import tempfile
+import pandas as pd
+
+from sentence_construction.graph_to_sentence import rel_to_sentence, get_all_sentences
+from util import load_df, get_en_idx
+
+"""
+Benchmark: per-row sentence loop vs. column-wise get_all_sentences
+python -m benchmarks.bench_sentences
+"""
+
+
+def legacy_get_all_sentences(graph_df, indices, out_txt, out_csv):
+    """The per-row loop get_all_sentences used before the column-wise builder, kept for comparison"""
+    text_file = open(out_txt, "w+")
+    inx_sentence_list = []
+    for inx in indices:
+        row = graph_df.loc[inx]
+        rel_sentence = rel_to_sentence(row['word1'], row['word2'], row['relation'], logging=False)
+        if rel_sentence:
+            text_file.write(rel_sentence + '\n')
+            inx_sentence_list.append([inx, rel_sentence])
+    text_file.close()
+    sent_df = pd.DataFrame.from_dict(inx_sentence_list)
+    sent_df.to_csv(out_csv, sep='\t')
+
+
+def tile_graph(graph_df, n_rows):
+    """Repeats graph_df until it has n_rows rows"""
+    repeats = n_rows // len(graph_df) + 1
+    return pd.concat([graph_df] * repeats, ignore_index=True).iloc[:n_rows]
+
+
+def bench_get_all_sentences(graph_df, out_dir):
+    indices = get_en_idx(graph_df)
+    timings = {}
+    outputs = {}
+    for name, func in [('loop', legacy_get_all_sentences), ('columnar', get_all_sentences)]:
+        out_txt = os.path.join(out_dir, name + '.txt')
+        out_csv = os.path.join(out_dir, name + '.csv')
+        start = time.perf_counter()
+        func(graph_df, indices, out_txt, out_csv)
+        timings[name] = time.perf_counter() - start
+        with open(out_txt) as txt_file, open(out_csv) as csv_file:
+            outputs[name] = (txt_file.read(), csv_file.read())
+    assert outputs['loop'] == outputs['columnar'], 'column-wise sentences differ from rel_to_sentence'
+    return timings
+
+
+if __name__ == '__main__':
+    toy = load_df('./data/examples/conceptnet_toy.csv', columns=['word1', 'word2', 'score', 'sources', 'relation'])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_rows in [10000, 100000]:
+            t = bench_get_all_sentences(tile_graph(toy, n_rows), tmp_dir)
+            print('{} edges: loop {:.2f}s, columnar {:.3f}s, speedup {:.0f}x'.format(
+                n_rows, t['loop'], t['columnar'], t['loop'] / t['columnar']))
@@ -0,0 +1,107 @@
+import os
+import time
+import argparse
+import tempfile
+
+from benchmarks.synthetic import write_conceptnet
+from sentence_construction.graph_to_sentence import relations_to_sentences, concepts_to_words, \
+    relation_types_to_sentence, get_all_sentences, concept_vocabulary
+from graph_reweighting.streaming_pipeline import stream_sentences
+from util import load_df, get_en_idx
+from vocabulary import Vocabulary, get_vocabulary, clear_vocabularies
+
+"""
+Benchmark: per-edge string sentence building vs. interned vocabularies, and memory of string columns vs. ids
+python -m benchmarks.bench_vocabulary --edges 1000000
+"""
+
+CN_COLUMNS = ['word1', 'word2', 'score', 'sources', 'relation']
+
+
+def legacy_relations_to_sentences(graph_df):
+    """relations_to_sentences before the vocabularies, string operations run once per edge"""
+    relation = graph_df['relation']
+    template = relation.map(relation_types_to_sentence)
+    known = template.notna().to_numpy()
+    missed = relation[~known].value_counts(dropna=False)
+
+    relation = relation[known]
+    template = template[known].str.replace('_', ' ', regex=False)
+    w1 = concepts_to_words(graph_df['word1'][known])
+    w2 = concepts_to_words(graph_df['word2'][known])
+    flip = relation.isin(['/r/Causes', '/r/HasA']).to_numpy()
+    first = w1.where(~flip, w2)
+    second = w2.where(~flip, w1)
+    sentences = 'a ' + first + ' ' + template + ' a ' + second
+    return sentences, missed
+
+
+def bench_sentences(graph_df):
+    en_df = graph_df.loc[get_en_idx(graph_df)]
+    timings = {}
+    start = time.perf_counter()
+    legacy, legacy_missed = legacy_relations_to_sentences(en_df)
+    timings['legacy'] = time.perf_counter() - start
+    clear_vocabularies()
+    for name in ['vocabulary_cold', 'vocabulary_warm']:
+        start = time.perf_counter()
+        sentences, missed = relations_to_sentences(en_df)
+        timings[name] = time.perf_counter() - start
+    assert legacy.astype(object).equals(sentences.astype(object)) and legacy_missed.equals(missed), \
+        'vocabulary sentences differ from the per-edge ones'
+    return len(en_df), timings
+
+
+def check_scoped_vocabulary(graph_path, tmp_dir):
+    """
+    relations_to_sentences fills the vocabulary it is given, even an empty one, and get_all_sentences and
+    stream_sentences leave the shared 'concepts' vocabulary alone
+    """
+    clear_vocabularies()
+    shared = get_vocabulary('concepts')
+    graph_df = load_df(graph_path, columns=CN_COLUMNS)
+    concepts = concept_vocabulary()
+    relations_to_sentences(graph_df.loc[get_en_idx(graph_df)], concepts=concepts)
+    assert len(concepts) and not len(shared), 'concepts went into the shared vocabulary, not the one passed in'
+    get_all_sentences(graph_df, get_en_idx(graph_df), os.path.join(tmp_dir, 'scoped.txt'),
+                      os.path.join(tmp_dir, 'scoped.csv'))
+    stream_sentences(graph_path, os.path.join(tmp_dir, 'scoped_stream.txt'), os.path.join(tmp_dir, 'scoped_stream.csv'),
+                     CN_COLUMNS, chunksize=len(graph_df) // 3 + 1)
+    assert not len(shared), 'get_all_sentences or stream_sentences filled the shared concepts vocabulary'
+
+
+def bench_memory(graph_df):
+    """Bytes of the word1, word2 and relation columns as strings and as int32 ids plus their vocabularies"""
+    strings = int(sum(graph_df[column].astype(object).memory_usage(deep=True, index=False)
+                      for column in ['word1', 'word2', 'relation']))
+    concepts = Vocabulary()
+    relations = Vocabulary()
+    ids = [concepts.encode(graph_df['word1']), concepts.encode(graph_df['word2']),
+           relations.encode(graph_df['relation'])]
+    interned = sum(column_ids.nbytes for column_ids in ids) + concepts.memory_usage() + relations.memory_usage()
+    return strings, interned, len(concepts)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--edges', type=int, nargs='+', default=[100000, 1000000])
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        check_path = os.path.join(tmp_dir, 'cn_check.csv')
+        write_conceptnet(check_path, 10000)
+        check_scoped_vocabulary(check_path, tmp_dir)
+        for n_edges in args.edges:
+            path = os.path.join(tmp_dir, 'cn_{}.csv'.format(n_edges))
+            write_conceptnet(path, n_edges)
+            graph_df = load_df(path, columns=CN_COLUMNS)
+            n_en, t = bench_sentences(graph_df)
+            print('{} edges ({} English): legacy {:.2f}s, vocabulary {:.2f}s cold / {:.2f}s warm, speedup {:.1f}x'
+                  .format(n_edges, n_en, t['legacy'], t['vocabulary_cold'], t['vocabulary_warm'],
+                          t['legacy'] / t['vocabulary_cold']))
+            strings, interned, n_concepts = bench_memory(graph_df)
+            print('{} edges ({} concepts): strings {:.0f} MB, ids + vocabularies {:.0f} MB ({:.1f}x smaller, '
+                  '{:.0f} vs {:.0f} bytes per edge)'.format(n_edges, n_concepts, strings / 2 ** 20, interned / 2 ** 20,
+                                                           strings / interned, strings / n_edges,
+                                                           interned / n_edges))
+            del graph_df
+            clear_vocabularies()
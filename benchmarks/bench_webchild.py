@@ -0,0 +1,168 @@
+import os
+import time
+import tempfile
+import filecmp
+import numpy as np
+import pandas as pd
+
+from sentence_construction.WebChild_to_sentence import webchild_to_conceptnet_format, \
+    webchild_action_to_conceptnet_format, webchild_spatial_to_conceptnet_format
+from util import load_df, word_to_concept, word_to_rel
+
+"""
+Benchmark: iterrows WebChild converters vs. column-wise converters on a synthetic WebChild subgraph
+python -m benchmarks.bench_webchild
+"""
+
+
+"""
+Iterrows converters used before the column-wise ones, kept for comparison
+"""
+
+
+def legacy_webchild_to_conceptnet_format(graph_df, out_path):
+    assertions_temp_list = []
+    i = 0
+    for index, row in graph_df.iterrows():
+        i += 1
+        w1 = str(row['#x'])
+        w2 = str(row['y'])
+        if w1.find('#') != -1:
+            w1 = w1[:w1.find('#')]
+        if w2.find('#') != -1:
+            w2 = w2[:w2.find('#')]
+        c1 = word_to_concept(w1)
+        c2 = word_to_concept(w2)
+        r = str(row['r'])
+        if r.find('#') != -1:
+            r = r[:r.find('#')]
+        rel = word_to_rel(r)
+        score = row['score']
+        source = row['sources']  # 'http://people.mpi-inf.mpg.de/~ntandon/resources/readme-partwhole.html'
+        assoc = [c1, c2, score, source, rel]
+        assertions_temp_list.append(assoc)
+    web_child_res = pd.DataFrame(assertions_temp_list, index=None)
+    web_child_res.to_csv(out_path, sep='\t', index=False, header=False)
+
+
+def legacy_webchild_action_to_conceptnet_format(path_to_tab_sep_file, out_name):
+    column_names = ['action', 'attribut', 'attribut_value', 'score']
+    data = load_df(path_to_tab_sep_file, columns=column_names)
+    assertions_temp_list = []
+    i = 0
+    for index, row in data.iterrows():
+        i += 1
+        w1 = str(row['action'])
+        w2 = str(row['attribut_value'])
+        w1_split = w1.split(';')
+        w2_split = w2.split(';')
+        w1 = ''
+        w2 = ''
+        for w in w1_split:
+            w_split = w.split(' ')
+            for wt in w_split:
+                inx = wt.find('#')
+                if inx != -1:
+                    wt = wt[:inx]
+                w1 = w1 + wt + ' '
+        for w in w2_split:
+            w_split = w.split(' ')
+            for wt in w_split:
+                inx = wt.find('#')
+                if inx != -1:
+                    wt = wt[:inx]
+                w2 = w2 + wt + ' '
+        c1 = word_to_concept(w1[:-1])
+        c2 = word_to_concept(w2[:-1])
+        r = row['attribut']
+        rel = word_to_rel(r)
+        score = row['score']
+        source = 'http://people.mpi-inf.mpg.de/~ntandon/resources/readme-activity.html'
+        assoc = [c1, c2, score, source, rel]
+        assertions_temp_list.append(assoc)
+    web_child_res = pd.DataFrame(assertions_temp_list, index=None)
+    web_child_res.to_csv(out_name, sep='\t', index=False, header=False)
+
+
+def legacy_webchild_spatial_to_conceptnet_format(path_to_tab_sep_file, out_name):
+    column_names = ['word1', 'locationword', 'artikels_with_counts', 'score']
+    data = load_df(path_to_tab_sep_file, columns=column_names)
+    assertions_temp_list = []
+    i = 0
+    for index, row in data.iterrows():
+        i += 1
+        w1 = str(row['word1'])
+        w2 = str(row['locationword'])
+        if w1.find('#') != -1:
+            w1 = w1[:w1.find('#')]
+        if w2.find('#') != -1:
+            w2 = w2[:w2.find('#')]
+        c1 = word_to_concept(w1)
+        c2 = word_to_concept(w2)
+        r = row['artikels_with_counts']
+        rel_value_list = r.split(',')
+        rel_value_dict = {}
+        for rel_val in rel_value_list:
+            rv_split = rel_val.split(' :')
+            rel_value_dict[float(rv_split[1])] = rv_split[0]
+        maxim = max(rel_value_dict)
+        r = 'is located ' + rel_value_dict[maxim]
+        rel = word_to_rel(r)
+        score = row['score']
+        source = 'spatial'
+        assoc = [c1, c2, score, source, rel]
+        assertions_temp_list.append(assoc)
+    web_child_res = pd.DataFrame(assertions_temp_list, index=None)
+    web_child_res.to_csv(out_name, sep='\t', index=False, header=False)
+
+
+def write_random_webchild(tmp_dir, n_rows, seed=0):
+    """Writes synthetic property (DataFrame), action and spatial subgraphs, returns the property DataFrame"""
+    rand = np.random.RandomState(seed)
+    words = np.array(['word{}#{}'.format(i, 'an'[i % 2]) + ('#{}'.format(i % 7) if i % 3 else '')
+                      for i in range(5000)] + ['-', 'two words#n'], dtype=object)
+
+    def pick(n=n_rows):
+        return words[rand.randint(0, len(words), n)]
+    property_df = pd.DataFrame({'#x': pick(), 'y': pick(), 'r': pick(), 'score': rand.rand(n_rows).round(4),
+                                'sources': 'http://people.mpi-inf.mpg.de/~ntandon/resources/readme-property.html'})
+    action_df = pd.DataFrame({'action': pick() + ';' + pick(), 'attribut': rand.choice(['time', 'location', '-'],
+                                                                                       n_rows),
+                              'attribut_value': pick() + ' ' + pick(), 'score': rand.rand(n_rows).round(4)})
+    action_df.to_csv(os.path.join(tmp_dir, 'wc_action.csv'), sep='\t', index=False, header=False)
+    counts = rand.randint(0, 20, (n_rows, 3))
+    spatial_df = pd.DataFrame({'word1': pick(), 'locationword': pick(),
+                               'artikels_with_counts': ['in :{},on :{},under :{}'.format(*c) for c in counts],
+                               'score': rand.rand(n_rows).round(4)})
+    spatial_df.to_csv(os.path.join(tmp_dir, 'wc_spatial.csv'), sep='\t', index=False, header=False)
+    return property_df
+
+
+def bench(tmp_dir, n_rows, with_legacy):
+    property_df = write_random_webchild(tmp_dir, n_rows)
+    action_path = os.path.join(tmp_dir, 'wc_action.csv')
+    spatial_path = os.path.join(tmp_dir, 'wc_spatial.csv')
+    runs = [('property', webchild_to_conceptnet_format, legacy_webchild_to_conceptnet_format, property_df),
+            ('action', webchild_action_to_conceptnet_format, legacy_webchild_action_to_conceptnet_format, action_path),
+            ('spatial', webchild_spatial_to_conceptnet_format, legacy_webchild_spatial_to_conceptnet_format,
+             spatial_path)]
+    for name, func, legacy_func, data in runs:
+        out_path = os.path.join(tmp_dir, name + '_out.csv')
+        start = time.perf_counter()
+        func(data, out_path)
+        seconds = time.perf_counter() - start
+        line = '{} rows {}: column-wise {:.2f}s'.format(n_rows, name, seconds)
+        if with_legacy:
+            legacy_path = os.path.join(tmp_dir, name + '_legacy.csv')
+            start = time.perf_counter()
+            legacy_func(data, legacy_path)
+            legacy_seconds = time.perf_counter() - start
+            assert filecmp.cmp(out_path, legacy_path, shallow=False), name + ' output differs'
+            line += ', iterrows {:.2f}s, speedup {:.0f}x'.format(legacy_seconds, legacy_seconds / seconds)
+        print(line)
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bench(tmp_dir, 200000, with_legacy=True)
+        bench(tmp_dir, 2000000, with_legacy=False)
@@ -0,0 +1,189 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import numpy as np
+
+from analysis.ablation_study import get_subgraph, get_subgraphs, get_pruned_graph, get_pruned_graphs, \
+    get_original_pruned_graph, get_shuffled_graph, get_shuffled_graphs, get_shuffled_english_graph
+from benchmarks.synthetic import write_conceptnet, write_webchild, write_yago_taxonomy, write_bert_results
+from graph_reweighting.lm_scoring import score_sentence_file
+from graph_reweighting.perplexities_to_scores import apply_reweight, get_perplexity_from_multiple_files, \
+    perplexities_to_scores
+from graph_reweighting.streaming_pipeline import stream_sentences, stream_reweight
+from graph_store import tsv_to_graph_store
+from instrumentation import start_run, get_run_report
+from sentence_construction.graph_to_sentence import get_all_sentences, split_text_file, prepare_lm_chunks
+from sentence_construction.WebChild_to_sentence import webchild_to_conceptnet_format, \
+    webchild_action_to_conceptnet_format, webchild_spatial_to_conceptnet_format, reduce_webchild, \
+    webchild_get_all_sentences
+from sentence_construction.yago_to_sentence import yago_taxonomy_to_conceptnet_format
+from util import load_df, load_graph, get_en_idx, concatenate_files
+
+"""
+Benchmark suite: times the public entry points on deterministic synthetic inputs (see benchmarks/synthetic.py)
+and compares them to a stored baseline, so regressions show up between runs.
+python -m benchmarks.run_suite --edges 100000
+python -m benchmarks.run_suite --edges 1000000 --update-baseline
+Baselines are stored per size in benchmarks/baselines/edges_<n>.json. Timings depend on the machine,
+compare only baselines recorded on the same kind of host (stored with each baseline).
+"""
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+CN_COLUMNS = ['word1', 'word2', 'score', 'sources', 'relation']
+REGRESSION_FACTOR = 1.5  # slower than baseline by this factor ...
+REGRESSION_MIN_S = 0.1  # ... and by at least this many seconds counts as regression
+LM_SENTENCES = 50000  # the stand-in LM scores token by token in Python, so only a sample is timed
+
+
+class Timer:
+    def __init__(self):
+        self.timings = {}
+
+    def __call__(self, name, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.timings[name] = time.perf_counter() - start
+        print('{:<38} {:8.2f}s'.format(name, self.timings[name]), flush=True)
+        return result
+
+
+def run_conceptnet_cases(timer, n_edges, seed):
+    timer('generate_conceptnet', write_conceptnet, 'cn.csv', n_edges, seed)
+    graph_df = timer('load_df', load_df, 'cn.csv', columns=CN_COLUMNS)
+    timer('tsv_to_graph_store', tsv_to_graph_store, 'cn.csv', 'cn_store')
+    timer('load_graph_store', load_graph, 'cn_store')
+    en_idx = timer('get_en_idx', get_en_idx, graph_df)
+    timer('get_all_sentences', get_all_sentences, graph_df, en_idx, 'cn_sentences.txt', 'cn_sentences.csv')
+    timer('stream_sentences', stream_sentences, 'cn.csv', 'cn_stream_sentences.txt', 'cn_stream_sentences.csv',
+          CN_COLUMNS)
+    os.makedirs('split', exist_ok=True)
+    timer('split_text_file', split_text_file, 'cn_sentences.txt', 'split/cn_sentences_{}.txt', 200000)
+    timer('prepare_lm_chunks', prepare_lm_chunks, 'cn_sentences.txt', 'lm_input', 8, max_len=43)
+
+    with open('cn_sentences.txt') as sentence_file:
+        n_sentences = sum(1 for _ in sentence_file)
+    timer('generate_bert_results', write_bert_results, 'bert_results', n_sentences, 200000, seed)
+    perplex = timer('get_perplexity_from_multiple_files', get_perplexity_from_multiple_files, 'bert_results')
+    timer('perplexities_to_scores', perplexities_to_scores, perplex, 'reweight')
+    timer('apply_reweight', apply_reweight, 'cn_sentences.csv', 'cn.csv', 'bert_results', 'cn_reweight.csv',
+          'reweight')
+    timer('apply_reweight_store', apply_reweight, 'cn_sentences.csv', 'cn_store', 'bert_results',
+          'cn_store_reweight.csv', 'reweight')
+    timer('apply_reweight_relation', apply_reweight, 'cn_sentences.csv', 'cn.csv', 'bert_results',
+          'cn_relation_reweight.csv', 'relation_reweight')
+    timer('stream_reweight', stream_reweight, 'cn_sentences.csv', 'cn.csv', 'bert_results',
+          'cn_stream_reweight.csv', 'reweight')
+
+    with open('cn_sentences.txt') as sentence_file, open('lm_sample.txt', 'w') as sample_file:
+        for _, line in zip(range(LM_SENTENCES), sentence_file):
+            sample_file.write(line)
+    timer('score_sentence_file', score_sentence_file, 'lm_sample.txt', 'lm_results', chunk_size=10000)
+
+    weighted_df = load_df('cn_reweight.csv', columns=CN_COLUMNS)
+    os.makedirs('Thresholds', exist_ok=True)
+    timer('get_subgraph', get_subgraph, graph_df, '/d/wordnet/', 'cn_subgraph_{}_{}.csv')
+    timer('get_subgraphs', get_subgraphs, graph_df, ['/d/wiktionary/', '/d/wordnet/', '/d/conceptnet/', '/d/verbosity',
+                                                     '/d/dbpedia/', '/d/jmdict', '/d/opencyc', '/d/umbel'],
+          'cn_subgraph_{}_{}.csv')
+    timer('get_pruned_graph', get_pruned_graph, weighted_df, 1, 'cn_pruned_{}.csv')
+    timer('get_pruned_graphs_20', get_pruned_graphs, weighted_df, np.linspace(0.5, 10, 20).tolist(), 'cn_pruned_{}.csv')
+    timer('get_original_pruned_graph', get_original_pruned_graph, graph_df, weighted_df, 1, 'cn_orig')
+    timer('get_shuffled_graph', get_shuffled_graph, graph_df, ['word2'], 'cn_shuffled.csv', seed)
+    timer('get_shuffled_graphs_10', get_shuffled_graphs, graph_df, ['word2'], 'cn_shuffled_{}.csv', range(10))
+    timer('get_shuffled_english_graph', get_shuffled_english_graph, graph_df, 'score', 'cn_en_shuffled.csv', seed)
+
+
+def run_converter_cases(timer, n_rows, seed):
+    timer('generate_webchild', write_webchild, '.', n_rows, seed)
+    cn_format_dir = os.path.join('WebChild', 'ConceptNet_Format')
+    os.makedirs(cn_format_dir, exist_ok=True)
+    os.makedirs(os.path.join('output', 'sentences'), exist_ok=True)
+    converted = [os.path.join(cn_format_dir, name) for name in ['webchild_property_concepntnetFormat.csv',
+                                                                 'webchild_activity_concepntnetFormat.csv',
+                                                                 'webchild_spatial_concepntnetFormat.csv']]
+    property_df = load_df('wc_property.csv', columns=['#x', 'y', 'r', 'score', 'sources'])
+    timer('webchild_to_conceptnet_format', webchild_to_conceptnet_format, property_df, converted[0])
+    timer('webchild_action_to_conceptnet_format', webchild_action_to_conceptnet_format, 'wc_action.csv',
+          converted[1])
+    timer('webchild_spatial_to_conceptnet_format', webchild_spatial_to_conceptnet_format, 'wc_spatial.csv',
+          converted[2])
+    timer('concatenate_files', concatenate_files, converted, 'wc_cnformat.csv')
+    wc_df = load_df('wc_cnformat.csv', columns=CN_COLUMNS + ['filename'])
+    timer('reduce_webchild', reduce_webchild, wc_df, 'wc_cnformat_reduced.csv')
+    wc_reduced = load_df('wc_cnformat_reduced.csv', columns=CN_COLUMNS + ['file'])
+    timer('webchild_get_all_sentences', webchild_get_all_sentences, wc_reduced, wc_reduced.index.values,
+          'wc_sentences.txt', 'wc_sentences.csv')
+
+    timer('generate_yago', write_yago_taxonomy, 'yago_taxonomy.tsv', n_rows, seed)
+    timer('yago_taxonomy_to_conceptnet_format', yago_taxonomy_to_conceptnet_format, 'yago_taxonomy.tsv',
+          'yago_cnformat.csv')
+
+
+def run_suite(n_edges, seed=0, work_dir=None):
+    """Runs all cases in work_dir (default: a temporary directory), returns the results with timings per case"""
+    start_run()
+    timer = Timer()
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp(dir=work_dir)
+    try:
+        os.chdir(tmp_dir)
+        run_conceptnet_cases(timer, n_edges, seed)
+        run_converter_cases(timer, max(n_edges // 4, 1), seed)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    stages = {}
+    for record in get_run_report().stages:
+        stages[record['stage']] = stages.get(record['stage'], 0.0) + record['wall_s']
+    return {'edges': n_edges, 'seed': seed, 'host': {'machine': platform.machine(), 'processor': platform.processor(),
+                                                     'cpus': os.cpu_count(), 'python': platform.python_version(),
+                                                     'numpy': np.__version__},
+            'timings': timer.timings, 'stages': stages,
+            'process_peak_rss_mb': get_run_report().to_dict()['process_peak_rss_mb']}
+
+
+def baseline_path(n_edges):
+    return os.path.join(BASELINE_DIR, 'edges_{}.json'.format(n_edges))
+
+
+def compare_to_baseline(results, baseline, factor=REGRESSION_FACTOR, min_seconds=REGRESSION_MIN_S):
+    """Cases slower than the baseline by factor and at least min_seconds, as {case: (baseline s, current s)}"""
+    regressions = {}
+    for case, seconds in results['timings'].items():
+        before = baseline['timings'].get(case)
+        if before is not None and seconds > before * factor and seconds - before > min_seconds:
+            regressions[case] = (before, seconds)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times the REWEIGHT entry points on synthetic graphs')
+    parser.add_argument('--edges', type=int, default=100000, help='ConceptNet-format edges, 10^5 to 10^8')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', default=None, help='directory for the temporary inputs and outputs')
+    parser.add_argument('--update-baseline', action='store_true', help='store the timings as new baseline')
+    parser.add_argument('--factor', type=float, default=REGRESSION_FACTOR)
+    args = parser.parse_args()
+
+    results = run_suite(args.edges, args.seed, args.work_dir)
+    path = baseline_path(args.edges)
+    if args.update_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(path, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        print('Baseline written to', path)
+    elif os.path.isfile(path):
+        with open(path) as baseline_file:
+            regressions = compare_to_baseline(results, json.load(baseline_file), factor=args.factor)
+        for case, (before, now) in sorted(regressions.items()):
+            print('REGRESSION {}: {:.2f}s -> {:.2f}s'.format(case, before, now))
+        if regressions:
+            sys.exit(1)
+        print('No regressions against', path)
+    else:
+        print('No baseline for {} edges, store one with --update-baseline'.format(args.edges))
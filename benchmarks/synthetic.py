@@ -0,0 +1,190 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+"""
+Deterministic synthetic inputs for the benchmark suite
+
+Same seed and size give byte-identical files. Everything is generated and written in blocks of GENERATOR_BLOCK rows,
+so inputs up to 10^8 edges need no more memory than the concept vocabulary.
+Language, relation and source shares roughly follow ConceptNet 5.7: about a third of all concepts and the most used
+ones are English, so 10-20% of the edges are English-English, and RelatedTo, FormOf and DerivedFrom dominate
+the relations. Concept popularity is Zipf-distributed like in the real graph.
+"""
+
+GENERATOR_BLOCK = 1000000
+
+LANGUAGE_SHARES = {'en': 0.31, 'fr': 0.12, 'de': 0.06, 'ja': 0.05, 'it': 0.05, 'es': 0.05, 'ru': 0.04, 'zh': 0.04,
+                   'nl': 0.03, 'pt': 0.03, 'fi': 0.03, 'la': 0.03, 'sv': 0.02, 'pl': 0.02, 'ms': 0.02, 'cs': 0.02,
+                   'ar': 0.02, 'ca': 0.02, 'hu': 0.01, 'eo': 0.01, 'da': 0.01, 'ga': 0.01, 'gl': 0.01, 'tr': 0.01}
+RELATION_SHARES = {'/r/RelatedTo': 0.42, '/r/FormOf': 0.11, '/r/DerivedFrom': 0.085, '/r/Synonym': 0.06,
+                   '/r/HasContext': 0.06, '/r/IsA': 0.06, '/r/EtymologicallyRelatedTo': 0.02, '/r/SimilarTo': 0.01,
+                   '/r/UsedFor': 0.01, '/r/AtLocation': 0.008, '/r/HasSubevent': 0.007, '/r/CapableOf': 0.006,
+                   '/r/HasPrerequisite': 0.006, '/r/Antonym': 0.006, '/r/Causes': 0.005, '/r/PartOf': 0.004,
+                   '/r/MannerOf': 0.004, '/r/HasProperty': 0.003, '/r/MotivatedByGoal': 0.003,
+                   '/r/ReceivesAction': 0.002, '/r/HasA': 0.002, '/r/CausesDesire': 0.002, '/r/Desires': 0.001,
+                   '/r/DistinctFrom': 0.001, '/r/HasFirstSubevent': 0.001, '/r/HasLastSubevent': 0.001,
+                   '/r/dbpedia/genre': 0.02, '/r/ExternalURL': 0.05, '/r/Entails': 0.001, '/r/InstanceOf': 0.001,
+                   '/r/LocatedNear': 0.001, '/r/NotDesires': 0.001}
+SOURCE_SHARES = {'/d/wiktionary/en': 0.45, '/d/wiktionary/fr': 0.1, '/d/wiktionary/de': 0.03,
+                 '/d/conceptnet/4/en': 0.1, '/d/conceptnet/4/zh': 0.03, '/d/wordnet/3.1': 0.08,
+                 '/d/verbosity': 0.03, '/d/dbpedia/en': 0.05, '/d/jmdict': 0.04, '/d/opencyc': 0.03,
+                 '/d/umbel': 0.02, '/d/emoji': 0.01, '/d/kyoto_yahoo': 0.03}
+POS_TAGS = ['', '', '', '/n', '/v', '/a']
+
+
+def _choice(rand, shares, size):
+    names = np.array(list(shares), dtype=object)
+    probs = np.array(list(shares.values()), dtype=np.float64)
+    return names[rand.choice(len(names), size=size, p=probs / probs.sum())]
+
+
+def _zipf_ids(rand, n_values, size, exponent=1.15):
+    """Ids in [0, n_values) with Zipf-distributed popularity, the most popular ids spread over the range"""
+    return ((rand.zipf(exponent, size) - 1) * 7919) % n_values
+
+
+def _words(ids, rand):
+    """Surface words for ids, every fifth a two-word compound"""
+    words = pd.Series(ids).map('w{}'.format)
+    compound = rand.rand(len(ids)) < 0.2
+    words[compound] = words[compound] + '_' + pd.Series(ids[compound] % 9973).map('x{}'.format).to_numpy()
+    return words.to_numpy(dtype=object)
+
+
+def concept_vocabulary(n_concepts, seed=0):
+    """ConceptNet concept URIs /c/<lang>/<word>[/<pos>] for n_concepts concepts"""
+    rand = np.random.RandomState(seed)
+    languages = _choice(rand, LANGUAGE_SHARES, n_concepts)
+    languages[_zipf_ids(rand, n_concepts, n_concepts // 20000 + 1)] = 'en'  # the most used concepts are English
+    words = _words(np.arange(n_concepts), rand)
+    pos = np.array(POS_TAGS, dtype=object)[rand.randint(0, len(POS_TAGS), n_concepts)]
+    return '/c/' + languages + '/' + words + pos
+
+
+def conceptnet_blocks(n_edges, seed=0, n_concepts=None):
+    """DataFrames with columns word1, word2, score, sources, relation of GENERATOR_BLOCK edges each"""
+    n_concepts = n_concepts or max(min(n_edges // 4, 10000000), 100)
+    concepts = concept_vocabulary(n_concepts, seed)
+    rand = np.random.RandomState(seed + 1)
+    for start in range(0, n_edges, GENERATOR_BLOCK):
+        size = min(GENERATOR_BLOCK, n_edges - start)
+        sources = _choice(rand, SOURCE_SHARES, size)
+        scores = np.where(sources == '/d/wordnet/3.1', 2.0, 1.0)
+        crowd = np.char.startswith(sources.astype(str), '/d/conceptnet/4')
+        scores[crowd] = rand.randint(1, 12, crowd.sum()) / 2  # several contributors
+        yield pd.DataFrame({'word1': concepts[_zipf_ids(rand, n_concepts, size)],
+                            'word2': concepts[_zipf_ids(rand, n_concepts, size)],
+                            'score': scores, 'sources': sources,
+                            'relation': _choice(rand, RELATION_SHARES, size)})
+
+
+def write_conceptnet(path, n_edges, seed=0, n_concepts=None):
+    """Writes a headerless ConceptNet-format TSV, returns the number of edges"""
+    with open(path, 'w', newline='') as out_file:
+        for block in conceptnet_blocks(n_edges, seed, n_concepts):
+            block.to_csv(out_file, sep='\t', index=False, header=False)
+    return n_edges
+
+
+def _sense_words(rand, size, n_words, senses=True):
+    ids = _zipf_ids(rand, n_words, size)
+    words = pd.Series(ids).map('w{}'.format).to_numpy(dtype=object)
+    if senses:
+        words = words + '#' + np.array(['n', 'a', 'v'], dtype=object)[ids % 3] + '#' + (ids % 5 + 1).astype(str)
+    return words
+
+
+def write_webchild(out_dir, n_rows, seed=0, n_words=50000):
+    """
+    Writes WebChild-shaped subgraphs to out_dir:
+    wc_property.csv (#x, y, r, score, sources), wc_action.csv (action, attribut, attribut_value, score)
+    and wc_spatial.csv (word1, locationword, artikels_with_counts, score), all headerless TSV.
+    Returns the column names of each file.
+    """
+    rand = np.random.RandomState(seed)
+    columns = {'wc_property.csv': ['#x', 'y', 'r', 'score', 'sources'],
+               'wc_action.csv': ['action', 'attribut', 'attribut_value', 'score'],
+               'wc_spatial.csv': ['word1', 'locationword', 'artikels_with_counts', 'score']}
+    attributes = np.array(['color', 'size', 'shape', 'taste', 'temperature', 'ability'], dtype=object)
+    files = {name: open(os.path.join(out_dir, name), 'w', newline='') for name in columns}
+    try:
+        for start in range(0, n_rows, GENERATOR_BLOCK):
+            size = min(GENERATOR_BLOCK, n_rows - start)
+            pd.DataFrame({'#x': _sense_words(rand, size, n_words), 'y': _sense_words(rand, size, n_words),
+                          'r': attributes[rand.randint(0, len(attributes), size)] + '#n#1',
+                          'score': rand.rand(size).round(4),
+                          'sources': 'http://people.mpi-inf.mpg.de/~ntandon/resources/readme-property.html'}
+                         ).to_csv(files['wc_property.csv'], sep='\t', index=False, header=False)
+            pd.DataFrame({'action': _sense_words(rand, size, n_words) + ';' + _sense_words(rand, size, n_words),
+                          'attribut': np.array(['time', 'location', 'participant', '-'],
+                                               dtype=object)[rand.randint(0, 4, size)],
+                          'attribut_value': _sense_words(rand, size, n_words) + ' ' + _sense_words(rand, size,
+                                                                                                   n_words),
+                          'score': rand.rand(size).round(4)}
+                         ).to_csv(files['wc_action.csv'], sep='\t', index=False, header=False)
+            counts = rand.randint(0, 30, (size, 3))
+            pd.DataFrame({'word1': _sense_words(rand, size, n_words), 'locationword': _sense_words(rand, size, n_words),
+                          'artikels_with_counts': 'in :' + counts[:, 0].astype(str).astype(object) + ',on :' +
+                                                  counts[:, 1].astype(str).astype(object) + ',under :' +
+                                                  counts[:, 2].astype(str).astype(object),
+                          'score': rand.rand(size).round(4)}
+                         ).to_csv(files['wc_spatial.csv'], sep='\t', index=False, header=False)
+    finally:
+        for out_file in files.values():
+            out_file.close()
+    return columns
+
+
+def write_yago_taxonomy(path, n_lines, seed=0, n_classes=200000):
+    """
+    Writes a YAGO taxonomy TSV (header, then id, subject, relation, object) with wikicat and wordnet classes.
+    About 1% of the lines use another relation, as in the real taxonomy dump.
+    """
+    rand = np.random.RandomState(seed)
+    with open(path, 'w', newline='') as out_file:
+        out_file.write('id\tsubject\tpredicate\tobject\n')
+        for start in range(0, n_lines, GENERATOR_BLOCK):
+            size = min(GENERATOR_BLOCK, n_lines - start)
+            ids = _zipf_ids(rand, n_classes, size)
+            subjects = np.where(rand.rand(size) < 0.9,
+                                '<wikicat_' + pd.Series(ids).map('W{}'.format).to_numpy(dtype=object) + '_things>',
+                                '<wordnet_' + pd.Series(ids).map('w{}'.format).to_numpy(dtype=object) + '_1' +
+                                (ids % 100000).astype(str).astype(object) + '>')
+            parents = _zipf_ids(rand, n_classes // 10 + 1, size)
+            objects = '<wordnet_' + pd.Series(parents).map('w{}'.format).to_numpy(dtype=object) + '_1' + \
+                      (parents % 100000).astype(str).astype(object) + '>'
+            relations = np.where(rand.rand(size) < 0.99, 'rdfs:subClassOf', 'owl:equivalentClass')
+            pd.DataFrame({'id': '<id_' + (start + np.arange(size)).astype(str).astype(object) + '>',
+                          'subject': subjects, 'predicate': relations, 'object': objects}
+                         ).to_csv(out_file, sep='\t', index=False, header=False)
+    return n_lines
+
+
+def write_bert_results(out_dir, n_sentences, chunk_size=200000, seed=0, with_tokens=True):
+    """
+    Writes BERT_LM-shaped result folders out_dir/chunk{i}/test_results.json for n_sentences sentences.
+    with_tokens: include the per-token probabilities like the real output (about 10x larger files).
+    Perplexities are log-normal around 300.
+    """
+    rand = np.random.RandomState(seed)
+    for i, start in enumerate(range(0, n_sentences, chunk_size)):
+        size = min(chunk_size, n_sentences - start)
+        chunk_dir = os.path.join(out_dir, 'chunk{}'.format(i))
+        os.makedirs(chunk_dir, exist_ok=True)
+        perplexities = np.exp(rand.randn(size) * 1.5 + 5.7)
+        lengths = rand.randint(5, 10, size)
+        with open(os.path.join(chunk_dir, 'test_results.json'), 'w') as json_file:
+            json_file.write('[\n')
+            for j in range(size):
+                entry = {'ppl': float(perplexities[j])}
+                if with_tokens:
+                    entry = {'tokens': [{'token': 'w{}'.format(t), 'prob': float(p)}
+                                        for t, p in zip(rand.randint(0, 30000, lengths[j]),
+                                                        rand.rand(lengths[j]))],
+                             'ppl': float(perplexities[j])}
+                json_file.write(json.dumps(entry, indent=2))
+                json_file.write(',\n' if j < size - 1 else '\n')
+            json_file.write(']\n')
+    return n_sentences
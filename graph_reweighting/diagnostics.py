@@ -0,0 +1,206 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+"""
+Headless REWEIGHT diagnostics
+
+Histograms and summary statistics of perplexities and weights, collected chunk by chunk with NumPy
+and written as a compact diagnostics.json plus one PNG per histogram. Plots are drawn on an Agg canvas,
+so nothing needs a display and nothing blocks.
+"""
+
+HISTOGRAM_BINS = 200
+SUMMARY_QUANTILES = [0.01, 0.25, 0.5, 0.75, 0.99]
+
+
+def group_moments(values, groups):
+    """count, mean, m2 (sum of squared deviations), min and max of values per group, NaN values skipped"""
+    grouped = pd.Series(values).groupby(np.asarray(groups, dtype=object))
+    count = grouped.count()
+    return pd.DataFrame({'count': count, 'mean': grouped.mean(), 'm2': grouped.var(ddof=0) * count,
+                         'min': grouped.min(), 'max': grouped.max()})
+
+
+def merge_moments(a, b):
+    """Combines two group_moments tables (Chan et al.), stable for large counts"""
+    index = a.index.union(b.index)
+    a = a.reindex(index)
+    b = b.reindex(index)
+    a_count = a['count'].fillna(0)
+    b_count = b['count'].fillna(0)
+    count = a_count + b_count
+    delta = b['mean'].fillna(0) - a['mean'].fillna(0)
+    with np.errstate(invalid='ignore'):
+        mean = (a['mean'].fillna(0) + delta * b_count / count).fillna(0)
+        m2 = a['m2'].fillna(0) + b['m2'].fillna(0) + (delta ** 2 * a_count * b_count / count).fillna(0)
+    return pd.DataFrame({'count': count, 'mean': mean, 'm2': m2,
+                         'min': np.fmin(a['min'], b['min']), 'max': np.fmax(a['max'], b['max'])})
+
+
+def empty_moments():
+    return pd.DataFrame({'count': [], 'mean': [], 'm2': [], 'min': [], 'max': []})
+
+
+class StreamingHistogram:
+    """
+    Histogram with a fixed number of equal-width bins whose range grows with the data:
+    when a chunk falls outside it, the bin width is doubled until the range covers it and the old bins are merged,
+    so the counts stay exact for the (coarser) bins. log: bins over log10 of the values.
+    """
+
+    def __init__(self, bins=HISTOGRAM_BINS, log=False):
+        self.bins = bins
+        self.log = log
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.low = None
+        self.width = None
+        self.count = 0
+        self.nan = 0
+        self.sum = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def _extend(self, low, high):
+        if self.low is None:
+            self.low = low
+            self.width = max(high - low, abs(low) * 1e-9, 1e-12) / self.bins * (1 + 1e-9)
+        # smallest power of two wider bins that cover [low, high], aligned with the old bin edges
+        factor = 1
+        while True:
+            width = self.width * factor
+            shift = int(np.ceil((self.low - low) / width)) if low < self.low else 0
+            if np.floor((high - (self.low - shift * width)) / width) < self.bins:
+                break
+            factor *= 2
+        target = shift + np.arange(self.bins) // factor
+        counts = np.bincount(target, weights=self.counts, minlength=self.bins).astype(np.int64)
+        # old bins mapped past the end are above the old maximum, so empty
+        counts = counts[:self.bins]
+        self.counts = counts
+        self.low -= shift * width
+        self.width = width
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if self.log:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = np.log10(values)
+        finite = np.isfinite(values)
+        self.nan += int((~finite).sum())
+        values = values[finite]
+        if not len(values):
+            return
+        chunk_min, chunk_max = values.min(), values.max()
+        if self.low is None or chunk_min < self.low or chunk_max >= self.low + self.bins * self.width:
+            self._extend(min(chunk_min, self.min), max(chunk_max, self.max))
+        bins = np.minimum(((values - self.low) / self.width).astype(np.int64), self.bins - 1)
+        self.counts += np.bincount(bins, minlength=self.bins)
+        # running mean and m2 merged per chunk
+        chunk_mean = values.mean()
+        total = self.count + len(values)
+        delta = chunk_mean - (self.sum / self.count if self.count else 0.0)
+        self.m2 += ((values - chunk_mean) ** 2).sum() + delta ** 2 * self.count * len(values) / total
+        self.sum += values.sum()
+        self.count = total
+        self.min = min(self.min, chunk_min)
+        self.max = max(self.max, chunk_max)
+
+    def quantiles(self, qs):
+        """Approximate quantiles, interpolated linearly within a bin"""
+        if not self.count:
+            return [None] * len(qs)
+        cumulative = np.r_[0, self.counts.cumsum()]
+        result = []
+        for q in qs:
+            target = q * self.count
+            b = max(min(np.searchsorted(cumulative, target, side='left'), self.bins) - 1, 0)
+            within = (target - cumulative[b]) / self.counts[b] if self.counts[b] else 0.0
+            result.append(float(np.clip(self.low + (b + within) * self.width, self.min, self.max)))
+        return result
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0, 'nan': self.nan}
+        summary = {'count': self.count, 'nan': self.nan, 'mean': float(self.sum / self.count),
+                   'std': float(np.sqrt(self.m2 / self.count)), 'min': float(self.min), 'max': float(self.max)}
+        summary.update({'q{:g}'.format(q * 100): value
+                        for q, value in zip(SUMMARY_QUANTILES, self.quantiles(SUMMARY_QUANTILES))})
+        return summary
+
+    def to_dict(self):
+        return {'log10': self.log, 'low': self.low, 'width': self.width, 'counts': self.counts.tolist()}
+
+
+class Diagnostics:
+    """
+    Collects a StreamingHistogram and per-group (relation) summary statistics for each named series,
+    both over log10 of the values for log=True.
+    With enabled=False every call is a no-op, so nothing is computed or written.
+    diagnostics = Diagnostics()
+    diagnostics.add('perplexity', perplex, groups=relations, log=True)
+    diagnostics.write('cn_reweight_diagnostics/')
+    """
+
+    def __init__(self, enabled=True, bins=HISTOGRAM_BINS):
+        self.enabled = enabled
+        self.bins = bins
+        self.histograms = {}
+        self.groups = {}
+
+    def add(self, name, values, groups=None, log=False):
+        if not self.enabled:
+            return
+        if name not in self.histograms:
+            self.histograms[name] = StreamingHistogram(self.bins, log=log)
+        self.histograms[name].update(values)
+        if groups is not None:
+            values = np.asarray(values, dtype=np.float64)
+            if log:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    values = np.log10(values)
+                values[~np.isfinite(values)] = np.nan
+            self.groups[name] = merge_moments(self.groups.get(name, empty_moments()), group_moments(values, groups))
+
+    def report(self):
+        report = {}
+        for name, histogram in self.histograms.items():
+            report[name] = {'summary': histogram.summary(), 'histogram': histogram.to_dict()}
+            if name in self.groups:
+                moments = self.groups[name]
+                report[name]['by_group'] = {
+                    str(group): {'count': int(row['count']), 'mean': float(row['mean']),
+                                 'std': float(np.sqrt(row['m2'] / row['count'])) if row['count'] else None,
+                                 'min': float(row['min']), 'max': float(row['max'])}
+                    for group, row in moments.iterrows()}
+        return report
+
+    def write(self, out_dir):
+        """Writes diagnostics.json and <name>.png to out_dir, returns the report"""
+        if not self.enabled:
+            return None
+        os.makedirs(out_dir, exist_ok=True)
+        report = self.report()
+        with open(os.path.join(out_dir, 'diagnostics.json'), 'w') as json_file:
+            json.dump(report, json_file, indent=1, default=float)
+        for name, histogram in self.histograms.items():
+            plot_histogram(histogram, os.path.join(out_dir, name + '.png'), title=name)
+        return report
+
+
+def plot_histogram(histogram, out_path, title=None):
+    """Draws a StreamingHistogram with log scale counts on an Agg canvas, no pyplot state involved"""
+    figure = Figure(figsize=(8, 5))
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    if histogram.count:
+        edges = histogram.low + histogram.width * np.arange(histogram.bins + 1)
+        axes.stairs(histogram.counts, edges, fill=True)
+        axes.set_yscale('log')
+    label = 'log10 ' + title if histogram.log else title
+    axes.set(title='Frequency Histogram ' + (label or ''), xlabel=label, ylabel='Frequency')
+    figure.savefig(out_path, dpi=100)
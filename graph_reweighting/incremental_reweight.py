@@ -0,0 +1,103 @@
+import os
+import numpy as np
+import pandas as pd
+
+from graph_reweighting.lm_scoring import write_perplexities
+from graph_reweighting.perplexities_to_scores import get_perplexity_from_multiple_files, apply_reweight
+from sentence_construction.graph_to_sentence import relations_to_sentences, write_missed_relations
+from util import load_df, load_graph, get_en_idx
+from instrumentation import stage
+
+"""
+Incremental REWEIGHT for graph version updates
+
+Only triples (word1, relation, word2) that are new, or whose sentence changed, are sent to the LM again.
+For all others the perplexity of the previous run is carried forward. The scores are then computed from the
+perplexities of all edges as in a full run, so the reweighted graph is the same as from a full apply_reweight.
+1. diff_sentences: sentence .csv for all edges of the new graph, .txt with the sentences to score
+2. run the LM on that .txt
+3. apply_incremental_reweight
+"""
+
+KEY_COLUMNS = ['word1', 'relation', 'word2']
+
+
+def _sentence_keys(graph_df, sentence_idx, sentences):
+    """(word1, relation, word2, sentence) of each sentence row"""
+    keys = pd.DataFrame({col: np.asarray(graph_df[col].to_numpy()[sentence_idx], dtype=object) for col in KEY_COLUMNS})
+    keys['sentence'] = np.asarray(sentences, dtype=object)
+    return keys
+
+
+def diff_sentences(graph_path, prev_graph_path, prev_sentence_csv_path, prev_perplexity_file_dir,
+                   out_txt, out_csv, carry_path, columns=None):
+    """
+    Writes the sentence .csv for all English edges of graph_path (as get_all_sentences), but only the sentences
+    without a previous perplexity to out_txt. The previous perplexities per sentence row are saved to carry_path
+    (.npy, NaN for sentences in out_txt). prev_graph_path can be the previous input or reweighted graph.
+    Returns the number of edges, reused and recomputed sentences, which are logged with the 'diff_sentences' stage.
+    diff_sentences(graph_path='conceptnet_v2.csv', prev_graph_path='cn_reweight_v1.csv',
+                   prev_sentence_csv_path='cn_sentences_v1.csv', prev_perplexity_file_dir='BERT_LM_results_v1/',
+                   out_txt='cn_sentences_v2_new.txt', out_csv='cn_sentences_v2.csv', carry_path='cn_v2_carry.npy')
+    """
+    columns = columns or ['word1', 'word2', 'score', 'sources', 'relation']
+    graph_df = load_graph(graph_path, columns=columns)
+    with stage('sentences', path=out_csv) as record:
+        sentences, missed = relations_to_sentences(graph_df.loc[get_en_idx(graph_df),
+                                                                ['word1', 'word2', 'relation']])
+        sent_df = pd.DataFrame({0: sentences.index.to_numpy(), 1: sentences.to_numpy()})
+        sent_df.to_csv(out_csv, sep='\t')
+        record['rows'] = len(sentences)
+    write_missed_relations(missed, os.path.join(os.path.dirname(out_txt), 'missed_relation_types.txt'))
+    new_keys = _sentence_keys(graph_df, graph_df.index.get_indexer(sentences.index), sentences)
+    del graph_df
+
+    prev_graph_df = load_graph(prev_graph_path, columns=columns)
+    prev_sentence_df = load_df(prev_sentence_csv_path, index=0)
+    prev_keys = _sentence_keys(prev_graph_df, prev_sentence_df['0'].to_numpy(), prev_sentence_df['1'])
+    del prev_graph_df
+    prev_perplex = get_perplexity_from_multiple_files(prev_perplexity_file_dir)
+    if len(prev_perplex) != len(prev_keys):
+        raise ValueError('Got {} previous perplexities for {} sentences'.format(len(prev_perplex), len(prev_keys)))
+    prev_keys['ppl'] = prev_perplex
+    prev_keys = prev_keys.drop_duplicates(KEY_COLUMNS + ['sentence'])
+
+    with stage('diff_sentences', path=out_txt) as record:
+        carried = new_keys.merge(prev_keys, how='left', on=KEY_COLUMNS + ['sentence'])['ppl'].to_numpy()
+        np.save(carry_path, carried)
+        recompute = np.isnan(carried)
+        with open(out_txt, 'w+') as text_file:
+            text_file.writelines(sentence + '\n' for sentence in sentences[recompute])
+        report = {'edges': len(carried), 'reused': int((~recompute).sum()), 'recomputed': int(recompute.sum())}
+        record.update(report)
+        record['rows'] = len(carried)
+    return report
+
+
+def merge_incremental_perplexities(carry_path, new_perplexity_file_dir, out_dir):
+    """
+    Fills the carried perplexities with the LM results for the new sentences (in order)
+    and writes them as out_dir/merged/test_results.json, the input for apply_reweight.
+    """
+    perplex = np.load(carry_path)
+    recompute = np.isnan(perplex)
+    new_perplex = get_perplexity_from_multiple_files(new_perplexity_file_dir)
+    if len(new_perplex) != recompute.sum():
+        raise ValueError('Got {} perplexities for {} new sentences'.format(len(new_perplex), recompute.sum()))
+    perplex[recompute] = new_perplex
+    write_perplexities(perplex, os.path.join(out_dir, 'merged'))
+
+
+def apply_incremental_reweight(sentence_csv_path, graph_path, carry_path, new_perplexity_file_dir, out_file,
+                               score_type, merged_perplexity_dir=None):
+    """
+    apply_reweight with carried forward and new perplexities, written to merged_perplexity_dir
+    (default: next to out_file) so later updates can diff against this run.
+    apply_incremental_reweight(sentence_csv_path='cn_sentences_v2.csv', graph_path='conceptnet_v2.csv',
+                               carry_path='cn_v2_carry.npy', new_perplexity_file_dir='BERT_LM_results_v2_new/',
+                               out_file='cn_reweight_v2.csv', score_type='reweight')
+    """
+    if merged_perplexity_dir is None:
+        merged_perplexity_dir = os.path.splitext(out_file)[0] + '_perplexities'
+    merge_incremental_perplexities(carry_path, new_perplexity_file_dir, merged_perplexity_dir)
+    apply_reweight(sentence_csv_path, graph_path, merged_perplexity_dir, out_file, score_type)
@@ -0,0 +1,232 @@
+import os
+import abc
+import json
+import zlib
+import hashlib
+import itertools
+import multiprocessing
+import numpy as np
+
+from graph_reweighting.perplexities_to_scores import get_perplexity_array_from_json
+from instrumentation import stage
+
+"""
+Generate perplexities for the sentences with a language model
+
+Built-in alternative to the external BERT_LM run: reads the sentence .txt written by get_all_sentences
+and writes one subfolder per chunk with a 'test_results.json' that only holds the 'ppl' of each sentence,
+the layout get_perplexity_from_multiple_files reads.
+"""
+
+
+class MaskedLMBackend(abc.ABC):
+    """
+    Interface for language models used by score_sentence_file.
+    token_probabilities gets a batch of sentences with the same number of tokens and returns an array of shape
+    (batch size, number of tokens) with the probability of each token given the rest of the sentence.
+    """
+
+    def tokenize(self, sentence):
+        return sentence.split()
+
+    @abc.abstractmethod
+    def token_probabilities(self, token_batch):
+        pass
+
+
+class StandInMaskedLM(MaskedLMBackend):
+    """
+    Tiny deterministic stand-in for a masked language model, for running the scoring stage offline.
+    The probability of a token only depends on a CRC32 hash of its neighbours and itself.
+    """
+
+    def __init__(self, min_prob=1e-4):
+        self.min_prob = min_prob
+
+    def token_probabilities(self, token_batch):
+        hashes = np.array([[zlib.crc32(' '.join(tokens[max(i - 1, 0):i + 2]).encode('utf-8'))
+                            for i in range(len(tokens))] for tokens in token_batch], dtype=np.float64)
+        return self.min_prob + (1 - self.min_prob) * hashes / 2 ** 32
+
+
+def pseudo_perplexity(probabilities):
+    """exp of the mean negative log probability per sentence (row), like the BERT_LM 'ppl'"""
+    return np.exp(-np.log(probabilities).mean(axis=1))
+
+
+def score_sentences(model, sentences, batch_size=64):
+    """
+    Pseudo-perplexities of sentences in input order. Sentences are grouped into buckets of equal token count,
+    so each batch is one dense array.
+    """
+    token_lists = [model.tokenize(sentence) for sentence in sentences]
+    result = np.full(len(sentences), np.nan)
+    buckets = {}
+    for i, tokens in enumerate(token_lists):
+        buckets.setdefault(len(tokens), []).append(i)
+    for length, bucket in buckets.items():
+        if length == 0:
+            continue  # no tokens, no perplexity
+        for start in range(0, len(bucket), batch_size):
+            batch = bucket[start:start + batch_size]
+            probabilities = model.token_probabilities([token_lists[i] for i in batch])
+            result[batch] = pseudo_perplexity(probabilities)
+    return result
+
+
+def is_chunk_scored(chunk_dir):
+    """A chunk is done when its test_results.json exists, it is only moved into place once fully written"""
+    return os.path.isfile(os.path.join(chunk_dir, 'test_results.json'))
+
+
+def write_perplexities(perplexities, chunk_dir):
+    """Writes test_results.json with one {'ppl': ...} per sentence, via a temporary file so it appears complete"""
+    os.makedirs(chunk_dir, exist_ok=True)
+    tmp_path = os.path.join(chunk_dir, 'test_results.json.tmp')
+    with open(tmp_path, 'w') as json_file:
+        json.dump([{'ppl': float(ppl)} for ppl in perplexities], json_file)
+    os.replace(tmp_path, os.path.join(chunk_dir, 'test_results.json'))
+
+
+def get_chunk_offsets(sentence_txt, chunk_size):
+    """Byte offset and number of sentences of each chunk of chunk_size lines, in one pass over the file"""
+    offsets = []
+    with open(sentence_txt, 'rb') as text_file:
+        while True:
+            offset = text_file.tell()
+            num_lines = sum(1 for _ in itertools.islice(text_file, chunk_size))
+            if num_lines == 0:
+                break
+            offsets.append((offset, num_lines))
+    return offsets
+
+
+_worker_model = None
+
+
+def _init_worker(model_factory, model_kwargs):
+    global _worker_model
+    _worker_model = model_factory(**model_kwargs)
+
+
+def _score_chunk(args):
+    sentence_txt, offset, num_lines, chunk_dir, batch_size = args
+    with open(sentence_txt, 'rb') as text_file:
+        text_file.seek(offset)
+        sentences = [line.decode('utf-8').rstrip('\n') for line in itertools.islice(text_file, num_lines)]
+    write_perplexities(score_sentences(_worker_model, sentences, batch_size), chunk_dir)
+    return chunk_dir, num_lines
+
+
+def _run_scoring_tasks(tasks, model_factory, model_kwargs, processes):
+    if processes is None:
+        processes = os.cpu_count()
+    processes = max(min(processes, len(tasks)), 1)
+    with stage('lm_scoring', chunks=len(tasks), processes=processes) as record:
+        if processes == 1:
+            _init_worker(model_factory, model_kwargs or {})
+            done = [_score_chunk(task) for task in tasks]
+        else:
+            with multiprocessing.Pool(processes, initializer=_init_worker,
+                                      initargs=(model_factory, model_kwargs or {})) as pool:
+                done = list(pool.imap_unordered(_score_chunk, tasks))
+        record['rows'] = sum(num_lines for _, num_lines in done)
+    return record['rows']
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as data_file:
+        for block in iter(lambda: data_file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scoring_run(model_factory, model_kwargs, batch_size, inputs):
+    """What the results of a scoring run depend on: the model, its arguments, the batch size and the inputs"""
+    return {'model': '{}.{}'.format(model_factory.__module__, model_factory.__qualname__),
+            'model_kwargs': json.loads(json.dumps(model_kwargs or {}, sort_keys=True, default=repr)),
+            'batch_size': batch_size, 'inputs': inputs}
+
+
+def check_scoring_run(previous_run, run, out_dir, chunk_dirs):
+    """
+    Raises a ValueError if out_dir already has scored chunks of another scoring run (or of an unknown one),
+    so resuming never mixes results of different models, settings or inputs
+    """
+    if previous_run == run or not any(is_chunk_scored(chunk_dir) for chunk_dir in chunk_dirs):
+        return
+    if previous_run is None:
+        raise ValueError('{} has scored chunks without a record of their scoring run, '
+                         'delete them or use another out_dir'.format(out_dir))
+    changed = sorted(key for key in run if previous_run.get(key) != run[key])
+    raise ValueError('{} has scored chunks of another scoring run (different {}), '
+                     'delete them or use another out_dir'.format(out_dir, ', '.join(changed)))
+
+
+def score_sentence_file(sentence_txt, out_dir, model_factory=StandInMaskedLM, model_kwargs=None,
+                        chunk_size=200000, batch_size=64, processes=None):
+    """
+    Scores all sentences of sentence_txt in chunks of chunk_size sentences, written to out_dir/chunk{i}/.
+    Chunks are scored in worker processes that each create their model with model_factory(**model_kwargs).
+    Chunks that already have results are skipped, so an interrupted run resumes where it stopped.
+    The model, its arguments, batch_size and the input are stored in out_dir/scoring.json,
+    resuming with results of another run raises a ValueError.
+    Returns the number of sentences scored in this run.
+    score_sentence_file(sentence_txt='cn_sentences.txt', out_dir='LM_results/', processes=8)
+    """
+    chunks = get_chunk_offsets(sentence_txt, chunk_size)
+    chunk_dirs = [os.path.join(out_dir, 'chunk{}'.format(i)) for i in range(len(chunks))]
+    run = scoring_run(model_factory, model_kwargs, batch_size,
+                      {'sentences': _file_digest(sentence_txt), 'chunk_size': chunk_size})
+    run_path = os.path.join(out_dir, 'scoring.json')
+    previous_run = None
+    if os.path.isfile(run_path):
+        with open(run_path) as run_file:
+            previous_run = json.load(run_file)
+    check_scoring_run(previous_run, run, out_dir, chunk_dirs)
+    os.makedirs(out_dir, exist_ok=True)
+    with open(run_path, 'w') as run_file:
+        json.dump(run, run_file, indent=2)
+
+    tasks = [(sentence_txt, offset, num_lines, chunk_dir, batch_size)
+             for (offset, num_lines), chunk_dir in zip(chunks, chunk_dirs) if not is_chunk_scored(chunk_dir)]
+    return _run_scoring_tasks(tasks, model_factory, model_kwargs, processes)
+
+
+def score_prepared_chunks(prepared_dir, out_dir, model_factory=StandInMaskedLM, model_kwargs=None,
+                          batch_size=64, processes=None):
+    """
+    Like score_sentence_file, for the chunks written by prepare_lm_chunks. Writes their manifest.json to out_dir,
+    so get_perplexity_from_multiple_files(out_dir) checks the results against it, with the scoring run
+    (model, arguments, batch_size, digest of every chunk) under 'scoring'.
+    score_prepared_chunks(prepared_dir='cn_lm_input/', out_dir='LM_results/', processes=8)
+    """
+    with open(os.path.join(prepared_dir, 'manifest.json')) as manifest_file:
+        manifest = json.load(manifest_file)
+    chunk_inputs = [os.path.join(prepared_dir, chunk['name'], 'sentences.txt') for chunk in manifest['chunks']]
+    chunk_dirs = [os.path.join(out_dir, chunk['name']) for chunk in manifest['chunks']]
+    run = scoring_run(model_factory, model_kwargs, batch_size,
+                      {'chunks': manifest['chunks'],
+                       'digests': {chunk['name']: _file_digest(path)
+                                   for chunk, path in zip(manifest['chunks'], chunk_inputs)}})
+    out_manifest_path = os.path.join(out_dir, 'manifest.json')
+    previous_run = None
+    if os.path.isfile(out_manifest_path):
+        with open(out_manifest_path) as manifest_file:
+            previous_run = json.load(manifest_file).get('scoring')
+    check_scoring_run(previous_run, run, out_dir, chunk_dirs)
+    os.makedirs(out_dir, exist_ok=True)
+    with open(out_manifest_path, 'w') as manifest_file:
+        json.dump(dict(manifest, scoring=run), manifest_file, indent=2)
+
+    tasks = [(path, 0, chunk['sentences'], chunk_dir, batch_size)
+             for chunk, path, chunk_dir in zip(manifest['chunks'], chunk_inputs, chunk_dirs)
+             if not is_chunk_scored(chunk_dir)]
+    return _run_scoring_tasks(tasks, model_factory, model_kwargs, processes)
+
+
+if __name__ == '__main__':
+    score_sentence_file(sentence_txt='./output/sentences/cn_toy_sentences.txt',
+                        out_dir='./output/lm_results/cn_toy/', chunk_size=4)
+    print(get_perplexity_array_from_json('./output/lm_results/cn_toy/chunk0/test_results.json'))
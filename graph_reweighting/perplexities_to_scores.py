@@ -1,12 +1,18 @@
 
 import os
-import tqdm
+import re
 import json
+import itertools
+import multiprocessing
 import numpy as np
 import pandas as pd
 from natsort import natsorted, ns
 
-from util import load_df, plot_hist
+from util import load_df, load_graph_text
+from graph_store import is_graph_store, load_graph_store
+from instrumentation import stage, logger
+from graph_reweighting.perplexity_cache import expand_cached_perplexities
+from graph_reweighting.diagnostics import Diagnostics, group_moments, merge_moments, empty_moments
 
 """
 Loading perplexities
@@ -25,20 +31,178 @@ def get_perplexity_from_json(path_to_json):
     return result_perplexity
 
 
-def get_perplexity_from_multiple_files(file_dir):
+# key 'ppl' followed by a JSON number, token dicts only have the keys 'token' and 'prob'
+PPL_PATTERN = re.compile(rb'"ppl"\s*:\s*(-?(?:[0-9]+(?:\.[0-9]*)?(?:[eE][-+]?[0-9]+)?|Infinity|NaN))')
+PPL_MAX_MATCH_LEN = 256
+
+
+def get_perplexity_array_from_json(path_to_json, block_size=1 << 24):
     """
-    Reads BERT_LM sentence perplexities from multiple files, e.g. for chunked data.
-    Expects subfolders in file_dir, containing a 'test_results.json'.
-    get_perplexity_from_multiple_files('BERT_LM_results/')
+    Reads the sentence perplexity outputs from the BERT_LM like get_perplexity_from_json, but scans the file
+    in blocks of block_size bytes for the 'ppl' values instead of parsing the token-level probabilities.
+    Returns a float64 NumPy array.
     """
+    result_perplexity = []
+    with open(path_to_json, 'rb') as json_file:
+        buffer = b''
+        while True:
+            block = json_file.read(block_size)
+            buffer += block
+            # a match starting in the last PPL_MAX_MATCH_LEN bytes might be cut, keep it for the next block
+            limit = len(buffer) if not block else max(len(buffer) - PPL_MAX_MATCH_LEN, 0)
+            end = 0
+            for match in PPL_PATTERN.finditer(buffer, 0, len(buffer)):
+                if match.start() >= limit:
+                    break
+                result_perplexity.append(float(match.group(1)))
+                end = match.end()
+            if not block:
+                break
+            buffer = buffer[max(end, limit):]
+    logger.debug('%s: %d perplexities', path_to_json, len(result_perplexity))
+    return np.array(result_perplexity, dtype=np.float64)
+
+
+def _read_perplexity_chunk(path_to_json):
+    """Worker for load_perplexity_chunks: perplexities of one chunk and whether its json is complete"""
+    if not os.path.isfile(path_to_json):
+        return None, False
+    perplexity = get_perplexity_array_from_json(path_to_json)
+    with open(path_to_json, 'rb') as json_file:
+        json_file.seek(max(os.path.getsize(path_to_json) - PPL_MAX_MATCH_LEN, 0))
+        complete = json_file.read().rstrip().endswith(b']')
+    return perplexity, complete
+
+
+def list_perplexity_chunks(file_dir):
+    """Natsorted chunk subfolders of file_dir, i.e. the order the chunks are concatenated in"""
     list_subfolder = [dir_name for dir_name in os.listdir(file_dir)
                       if os.path.isdir(os.path.join(file_dir, dir_name))]
-    sorted_list = natsorted(list_subfolder, alg=ns.IGNORECASE)
-    result_list = []
+    return natsorted(list_subfolder, alg=ns.IGNORECASE)
+
+
+def _missing_chunk_errors(sorted_list):
+    """Gaps in the chunk numbers of the natsorted chunk subfolders"""
+    chunk_numbers = [re.findall(r'\d+', fold) for fold in sorted_list]
+    if sorted_list and all(chunk_numbers):
+        numbers = [int(num[-1]) for num in chunk_numbers]
+        missing = sorted(set(range(numbers[0], numbers[-1] + 1)) - set(numbers))
+        if missing:
+            return ['missing chunk numbers {}'.format(missing)]
+    return []
+
+
+def _chunk_errors(fold, perplexity, complete, expected_counts):
+    """Problems of one chunk read by _read_perplexity_chunk"""
+    if perplexity is None:
+        return ['{}: no test_results.json'.format(fold)]
+    errors = []
+    if not complete:
+        errors.append('{}: test_results.json is truncated after {} sentences'.format(fold, len(perplexity)))
+    if expected_counts is not None and expected_counts.get(fold) != len(perplexity):
+        errors.append('{}: expected {} sentences, got {}'.format(fold, expected_counts.get(fold), len(perplexity)))
+    return errors
+
+
+def _chunk_line_up_error(file_dir, errors):
+    return ValueError('Perplexity chunks in {} do not line up with the sentences: {}'.format(
+        file_dir, '; '.join(errors)))
+
+
+def load_perplexity_chunks(file_dir, processes=None, expected_counts=None):
+    """
+    Reads the 'test_results.json' of all chunk subfolders of file_dir in a process pool.
+    Returns the perplexities of all chunks in natsort order as one float64 array and the list of (subfolder, count).
+    Raises a ValueError before anything is returned if a chunk is missing, truncated, or its count differs from
+    expected_counts (dict subfolder -> number of sentences, e.g. the sentence counts of the chunk files).
+    perplex, counts = load_perplexity_chunks('BERT_LM_results/', processes=8)
+    """
+    sorted_list = list_perplexity_chunks(file_dir)
+    paths = [os.path.join(file_dir, fold, 'test_results.json') for fold in sorted_list]
+    if processes is None:
+        processes = os.cpu_count()
+    processes = max(min(processes, len(paths)), 1)
+    if processes == 1:
+        chunks = [_read_perplexity_chunk(path) for path in paths]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            chunks = pool.map(_read_perplexity_chunk, paths, chunksize=1)
+
+    errors = _missing_chunk_errors(sorted_list)
+    counts = []
+    for fold, (perplexity, complete) in zip(sorted_list, chunks):
+        errors += _chunk_errors(fold, perplexity, complete, expected_counts)
+        if perplexity is not None:
+            counts.append((fold, len(perplexity)))
+    if expected_counts is not None:
+        for fold in set(expected_counts) - set(sorted_list):
+            errors.append('{}: no results folder'.format(fold))
+    if errors:
+        raise _chunk_line_up_error(file_dir, errors)
+
+    result = np.empty(sum(count for _, count in counts), dtype=np.float64)
+    pos = 0
+    for perplexity, _ in chunks:
+        result[pos:pos + len(perplexity)] = perplexity
+        pos += len(perplexity)
+    return result, counts
+
+
+def iter_perplexity_chunks(file_dir, manifest_path=None):
+    """
+    Streaming get_perplexity_from_multiple_files: yields the perplexities of one chunk subfolder at a time,
+    in natsort order, with the same checks as load_perplexity_chunks (raised when the chunk is reached).
+    for perplex in iter_perplexity_chunks('BERT_LM_results/'):
+    """
+    if manifest_path is None and os.path.isfile(os.path.join(file_dir, 'manifest.json')):
+        manifest_path = os.path.join(file_dir, 'manifest.json')
+    expected_counts = load_manifest_counts(manifest_path) if manifest_path else None
+    sorted_list = list_perplexity_chunks(file_dir)
+    errors = _missing_chunk_errors(sorted_list)
+    if expected_counts is not None:
+        errors += ['{}: no results folder'.format(fold) for fold in set(expected_counts) - set(sorted_list)]
+    if errors:
+        raise _chunk_line_up_error(file_dir, errors)
     for fold in sorted_list:
-        path_templ = os.path.join(file_dir, fold, 'test_results.json')
-        result_list += get_perplexity_from_json(path_templ)
-    return result_list
+        perplexity, complete = _read_perplexity_chunk(os.path.join(file_dir, fold, 'test_results.json'))
+        errors = _chunk_errors(fold, perplexity, complete, expected_counts)
+        if errors:
+            raise _chunk_line_up_error(file_dir, errors)
+        yield perplexity
+
+
+def load_manifest_counts(manifest_path):
+    """Number of sentences per chunk subfolder from a manifest.json written by prepare_lm_chunks"""
+    with open(manifest_path) as manifest_file:
+        return {chunk['name']: chunk['sentences'] for chunk in json.load(manifest_file)['chunks']}
+
+
+def get_perplexity_from_multiple_files(file_dir, streaming=True, processes=None, manifest_path=None):
+    """
+    Reads BERT_LM sentence perplexities from multiple files, e.g. for chunked data.
+    Expects subfolders in file_dir, containing a 'test_results.json'.
+    With streaming, reads them in parallel with load_perplexity_chunks and returns a NumPy array,
+    otherwise one after another with json.load into a list.
+    The sentence counts are checked against manifest_path, or file_dir/manifest.json if it exists.
+    get_perplexity_from_multiple_files('BERT_LM_results/')
+    """
+    if manifest_path is None and os.path.isfile(os.path.join(file_dir, 'manifest.json')):
+        manifest_path = os.path.join(file_dir, 'manifest.json')
+    expected_counts = load_manifest_counts(manifest_path) if manifest_path else None
+    with stage('load_perplexities', path=file_dir) as record:
+        if streaming:
+            result = load_perplexity_chunks(file_dir, processes=processes, expected_counts=expected_counts)[0]
+        else:
+            result = []
+            for fold in list_perplexity_chunks(file_dir):
+                path_templ = os.path.join(file_dir, fold, 'test_results.json')
+                result += get_perplexity_from_json(path_templ)
+            if expected_counts is not None and len(result) != sum(expected_counts.values()):
+                raise ValueError('Got {} perplexities for {} sentences in {}'.format(len(result),
+                                                                                    sum(expected_counts.values()),
+                                                                                    manifest_path))
+        record['rows'] = len(result)
+    return result
 
 
 """
@@ -46,36 +210,316 @@ Transforming perplexities to scores
 """
 
 
-def partial_scale(val, max):
-    """Scales all inputs val that are above 1 to [1,50], used in reweight"""
-    if val > 1:
-        val -= 1
-        val = val / (max - 1)
-        val = val * 49
-        val += 1
-    return val
+SKETCH_RANGE = (-1.0, 9.0)  # log10 perplexity range of the histogram sketches, values outside go to the edge bins
+SKETCH_BINS = 2000
 
 
-def reweight(ppl):
-    scale_good = np.vectorize(partial_scale)
+class LogPerplexitySketch:
+    """
+    Memory-bounded sketch of the log10 perplexities per group (e.g. relation): a fixed-bin histogram
+    plus the exact count, minimum and maximum of each group. The histograms are stored sparsely, only the non-empty
+    (group, bin) pairs, so a group takes memory for at most min(its values, bins) bins: many small groups
+    (like the compound sources of ConceptNet) stay cheap, however many edges there are.
+    Quantiles and the CDF are interpolated linearly within a bin, so they are exact up to the bin width.
+    """
+
+    def __init__(self, bins=SKETCH_BINS, value_range=SKETCH_RANGE):
+        self.bins = bins
+        self.low, self.high = value_range
+        self.width = (self.high - self.low) / bins
+        self.labels = pd.Index([], dtype=object)
+        self.keys = np.empty(0, dtype=np.int64)  # sorted group row * bins + bin of the non-empty bins
+        self.counts = np.empty(0, dtype=np.int64)  # number of values in each of them
+        self.min = np.empty(0)
+        self.max = np.empty(0)
+        self._prefix = None
+
+    def _bin(self, log_ppl):
+        return np.clip(((log_ppl - self.low) / self.width).astype(np.int64), 0, self.bins - 1)
+
+    def update(self, log_ppl, groups):
+        """Adds valid (non-NaN) log_ppl with their group labels, values without group (None, NaN) are skipped"""
+        codes, uniques = pd.factorize(np.asarray(groups, dtype=object))
+        if np.any(codes < 0):
+            log_ppl, codes = log_ppl[codes >= 0], codes[codes >= 0]
+        new_labels = pd.Index(uniques, dtype=object).difference(self.labels, sort=False)
+        if len(new_labels):
+            self.labels = self.labels.append(new_labels)
+            self.min = np.r_[self.min, np.full(len(new_labels), np.inf)]
+            self.max = np.r_[self.max, np.full(len(new_labels), -np.inf)]
+        rows = self.labels.get_indexer(uniques)[codes]
+        keys, counts = np.unique(rows * self.bins + self._bin(log_ppl), return_counts=True)
+        self.keys, positions = np.unique(np.r_[self.keys, keys], return_inverse=True)
+        self.counts = np.bincount(positions, weights=np.r_[self.counts, counts],
+                                  minlength=len(self.keys)).astype(np.int64)
+        self._prefix = None
+        np.minimum.at(self.min, rows, log_ppl)
+        np.maximum.at(self.max, rows, log_ppl)
+
+    def _rows(self, groups):
+        return self.labels.get_indexer(np.asarray(groups, dtype=object))
+
+    def _cumulative(self):
+        """Number of values in the non-empty bins before each key (and in all of them at the end)"""
+        if self._prefix is None:
+            self._prefix = np.r_[0, self.counts.cumsum()]
+        return self._prefix
+
+    def cdf(self, log_ppl, groups):
+        """Share of each group's values below log_ppl, NaN for unknown groups"""
+        rows = self._rows(groups)
+        if not len(self.labels):
+            return np.full(len(rows), np.nan)
+        prefix = self._cumulative()
+        known_rows = np.maximum(rows, 0)
+        first = np.searchsorted(self.keys, known_rows * self.bins)
+        last = np.searchsorted(self.keys, (known_rows + 1) * self.bins)
+        bins = self._bin(log_ppl)
+        keys = known_rows * self.bins + bins
+        pos = np.searchsorted(self.keys, keys)
+        in_bin = np.where(self.keys[np.minimum(pos, len(self.keys) - 1)] == keys,
+                          self.counts[np.minimum(pos, len(self.keys) - 1)], 0)
+        within = np.clip((log_ppl - self.low) / self.width - bins, 0, 1)
+        with np.errstate(invalid='ignore'):
+            below = prefix[pos] - prefix[first] + in_bin * within
+            result = below / (prefix[last] - prefix[first])
+        return np.where((rows < 0) | np.isnan(log_ppl), np.nan, result)
+
+    def quantiles(self, q):
+        """Approximate q-quantile of each group, as pd.Series indexed by the group labels"""
+        prefix = self._cumulative()
+        group_rows = np.arange(len(self.labels))
+        first = np.searchsorted(self.keys, group_rows * self.bins)
+        last = np.searchsorted(self.keys, (group_rows + 1) * self.bins)
+        target = q * (prefix[last] - prefix[first])
+        # the non-empty bin where the cumulated count of the group reaches target
+        pos = np.clip(np.searchsorted(prefix, prefix[first] + target, side='left') - 1, first, np.maximum(last - 1, 0))
+        if len(self.keys):
+            bins = self.keys[pos] - group_rows * self.bins
+            with np.errstate(divide='ignore', invalid='ignore'):
+                within = (prefix[first] + target - prefix[pos]) / self.counts[pos]
+        else:
+            bins = within = np.zeros(len(group_rows))
+        bins = np.where(target > 0, bins, 0)
+        within = np.where(target > 0, within, 0.0)
+        result = self.low + (bins + within) * self.width
+        return pd.Series(np.clip(result, self.min, self.max), index=self.labels)
+
+    def total(self):
+        """Sketch of all groups together, as a single group None"""
+        merged = LogPerplexitySketch(self.bins, (self.low, self.high))
+        merged.labels = pd.Index([None], dtype=object)
+        bin_counts = np.bincount(self.keys % self.bins, weights=self.counts, minlength=self.bins).astype(np.int64)
+        merged.keys = np.flatnonzero(bin_counts)
+        merged.counts = bin_counts[merged.keys]
+        merged.min = np.array([self.min.min() if len(self.min) else np.inf])
+        merged.max = np.array([self.max.max() if len(self.max) else -np.inf])
+        return merged
+
+
+class ScoreStatistics:
+    """
+    Global statistics of the log10 perplexities that score functions need, collected chunk by chunk with update()
+    in a first pass, so every chunk can then be scored on its own. NaN perplexities are skipped.
+    keep_values: keeps all values, sorted by finish(), for percentiles
+    by_relation: count, mean and sum of squared deviations (m2) per relation (or other group, see group_by of
+    register_score_function), merged chunk by chunk (see diagnostics.group_moments)
+    group_sketch: LogPerplexitySketch per relation (or other group), for quantiles with bounded memory
+    """
+
+    def __init__(self, keep_values=False, by_relation=False, group_sketch=False):
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.keep_values = keep_values
+        self.values = [] if keep_values else None
+        self.relations = empty_moments() if by_relation else None
+        self.sketch = LogPerplexitySketch() if group_sketch else None
 
-    # Transform perplexities
-    ppl = np.log10(ppl)  # log scale against outliers
-    max = ppl.max()  # save maximum for keeping cutoff point
-    ppl = ppl * -1 + max  # negate and move to [0, ..]
-    # (max -2) was x=2 in uninverted log-scale --> equals perplexity of 100
-    ppl = ppl / (max - 2)  # rescale so values higher than 100 perplexity are in [0,1]
+    def update(self, perplex, relations=None):
+        log_ppl = np.log10(np.asarray(perplex, dtype=np.float64))
+        valid = ~np.isnan(log_ppl)
+        log_ppl = log_ppl[valid]
+        if not len(log_ppl):
+            return
+        self.count += len(log_ppl)
+        self.min = min(self.min, log_ppl.min())
+        self.max = max(self.max, log_ppl.max())
+        if self.keep_values:
+            self.values.append(log_ppl)
+        if self.relations is not None:
+            self.relations = merge_moments(self.relations,
+                                           group_moments(log_ppl, np.asarray(relations, dtype=object)[valid]))
+        if self.sketch is not None:
+            self.sketch.update(log_ppl, np.asarray(relations, dtype=object)[valid])
 
-    scale_max = ppl.max()
-    print()
-    ppl = scale_good(ppl, scale_max)
-    return ppl
+    def finish(self):
+        if self.keep_values:
+            self.values = np.sort(np.concatenate(self.values)) if len(self.values) else np.empty(0)
+        return self
+
+
+def reweight_scores(perplex, stats, relations=None):
+    """
+    Log scale against outliers, negated and rescaled so that perplexity 100 is at 1,
+    values above 1 (better sentences) are scaled to [1, 50] with the global maximum as 50.
+    """
+    log_ppl = np.log10(np.asarray(perplex, dtype=np.float64))
+    if not stats.count:
+        return log_ppl
+    top = stats.max  # maximum for keeping cutoff point
+    # (top - 2) was x=2 in uninverted log-scale --> equals perplexity of 100
+    scaled = (log_ppl * -1 + top) / (top - 2)
+    # the scaled values are monotonic in log_ppl, so their maximum is at one of the extrema
+    scale_max = max((stats.min * -1 + top) / (top - 2), (top * -1 + top) / (top - 2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(scaled > 1, (scaled - 1) / (scale_max - 1) * 49 + 1, scaled)
+
+
+def reweight_light_scores(perplex, stats=None, relations=None, scale_factor=50):
+    """Inverse perplexity times scale_factor"""
+    return (1 / np.asarray(perplex, dtype=np.float64)) * scale_factor
+
+
+def percentile_scores(perplex, stats, relations=None):
+    """Share of all sentences with a higher perplexity (ties count half), in [0, 1]"""
+    log_ppl = np.log10(np.asarray(perplex, dtype=np.float64))
+    below = np.searchsorted(stats.values, log_ppl, side='left') + np.searchsorted(stats.values, log_ppl, side='right')
+    with np.errstate(invalid='ignore'):
+        return np.where(np.isnan(log_ppl), np.nan, 1 - below / (2 * max(stats.count, 1)))
+
+
+def rank_scores(perplex, stats, relations=None):
+    """percentile_scores scaled to [1, 50], the range reweight gives its good sentences"""
+    return percentile_scores(perplex, stats) * 49 + 1
+
+
+def relation_zscore_scores(perplex, stats, relations):
+    """
+    Standard score of the negated log10 perplexity within the group of each edge, squashed to (0, 50)
+    by a logistic function, so every group gets the same score distribution.
+    Groups with a single sentence or without spread get 25.
+    """
+    log_ppl = np.log10(np.asarray(perplex, dtype=np.float64))
+    moments = stats.relations.reindex(np.asarray(relations, dtype=object))
+    std = np.sqrt(moments['m2'].to_numpy() / moments['count'].to_numpy())
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.where(std > 0, (moments['mean'].to_numpy() - log_ppl) / std, 0.0)
+    z = np.where(np.isnan(log_ppl) | np.isnan(std), np.nan, z)
+    return 50 / (1 + np.exp(-z))
+
+
+def group_quantile_scores(perplex, stats, relations):
+    """Share of the sentences of the same group with a higher perplexity, from the sketch, scaled to [1, 50]"""
+    log_ppl = np.log10(np.asarray(perplex, dtype=np.float64))
+    return (1 - stats.sketch.cdf(log_ppl, relations)) * 49 + 1
+
+
+def group_reweight_scores(perplex, stats, relations):
+    """
+    reweight within each group: the cutoff (perplexity 100 in reweight) is moved by how far the group's median
+    log perplexity lies from the median of all sentences, the maximum score 50 goes to the group's best sentence.
+    """
+    log_ppl = np.log10(np.asarray(perplex, dtype=np.float64))
+    sketch = stats.sketch
+    rows = sketch._rows(relations)
+    if not len(sketch.labels):
+        return np.full(len(rows), np.nan)
+    cutoff = 2 + sketch.quantiles(0.5).to_numpy() - sketch.total().quantiles(0.5).iloc[0]
+    top = sketch.max[rows]
+    cutoff = cutoff[rows]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scaled = (top - log_ppl) / (top - cutoff)
+        scale_max = (top - sketch.min[rows]) / (top - cutoff)
+        result = np.where(scaled > 1, (scaled - 1) / (scale_max - 1) * 49 + 1, scaled)
+    # groups where no sentence is below the cutoff keep their unscaled values
+    result = np.where(top > cutoff, result, scaled)
+    return np.where(rows < 0, np.nan, result)
+
+
+"""
+score_type -> score function(perplex, stats, relations) and the statistics it needs.
+Per-relation score types (by_relation, group_sketch) get the relation of each sentence as relations,
+or the graph column group_by names (GROUP_COLUMNS), e.g. the sources.
+Further score types can be added with register_score_function.
+"""
+GROUP_COLUMNS = {'relation': 4, 'sources': 3}
+SCORE_FUNCTIONS = {}
+
+
+def register_score_function(score_type, score, keep_values=False, by_relation=False, group_sketch=False,
+                            group_by='relation'):
+    if group_by not in GROUP_COLUMNS:
+        raise ValueError('group_by needs to be one of {}, but was: {}'.format(list(GROUP_COLUMNS), group_by))
+    SCORE_FUNCTIONS[score_type] = {'score': score, 'keep_values': keep_values, 'by_relation': by_relation,
+                                   'group_sketch': group_sketch, 'group_by': group_by}
+
+
+register_score_function('reweight', reweight_scores)
+register_score_function('reweight_light', reweight_light_scores)
+register_score_function('percentile', percentile_scores, keep_values=True)
+register_score_function('rank', rank_scores, keep_values=True)
+register_score_function('relation_zscore', relation_zscore_scores, by_relation=True)
+register_score_function('relation_reweight', group_reweight_scores, group_sketch=True)
+register_score_function('relation_quantile', group_quantile_scores, group_sketch=True)
+register_score_function('source_reweight', group_reweight_scores, group_by='sources', group_sketch=True)
+register_score_function('source_quantile', group_quantile_scores, group_by='sources', group_sketch=True)
+
+
+def get_score_function(score_type):
+    if score_type not in SCORE_FUNCTIONS:
+        raise ValueError(f"score_type needs to be one of {list(SCORE_FUNCTIONS)}, but was: {score_type}")
+    return SCORE_FUNCTIONS[score_type]
+
+
+def needs_relations(score_type):
+    """Whether score_type needs the relation (or the group_by column) of each sentence"""
+    score_function = get_score_function(score_type)
+    return score_function['by_relation'] or score_function['group_sketch']
+
+
+def score_group_column(score_type):
+    """Column number of the graph that holds the group of each edge for score_type, None if it needs no groups"""
+    return GROUP_COLUMNS[get_score_function(score_type)['group_by']] if needs_relations(score_type) else None
+
+
+def score_statistics(score_type, perplex_chunks, relation_chunks=None):
+    """
+    First pass for chunked input: the global statistics score_type needs, from an iterable of perplexity chunks
+    (and the relation, or group_by column, of each sentence for per-relation score types).
+    """
+    score_function = get_score_function(score_type)
+    stats = ScoreStatistics(keep_values=score_function['keep_values'],
+                            by_relation=score_function['by_relation'],
+                            group_sketch=score_function['group_sketch'])
+    if relation_chunks is None:
+        relation_chunks = itertools.repeat(None)
+    for perplex, relations in zip(perplex_chunks, relation_chunks):
+        stats.update(perplex, relations)
+    return stats.finish()
+
+
+def perplexities_to_scores(perplex, score_type, relations=None, stats=None):
+    """
+    Scores for perplex with the score function registered as score_type, see SCORE_FUNCTIONS.
+    relations: the relation of each sentence (or the group_by column, e.g. sources), for per-relation score types
+    stats from score_statistics when perplex is one chunk of the data, otherwise they are computed from perplex.
+    perplexities_to_scores(perplex, score_type='reweight')
+    """
+    score_function = get_score_function(score_type)
+    if needs_relations(score_type) and relations is None:
+        raise ValueError('score_type {} needs the {} of each sentence'.format(score_type, score_function['group_by']))
+    if stats is None:
+        stats = score_statistics(score_type, [perplex], [relations])
+    return score_function['score'](perplex, stats, relations)
+
+
+def reweight(ppl):
+    return perplexities_to_scores(ppl, 'reweight')
 
 
 def reweight_light(perplex_series, scale_factor):
-    ppt = perplex_series
-    ppt = (1 / ppt) * scale_factor
-    return ppt
+    return reweight_light_scores(perplex_series, scale_factor=scale_factor)
 
 
 """
@@ -83,54 +527,68 @@ Map scores back to the edges of the KG
 """
 
 
-def apply_reweight(sentence_csv_path, graph_path, perplexity_file_dir, out_file, score_type):
+def check_sentence_alignment(sentence_rows, sentence_idx, num_perplexities, num_edges):
+    """
+    Checks that the sentence .csv rows are in the order they were sent to the LM and that every sentence
+    has one perplexity and maps to its own edge, raises a ValueError otherwise.
+    """
+    if len(sentence_idx) != num_perplexities:
+        raise ValueError('Got {} perplexities for {} sentences'.format(num_perplexities, len(sentence_idx)))
+    if not np.array_equal(np.asarray(sentence_rows), np.arange(len(sentence_idx))):
+        raise ValueError('Sentence rows are not numbered 0..{} in order'.format(len(sentence_idx) - 1))
+    if len(sentence_idx) and (sentence_idx.min() < 0 or sentence_idx.max() >= num_edges):
+        raise ValueError('Sentence indices need to be in [0, {}), the number of graph rows'.format(num_edges))
+    if len(np.unique(sentence_idx)) != len(sentence_idx):
+        raise ValueError('Sentence indices contain duplicate edges')
+
+
+def apply_reweight(sentence_csv_path, graph_path, perplexity_file_dir, out_file, score_type, cache_path=None,
+                   new_sentence_txt=None, diagnostics=None, diagnostics_dir=None):
     """
     Reads perplexity results from BERT_LM, applies a reweighting scheme and injects the resulting weights into the KG.
     sentence_csv_path generated in get_all_sentences
-    score_type: one of ['reweight', 'reweight_light']
+    graph_path: ConceptNet-format csv or graph store directory (see graph_store.tsv_to_graph_store)
+    score_type: one of SCORE_FUNCTIONS, e.g. 'reweight', 'reweight_light', 'percentile', 'rank', 'relation_zscore',
+    'relation_reweight', 'relation_quantile', 'source_reweight', 'source_quantile'
+    cache_path: perplexity cache (see perplexity_cache.export_uncached_sentences), then the BERT_LM results
+    only cover the sentences in new_sentence_txt
+    diagnostics: histograms and per-relation statistics of perplexities and weights, written to diagnostics_dir
+    (default: next to out_file), see diagnostics.Diagnostics. Off unless diagnostics=True or diagnostics_dir is given
     apply_reweight(sentence_csv_path='cn_sentences.csv', graph_path='conceptnet.csv', perplexity_file_dir='BERT_LM_results/', out_file='cn_reweight.csv', score_type='reweight')
     """
     # Load inputs
     sentence_df = load_df(sentence_csv_path, index=0)
-    sentence_idx = sentence_df['0'].tolist()  # only need the indices, not the entire sentences
+    sentence_idx = sentence_df['0'].to_numpy()  # only need the indices, not the entire sentences
     perplex = get_perplexity_from_multiple_files(perplexity_file_dir)
-    ppt_series = pd.Series(perplex)
-    plot_hist(ppt_series, log_scale=True)
-    # Load data as dict to increase writing speed
-    graph_file = open(graph_path)
-    data_dict = {}
-    print('Loading data...')
-    for i, line in enumerate(graph_file):
-        line = line.rstrip()
-        data_dict[i] = line.split('\t')
-    print('Done.')
+    if cache_path:
+        perplex = expand_cached_perplexities(sentence_df['1'], cache_path, new_sentence_txt, perplex)
+    with stage('load_graph', path=graph_path) as record:
+        from_store = is_graph_store(graph_path)
+        graph_df = load_graph_store(graph_path) if from_store else load_graph_text(graph_path)
+        record['rows'] = len(graph_df)
+    check_sentence_alignment(sentence_df.index, sentence_idx, len(perplex), len(graph_df))
 
     # Convert perplexities to scores
-    if score_type == 'reweight':
-        ppt_series = reweight(ppt_series)
-    elif score_type == 'reweight_light':
-        ppt_series = reweight_light(ppt_series, scale_factor=50)
-    else:
-        raise ValueError(f"score_type needs to be one of ['reweight', 'reweight_light'], but was: {score_type}")
-    plot_hist(ppt_series, log_scale=True)  # result for comparison
+    with stage('scores', score_type=score_type, rows=len(perplex)):
+        relations = None
+        if needs_relations(score_type):
+            relations = graph_df[graph_df.columns[score_group_column(score_type)]].to_numpy()[sentence_idx]
+        weights = perplexities_to_scores(perplex, score_type, relations=relations)
+    if diagnostics or (diagnostics is None and diagnostics_dir is not None):
+        with stage('diagnostics', rows=len(perplex)):
+            report = Diagnostics()
+            relations = graph_df[graph_df.columns[4]].to_numpy()[sentence_idx]
+            report.add('perplexity', perplex, groups=relations, log=True)
+            report.add('weight', weights, groups=relations)  # result for comparison
+            report.write(diagnostics_dir or os.path.splitext(out_file)[0] + '_diagnostics')
 
     # Inject new weights into the KG
-    weights = ppt_series.tolist()
-    print('Starting injections...')
-    injections_num = 0  # checksum
-    for idx in tqdm.tqdm(range(len(sentence_idx))):
-        injection = data_dict[sentence_idx[idx]]  # row for replacing
-        injection[2] = weights[idx]  # replace weight in column 2
-        data_dict[sentence_idx[idx]] = injection
-        injections_num += 1
-    print(injections_num)
-    keys = list(data_dict.keys())
-    keys.sort()
-    results = []
-    for i in tqdm.tqdm(range(len(keys))):
-        results.append(data_dict[keys[i]])
-    result_df = pd.DataFrame.from_dict(results)
-    result_df.to_csv(out_file, sep='\t', index=False, header=False)
+    with stage('inject', path=out_file, rows=len(graph_df)):
+        score_col = graph_df.columns[2]
+        scores = graph_df[score_col].to_numpy(dtype=np.float64 if from_store else object, copy=True)
+        scores[sentence_idx] = np.asarray(weights, dtype=np.float64)
+        graph_df[score_col] = scores
+        graph_df.to_csv(out_file, sep='\t', index=False, header=False)
 
 
 if __name__ == '__main__':
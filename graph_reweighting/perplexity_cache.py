@@ -0,0 +1,196 @@
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from sentence_construction.graph_to_sentence import split_long_words_in_sentences
+from util import load_df
+from instrumentation import stage
+
+"""
+Persistent perplexity cache
+
+Maps the normalized sentence text (as sent to the LM) to its perplexity, so identical sentences of different edges
+and of re-runs only go through the LM once. Workflow:
+-export_uncached_sentences: writes the distinct sentences that are not cached yet for the LM, and pins the
+ perplexities of the cached ones next to them, so evictions before the expansion do not lose them
+-apply_reweight(..., cache_path=...): puts the new LM results into the cache and expands cached and new
+ perplexities back onto every sentence (edge)
+"""
+
+
+class PerplexityCache:
+    """
+    sqlite backed sentence -> perplexity cache, bounded to max_entries sentences by evicting the least recently used.
+    max_word_len is fixed when the cache is created: sentences are normalized by splitting longer words
+    (like split_long_words) before lookups.
+    """
+
+    def __init__(self, path, max_entries=None, max_word_len=None):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS perplexities (sentence TEXT PRIMARY KEY, ppl REAL NOT NULL,
+                                                     last_used INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS perplexities_last_used ON perplexities (last_used);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+            ''')
+        self.connection.execute("INSERT OR IGNORE INTO meta VALUES ('max_word_len', ?)", (max_word_len,))
+        self.connection.execute("INSERT OR IGNORE INTO meta VALUES ('generation', 0)")
+        self.connection.commit()
+        self.max_word_len = self._get_meta('max_word_len')
+        if max_word_len is not None and max_word_len != self.max_word_len:
+            raise ValueError('Cache {} normalizes with max_word_len={}, not {}'.format(path, self.max_word_len,
+                                                                                       max_word_len))
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get_meta(self, key):
+        return self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()[0]
+
+    def _next_generation(self):
+        generation = self._get_meta('generation') + 1
+        self.connection.execute("UPDATE meta SET value = ? WHERE key = 'generation'", (generation,))
+        return generation
+
+    def normalize(self, sentences):
+        """Normalized cache keys for a Series of sentences, empty sentences (NaN when read by load_df) are ''"""
+        sentences = sentences.fillna('').astype(str).str.strip()
+        if self.max_word_len:
+            sentences = split_long_words_in_sentences(sentences, self.max_word_len)
+        return sentences
+
+    def get_many(self, sentences):
+        """Perplexities of normalized, distinct sentences as float array, NaN where not cached (see put_many)"""
+        result = np.full(len(sentences), np.nan)
+        with self.connection:
+            self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS lookup (pos INTEGER, sentence TEXT)')
+            self.connection.execute('DELETE FROM lookup')
+            self.connection.executemany('INSERT INTO lookup VALUES (?, ?)', enumerate(sentences))
+            found = self.connection.execute(
+                'SELECT lookup.pos, perplexities.ppl FROM lookup JOIN perplexities USING (sentence)').fetchall()
+            self.connection.execute('UPDATE perplexities SET last_used = ? WHERE sentence IN '
+                                    '(SELECT sentence FROM lookup)', (self._next_generation(),))
+            self.connection.execute('DELETE FROM lookup')
+        if found:
+            pos, ppl = zip(*found)
+            result[list(pos)] = ppl
+        self.hits += len(found)
+        self.misses += len(sentences) - len(found)
+        return result
+
+    def put_many(self, sentences, perplexities):
+        """
+        Adds normalized sentences with their perplexities, then evicts down to max_entries.
+        NaN perplexities (sentences without tokens, see lm_scoring.score_sentences) are not stored, so a NaN
+        from get_many always means not cached. Such sentences are exported to the LM again on the next run.
+        """
+        with self.connection:
+            generation = self._next_generation()
+            self.connection.executemany('INSERT OR REPLACE INTO perplexities VALUES (?, ?, ?)',
+                                        ((s, float(p), generation) for s, p in zip(sentences, perplexities)
+                                         if not np.isnan(p)))
+            if self.max_entries is not None:
+                excess = len(self) - self.max_entries
+                if excess > 0:
+                    self.connection.execute('DELETE FROM perplexities WHERE sentence IN (SELECT sentence FROM '
+                                            'perplexities ORDER BY last_used LIMIT ?)', (excess,))
+                    self.evictions += excess
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM perplexities').fetchone()[0]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def close(self):
+        self.connection.close()
+
+
+def load_sentences(sentence_csv_path):
+    """Sentences of a sentence .csv written by get_all_sentences, in row order"""
+    return load_df(sentence_csv_path, index=0)['1']
+
+
+def pinned_perplexities_path(new_sentence_txt):
+    """Where export_uncached_sentences pins the perplexities of the cache hits: '<out_txt without ext>_cached.tsv'"""
+    return os.path.splitext(new_sentence_txt)[0] + '_cached.tsv'
+
+
+def load_pinned_perplexities(new_sentence_txt):
+    """The perplexities pinned for new_sentence_txt as Series indexed by sentence, empty if there are none"""
+    path = pinned_perplexities_path(new_sentence_txt)
+    if not os.path.isfile(path):
+        return pd.Series(dtype=np.float64)
+    pinned = pd.read_csv(path, sep='\t', dtype={'sentence': object, 'ppl': np.float64}, na_filter=False)
+    return pd.Series(pinned['ppl'].to_numpy(), index=pinned['sentence'].to_numpy())
+
+
+def export_uncached_sentences(sentence_csv_path, cache_path, out_txt, max_entries=None, max_word_len=None):
+    """
+    Writes the distinct normalized sentences of sentence_csv_path that are not in the cache to out_txt,
+    the input for the LM. The perplexities of the cached ones are pinned to pinned_perplexities_path(out_txt),
+    so expand_cached_perplexities finds them even if they are evicted in between. Returns the cache statistics,
+    which are also logged with the 'export_uncached' stage record.
+    export_uncached_sentences(sentence_csv_path='cn_sentences.csv', cache_path='ppl_cache.sqlite',
+                              out_txt='cn_sentences_uncached.txt', max_word_len=43)
+    """
+    with stage('export_uncached', path=out_txt) as record:
+        cache = PerplexityCache(cache_path, max_entries=max_entries, max_word_len=max_word_len)
+        distinct = pd.Series(pd.unique(cache.normalize(load_sentences(sentence_csv_path))), dtype=object)
+        cached = cache.get_many(distinct)
+        with open(out_txt, 'w+') as text_file:
+            text_file.writelines(sentence + '\n' for sentence in distinct[np.isnan(cached)])
+        hits = ~np.isnan(cached)
+        pd.DataFrame({'sentence': distinct[hits].to_numpy(), 'ppl': cached[hits]}).to_csv(
+            pinned_perplexities_path(out_txt), sep='\t', index=False)
+        stats = cache.stats()
+        cache.close()
+        record.update(stats)
+        record['rows'] = len(distinct)
+    return stats
+
+
+def _fill_missing(distinct_ppl, missing, distinct, perplexities):
+    """Fills distinct_ppl where missing from perplexities (Series sentence -> ppl) and clears missing there"""
+    positions = perplexities.index.get_indexer(distinct[missing])
+    found = np.flatnonzero(missing)[positions >= 0]
+    distinct_ppl[found] = perplexities.to_numpy()[positions[positions >= 0]]
+    missing[found] = False
+
+
+def expand_cached_perplexities(sentences, cache_path, new_sentence_txt, new_perplexities, max_entries=None):
+    """
+    Perplexity for each of sentences (one per edge) from the cache or, for the sentences exported to new_sentence_txt,
+    from new_perplexities (the LM results in the order of new_sentence_txt), which are added to the cache.
+    Sentences evicted from the cache since the export come from the perplexities pinned by the export.
+    The cache statistics are logged with the 'expand_cached' stage record.
+    """
+    with stage('expand_cached', path=new_sentence_txt) as record:
+        cache = PerplexityCache(cache_path, max_entries=max_entries)
+        with open(new_sentence_txt) as text_file:
+            new_sentences = pd.Series([line.rstrip('\n') for line in text_file], dtype=object)
+        if len(new_sentences) != len(new_perplexities):
+            raise ValueError('Got {} perplexities for {} new sentences'.format(len(new_perplexities),
+                                                                            len(new_sentences)))
+
+        codes, distinct = pd.factorize(cache.normalize(sentences))
+        distinct_ppl = cache.get_many(pd.Series(distinct, dtype=object))
+        # misses are tracked with a mask, NaN is also a valid LM result (a sentence without tokens)
+        missing = np.isnan(distinct_ppl)
+        new_ppl = pd.Series(np.asarray(new_perplexities, dtype=np.float64), index=new_sentences)
+        new_ppl = new_ppl[~new_ppl.index.duplicated(keep='last')]
+        _fill_missing(distinct_ppl, missing, distinct, new_ppl)
+        if missing.any():
+            _fill_missing(distinct_ppl, missing, distinct, load_pinned_perplexities(new_sentence_txt))
+        if missing.any():
+            raise ValueError('{} sentences are neither cached nor in {}'.format(missing.sum(), new_sentence_txt))
+        cache.put_many(new_ppl.index, new_ppl.to_numpy())
+        stats = cache.stats()
+        cache.close()
+        record.update(stats)
+        record['rows'] = len(sentences)
+    return distinct_ppl[codes]
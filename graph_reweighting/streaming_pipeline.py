@@ -0,0 +1,209 @@
+import os
+import csv
+import itertools
+import numpy as np
+import pandas as pd
+
+from graph_reweighting.perplexities_to_scores import iter_perplexity_chunks, perplexities_to_scores, \
+    needs_relations, score_group_column, get_score_function, ScoreStatistics
+from graph_reweighting.diagnostics import Diagnostics
+from sentence_construction.graph_to_sentence import relations_to_sentences, write_missed_relations, \
+    concept_vocabulary
+from util import load_df, get_en_idx
+from instrumentation import stage
+
+"""
+Streaming REWEIGHT runner
+
+Same stages and outputs as get_all_sentences and apply_reweight, but the graph is only ever held
+chunksize rows at a time. The sentence index and the perplexities are read in step with the graph chunks
+(all three are in graph order), so memory does not grow with the graph, except for score types that keep all values
+(percentile, rank), which hold one float per sentence.
+"""
+
+
+def stream_sentences(graph_path, out_txt, out_csv, columns, chunksize=1000000, missed_path=None):
+    """
+    Reads the ConceptNet-format graph in chunks and writes the same sentence .txt, index .csv and missed relations
+    as get_all_sentences on all English edges. The concepts are interned in one vocabulary for all chunks,
+    which is freed when the call returns.
+    stream_sentences(graph_path='conceptnet.csv', out_txt='cn_sentences.txt', out_csv='cn_sentences.csv',
+                     columns=['word1', 'word2', 'score', 'sources', 'relation'])
+    """
+    missed = pd.Series(dtype='int64')
+    s_count = 0
+    concepts = concept_vocabulary()
+    with stage('sentences', path=out_txt) as record, open(out_txt, 'w+') as text_file, \
+            open(out_csv, 'w+') as csv_file:
+        for i, chunk in enumerate(load_df(graph_path, columns=columns, chunksize=chunksize)):
+            sentences, chunk_missed = relations_to_sentences(chunk.loc[get_en_idx(chunk),
+                                                                       ['word1', 'word2', 'relation']],
+                                                            concepts=concepts)
+            missed = missed.add(chunk_missed, fill_value=0)
+            text_file.writelines(sentence + '\n' for sentence in sentences)
+            sent_df = pd.DataFrame({0: sentences.index.to_numpy(), 1: sentences.to_numpy()},
+                                   index=pd.RangeIndex(s_count, s_count + len(sentences)))
+            sent_df.to_csv(csv_file, sep='\t', header=i == 0)
+            s_count += len(sentences)
+        record['rows'] = s_count
+    if missed_path is None:
+        missed_path = os.path.join(os.path.dirname(out_txt), 'missed_relation_types.txt')
+    write_missed_relations(missed.astype('int64').sort_values(ascending=False), missed_path)
+    return s_count
+
+
+def iter_sentence_index(sentence_csv_path, chunksize=1000000):
+    """
+    Reads only the graph row indices from a sentence .csv written by get_all_sentences, chunksize rows at a time.
+    Raises a ValueError if the sentence rows are not numbered in order or the graph rows are not increasing,
+    streaming needs the sentences in graph order (as get_all_sentences and stream_sentences write them).
+    """
+    count = 0
+    last = -1
+    for chunk in pd.read_csv(sentence_csv_path, sep='\t', usecols=[0, 1], chunksize=chunksize):
+        rows_idx = chunk.to_numpy(dtype=np.int64)
+        if not np.array_equal(rows_idx[:, 0], np.arange(count, count + len(rows_idx))):
+            raise ValueError('Sentence rows are not numbered 0, 1, ... in order after row {}'.format(count))
+        idx = rows_idx[:, 1]
+        if len(idx) and (idx[0] <= last or np.any(np.diff(idx) <= 0)):
+            raise ValueError('Sentence indices need to be non-negative and increasing (graph order), '
+                             'see sentence rows {} to {}'.format(count, count + len(idx) - 1))
+        count += len(idx)
+        last = idx[-1] if len(idx) else last
+        yield idx
+
+
+def iter_sentences(sentence_csv_path, perplexity_file_dir, chunksize=1000000):
+    """
+    Graph row indices and perplexities of the sentences in blocks of up to chunksize, read in step.
+    Raises a ValueError if there is not exactly one perplexity per sentence.
+    """
+    perplex_chunks = iter_perplexity_chunks(perplexity_file_dir)
+    perplex = np.empty(0, dtype=np.float64)
+    n_sentences = n_perplexities = 0
+    for idx in iter_sentence_index(sentence_csv_path, chunksize):
+        n_sentences += len(idx)
+        while len(perplex) < len(idx):
+            chunk = next(perplex_chunks, None)
+            if chunk is None:
+                raise ValueError('Got {} perplexities for at least {} sentences'.format(n_perplexities, n_sentences))
+            n_perplexities += len(chunk)
+            perplex = np.concatenate([perplex, chunk])
+        yield idx, perplex[:len(idx)]
+        perplex = perplex[len(idx):]
+    n_perplexities += sum(len(chunk) for chunk in perplex_chunks)
+    if n_perplexities != n_sentences:
+        raise ValueError('Got {} perplexities for {} sentences'.format(n_perplexities, n_sentences))
+
+
+def iter_graph_chunks(graph_path, sentences, chunksize=1000000):
+    """
+    Reads the graph chunksize lines at a time, split into fields, together with the sentences of these lines.
+    sentences: iterable of (graph row indices, perplexities) blocks in graph order, e.g. from iter_sentences
+    Yields the rows, the position of each sentence in the chunk and the perplexities.
+    """
+    sentences = iter(sentences)
+    idx = np.empty(0, dtype=np.int64)
+    perplex = np.empty(0, dtype=np.float64)
+    with open(graph_path) as graph_file:
+        for start in itertools.count(0, chunksize):
+            lines = list(itertools.islice(graph_file, chunksize))
+            if not lines:
+                break
+            chunk_idx, chunk_perplex = [], []
+            while True:
+                stop = np.searchsorted(idx, start + len(lines), side='left')
+                chunk_idx.append(idx[:stop])
+                chunk_perplex.append(perplex[:stop])
+                idx, perplex = idx[stop:], perplex[stop:]
+                if len(idx):
+                    break
+                block = next(sentences, None)
+                if block is None:
+                    break
+                idx, perplex = block
+            yield [line.rstrip().split('\t') for line in lines], np.concatenate(chunk_idx) - start, \
+                np.concatenate(chunk_perplex)
+    if not len(idx):
+        idx = next(sentences, (idx, perplex))[0]
+    if len(idx):
+        raise ValueError('Sentence index {} is beyond the end of {}'.format(idx[0], graph_path))
+
+
+def count_graph_columns(graph_path):
+    """Largest number of tab-separated fields in the lines of graph_path, the width apply_reweight pads rows to"""
+    with open(graph_path) as graph_file:
+        return max((line.rstrip().count('\t') + 1 for line in graph_file), default=0)
+
+
+def sentence_fields(rows, positions, column):
+    """Field number column of the rows at positions (None for rows without it, as in load_graph_text)"""
+    return np.array([rows[i][column] if len(rows[i]) > column else None for i in positions.tolist()], dtype=object)
+
+
+def stream_reweight(sentence_csv_path, graph_path, perplexity_file_dir, out_file, score_type,
+                    chunksize=1000000, n_columns=None, diagnostics=None, diagnostics_dir=None):
+    """
+    Streaming apply_reweight: writes the same reweighted graph (relation_zscore up to the last float bits, its
+    moments are merged chunk by chunk), reading the graph line by line in two passes,
+    the first one for the global statistics of score_type (it only reads the graph if score_type needs groups).
+    The sentences and perplexities are checked in the first pass, before anything is written.
+    n_columns: shorter rows are padded with empty fields to n_columns, as apply_reweight does for graphs with ragged
+    rows. By default the widest row of the graph, which takes one more read of the graph (count_graph_columns).
+    diagnostics are collected chunk by chunk, as in apply_reweight (off unless diagnostics=True or diagnostics_dir).
+    stream_reweight(sentence_csv_path='cn_sentences.csv', graph_path='conceptnet.csv',
+                    perplexity_file_dir='BERT_LM_results/', out_file='cn_reweight.csv', score_type='reweight')
+    """
+    score_function = get_score_function(score_type)
+    group_column = score_group_column(score_type)
+    stats = ScoreStatistics(keep_values=score_function['keep_values'], by_relation=score_function['by_relation'],
+                            group_sketch=score_function['group_sketch'])
+    with stage('scores', score_type=score_type) as record:
+        record['rows'] = 0
+        if needs_relations(score_type):
+            for rows, positions, perplex in iter_graph_chunks(
+                    graph_path, iter_sentences(sentence_csv_path, perplexity_file_dir, chunksize), chunksize):
+                record['rows'] += len(perplex)
+                stats.update(perplex, sentence_fields(rows, positions, group_column))
+        else:
+            for _, perplex in iter_sentences(sentence_csv_path, perplexity_file_dir, chunksize):
+                record['rows'] += len(perplex)
+                stats.update(perplex)
+        stats.finish()
+
+    if n_columns is None:
+        n_columns = count_graph_columns(graph_path)
+
+    diagnostics = diagnostics or (diagnostics is None and diagnostics_dir is not None)
+    report = Diagnostics(enabled=diagnostics)
+    with stage('inject', path=out_file) as record, open(out_file, 'w+', newline='') as out:
+        writer = csv.writer(out, delimiter='\t', lineterminator='\n')
+        record['rows'] = 0
+        for rows, positions, perplex in iter_graph_chunks(
+                graph_path, iter_sentences(sentence_csv_path, perplexity_file_dir, chunksize), chunksize):
+            record['rows'] += len(rows)
+            groups = None if group_column is None else sentence_fields(rows, positions, group_column)
+            weights = perplexities_to_scores(perplex, score_type, stats=stats, relations=groups)
+            if diagnostics:
+                relations = groups if group_column == 4 else sentence_fields(rows, positions, 4)
+                report.add('perplexity', perplex, groups=relations, log=True)
+                report.add('weight', weights, groups=relations)
+            for i, weight in zip(positions.tolist(), np.asarray(weights, dtype=np.float64).tolist()):
+                rows[i][2] = weight if weight == weight else ''  # NaN as an empty field, as pandas writes it
+            for row in rows:
+                row.extend([''] * (n_columns - len(row)))
+            writer.writerows(rows)
+    report.write(diagnostics_dir or os.path.splitext(out_file)[0] + '_diagnostics')
+
+
+if __name__ == '__main__':
+    stream_sentences(graph_path='./data/examples/conceptnet_toy.csv',
+                     out_txt='./output/sentences/cn_toy_sentences.txt',
+                     out_csv='./output/sentences/cn_toy_sentences.csv',
+                     columns=['word1', 'word2', 'score', 'sources', 'relation'])
+    # run the language model on cn_toy_sentences.txt, then:
+    stream_reweight(sentence_csv_path='./output/sentences/cn_toy_sentences.csv',
+                    graph_path='./data/examples/conceptnet_toy.csv',
+                    perplexity_file_dir='./data/examples/conceptnet_toy_BERT_results/',
+                    out_file='./output/kgs/cn_toy_reweight.csv',
+                    score_type='reweight')
@@ -0,0 +1,132 @@
+import os
+import csv
+import json
+import numpy as np
+import pandas as pd
+
+from instrumentation import stage
+
+"""
+Compact columnar graph store for ConceptNet-format KGs
+
+A store is a directory with one raw binary file per column, opened via memory mapping:
+-word1.bin, word2.bin, sources.bin, relation.bin: int32 ids into the vocabularies
+-score.bin: float64 scores
+-concepts.txt (shared by word1 and word2), sources.txt, relations.txt: one string per line, line number = id
+-meta.json: number of edges, column dtypes and vocabularies
+"""
+
+STORE_FORMAT = 'reweight-graph-store'
+STORE_VERSION = 1
+STORE_COLUMNS = ['word1', 'word2', 'score', 'sources', 'relation']
+STORE_VOCABULARIES = {'word1': 'concepts', 'word2': 'concepts', 'sources': 'sources', 'relation': 'relations'}
+CODE_DTYPE = np.int32
+SCORE_DTYPE = np.float64
+
+
+def is_graph_store(path):
+    return os.path.isfile(os.path.join(path, 'meta.json'))
+
+
+def _read_vocabulary(path):
+    with open(path, encoding='utf-8') as vocab_file:
+        return pd.Index(vocab_file.read().split('\n')[:-1], dtype=object)
+
+
+def tsv_to_graph_store(tsv_path, store_dir, chunksize=1000000):
+    """
+    Converts a headerless ConceptNet-format TSV (word1, word2, score, sources, relation) into a graph store.
+    Further columns, e.g. the file column of merged WebChild graphs, are not stored.
+    tsv_to_graph_store(tsv_path='conceptnet.csv', store_dir='conceptnet_store/')
+    """
+    with stage('convert_graph_store', path=tsv_path) as record:
+        os.makedirs(store_dir, exist_ok=True)
+        vocabularies = {name: {} for name in set(STORE_VOCABULARIES.values())}
+        num_edges = 0
+        column_files = {col: open(os.path.join(store_dir, col + '.bin'), 'wb') for col in STORE_COLUMNS}
+        try:
+            reader = pd.read_csv(tsv_path, sep='\t', header=None, names=STORE_COLUMNS,
+                                 usecols=range(len(STORE_COLUMNS)), dtype=str, quoting=csv.QUOTE_NONE,
+                                 na_filter=False, chunksize=chunksize)
+            for chunk in reader:
+                column_files['score'].write(pd.to_numeric(chunk['score']).to_numpy(dtype=SCORE_DTYPE).tobytes())
+                for col, vocab_name in STORE_VOCABULARIES.items():
+                    # dictionary lookups only for the distinct values of the chunk
+                    codes, uniques = pd.factorize(chunk[col])
+                    vocab = vocabularies[vocab_name]
+                    ids = np.fromiter((vocab.setdefault(value, len(vocab)) for value in uniques),
+                                      dtype=np.int64, count=len(uniques))
+                    column_files[col].write(ids[codes].astype(CODE_DTYPE).tobytes())
+                num_edges += len(chunk)
+        finally:
+            for column_file in column_files.values():
+                column_file.close()
+
+        for vocab_name, vocab in vocabularies.items():
+            with open(os.path.join(store_dir, vocab_name + '.txt'), 'w', encoding='utf-8') as vocab_file:
+                vocab_file.writelines(value + '\n' for value in vocab)
+        meta = {'format': STORE_FORMAT, 'version': STORE_VERSION, 'num_edges': num_edges,
+                'columns': {col: np.dtype(SCORE_DTYPE if col == 'score' else CODE_DTYPE).name
+                            for col in STORE_COLUMNS},
+                'vocabularies': STORE_VOCABULARIES}
+        with open(os.path.join(store_dir, 'meta.json'), 'w') as meta_file:
+            json.dump(meta, meta_file, indent=2)
+        record['rows'] = num_edges
+
+
+def open_graph_store(store_dir):
+    """
+    Memory maps the columns of a graph store.
+    Returns the meta data, the column arrays (read-only) and the vocabularies as pd.Index.
+    """
+    with open(os.path.join(store_dir, 'meta.json')) as meta_file:
+        meta = json.load(meta_file)
+    if meta.get('format') != STORE_FORMAT or meta.get('version') != STORE_VERSION:
+        raise ValueError('{} is not a version {} graph store'.format(store_dir, STORE_VERSION))
+    num_edges = meta['num_edges']
+    arrays = {}
+    for col, dtype in meta['columns'].items():
+        path = os.path.join(store_dir, col + '.bin')
+        if num_edges:
+            arrays[col] = np.memmap(path, dtype=dtype, mode='r', shape=(num_edges,))
+        else:
+            arrays[col] = np.empty(0, dtype=dtype)
+    vocabularies = {name: _read_vocabulary(os.path.join(store_dir, name + '.txt'))
+                    for name in set(meta['vocabularies'].values())}
+    return meta, arrays, vocabularies
+
+
+def _store_frame(meta, arrays, vocabularies, rows=slice(None)):
+    data = {}
+    for col in meta['columns']:
+        if col in meta['vocabularies']:
+            data[col] = pd.Categorical.from_codes(arrays[col][rows], categories=vocabularies[meta['vocabularies'][col]])
+        else:
+            data[col] = np.asarray(arrays[col][rows])
+    return pd.DataFrame(data)
+
+
+def load_graph_store(store_dir):
+    """
+    Loads a graph store as DataFrame with columns ['word1', 'word2', 'score', 'sources', 'relation'].
+    String columns are Categoricals over the store vocabularies, so string operations like str.contains
+    only run once per distinct value.
+    """
+    return _store_frame(*open_graph_store(store_dir))
+
+
+def graph_store_to_tsv(store_dir, out_path, chunksize=1000000):
+    """
+    Writes a graph store back to a headerless ConceptNet-format TSV. Scores are written as floats, e.g. '1' becomes '1.0'.
+    graph_store_to_tsv(store_dir='conceptnet_store/', out_path='conceptnet.csv')
+    """
+    meta, arrays, vocabularies = open_graph_store(store_dir)
+    with open(out_path, 'w', newline='', encoding='utf-8') as out_file:
+        for start in range(0, meta['num_edges'], chunksize):
+            chunk = _store_frame(meta, arrays, vocabularies, slice(start, start + chunksize))
+            chunk.to_csv(out_file, sep='\t', index=False, header=False)
+
+
+if __name__ == '__main__':
+    tsv_to_graph_store(tsv_path='./data/examples/conceptnet_toy.csv', store_dir='./output/kgs/cn_toy_store/')
+    graph_store_to_tsv(store_dir='./output/kgs/cn_toy_store/', out_path='./output/kgs/cn_toy_from_store.csv')
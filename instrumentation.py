@@ -0,0 +1,119 @@
+import sys
+import json
+import time
+import socket
+import logging
+import contextlib
+
+try:
+    import resource
+except ImportError:  # not available on Windows, peak RSS is then not recorded
+    resource = None
+
+"""
+Stage-level instrumentation for the REWEIGHT pipeline
+
+Every pipeline stage (format conversion, sentence generation, chunking, perplexity loading, scoring, injection)
+runs inside stage(), which records its wall time, rows per second and how much it raised the peak RSS
+into the current RunReport
+and logs one structured record per stage on the 'reweight' logger.
+with stage('sentences', graph=graph_path) as record:
+    ...
+    record['rows'] = len(sentences)
+write_run_report('run_report.json')
+"""
+
+logger = logging.getLogger('reweight')
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process and of its finished child processes (e.g. Pool workers) in MB"""
+    if resource is None:
+        return None, None
+    scale = 1 / 2 ** 20 if sys.platform == 'darwin' else 1 / 2 ** 10  # bytes on macOS, KB on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+class RunReport:
+    """Stage records of one pipeline run, in the order the stages finished"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = []
+
+    def to_dict(self):
+        peak, children_peak = peak_rss_mb()
+        return {'host': socket.gethostname(), 'started': self.started, 'wall_s': time.time() - self.started,
+                'process_peak_rss_mb': peak, 'children_peak_rss_mb': children_peak, 'stages': self.stages}
+
+    def write(self, path):
+        with open(path, 'w') as report_file:
+            json.dump(self.to_dict(), report_file, indent=2, default=str)
+
+
+_run_report = RunReport()
+
+
+def get_run_report():
+    return _run_report
+
+
+def start_run():
+    """Starts a new, empty run report, e.g. at the beginning of a pipeline run"""
+    global _run_report
+    _run_report = RunReport()
+    return _run_report
+
+
+def write_run_report(path):
+    """Writes the current run report as JSON"""
+    _run_report.write(path)
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """
+    Records wall time, rows/s and peak RSS of the enclosed block as stage name. fields (e.g. input paths) are added
+    to the record, the block can set record['rows'] and further fields on the yielded dict.
+    The OS only keeps the peak RSS of the whole process, so process_peak_rss_mb is the peak so far, including
+    earlier stages. peak_rss_delta_mb is how far the stage raised it: 0 for a stage that stayed below an earlier
+    peak, whatever it allocated itself.
+    """
+    record = {'stage': name, 'rows': None}
+    record.update(fields)
+    peak_before, _ = peak_rss_mb()
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as exc:
+        record['error'] = repr(exc)
+        raise
+    finally:
+        record['wall_s'] = time.perf_counter() - start
+        record['rows_per_s'] = record['rows'] / record['wall_s'] if record['rows'] and record['wall_s'] else None
+        record['process_peak_rss_mb'], record['children_peak_rss_mb'] = peak_rss_mb()
+        record['peak_rss_delta_mb'] = None if peak_before is None else record['process_peak_rss_mb'] - peak_before
+        _run_report.stages.append(record)
+        logger.info('stage %s: %.2fs, %s rows', name, record['wall_s'], record['rows'], extra={'record': record})
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """One JSON object per log line, with the stage record for stage logs"""
+
+    def format(self, log_record):
+        data = {'time': log_record.created, 'level': log_record.levelname, 'logger': log_record.name,
+                'message': log_record.getMessage()}
+        if hasattr(log_record, 'record'):
+            data.update(log_record.record)
+        return json.dumps(data, default=str)
+
+
+def configure_logging(level=logging.INFO, json_lines=False, stream=None):
+    """Logs the 'reweight' logger to stream (default stderr), as JSON lines for log collection if json_lines"""
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonLinesFormatter() if json_lines else
+                         logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    logger.handlers = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
@@ -0,0 +1,390 @@
+import os
+import json
+import shutil
+import hashlib
+import argparse
+import threading
+import concurrent.futures
+
+from graph_reweighting.lm_scoring import score_prepared_chunks
+from graph_reweighting.perplexities_to_scores import apply_reweight, SCORE_FUNCTIONS
+from graph_reweighting.streaming_pipeline import stream_sentences, stream_reweight
+from instrumentation import start_run, write_run_report, configure_logging
+from sentence_construction.graph_to_sentence import get_all_sentences, prepare_lm_chunks
+from sentence_construction.yago_to_sentence import yago_taxonomy_to_conceptnet_format
+from util import load_df, get_en_idx
+
+"""
+Resumable REWEIGHT pipeline
+
+Runs the stages convert -> sentences -> chunk -> score -> inject for one or more graphs as a DAG.
+Every stage writes into its own artifact directory <work_dir>/<graph>/<stage>/ and is identified by a key,
+the sha256 of its parameters and of the contents of its inputs (input files, or the outputs of upstream stages).
+A stage whose key is unchanged since it last completed is skipped. A stage that was interrupted is restarted
+in its directory when its key is the same, so LM scoring continues with the first chunk without results.
+Stages whose inputs are ready run in parallel (--jobs), chunks are scored in --processes worker processes.
+python pipeline.py --graph conceptnet.csv --graph yago:yago_taxonomy.tsv --work-dir reweight_run/ --chunks 16
+"""
+
+PIPELINE_VERSION = 1  # part of every stage key, increase when stage outputs change
+STATE_FILE = 'pipeline_state.json'
+STAGE_KEY_FILE = '.stage_key'
+GRAPH_KINDS = ['conceptnet', 'yago']
+CN_COLUMNS = ['word1', 'word2', 'score', 'sources', 'relation']
+
+
+"""
+Content hashes
+"""
+
+
+def file_digest(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as in_file:
+        for block in iter(lambda: in_file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def path_digest(path, cache=None):
+    """
+    sha256 of a file's content, for a directory over the relative paths and contents of all its files.
+    cache: dict {absolute path: [size, mtime_ns, digest]}, files with unchanged size and mtime are not read again.
+    """
+    if os.path.isfile(path):
+        path = os.path.abspath(path)
+        info = os.stat(path)
+        cached = cache.get(path) if cache is not None else None
+        if cached and cached[:2] == [info.st_size, info.st_mtime_ns]:
+            return cached[2]
+        digest = file_digest(path)
+        if cache is not None:
+            cache[path] = [info.st_size, info.st_mtime_ns, digest]
+        return digest
+    if not os.path.isdir(path):
+        raise FileNotFoundError('Pipeline input {} does not exist'.format(path))
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name == STAGE_KEY_FILE:
+                continue
+            file_path = os.path.join(root, name)
+            digest.update(os.path.relpath(file_path, path).replace(os.sep, '/').encode('utf-8'))
+            digest.update(path_digest(file_path, cache).encode('ascii'))
+    return digest.hexdigest()
+
+
+class PipelineState:
+    """
+    Completed stages {name: {'key', 'digest'}} and the digest cache of the input files, stored as JSON in work_dir.
+    Written after every completed stage, via a temporary file so a crash never leaves it half written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.files = {}
+        if os.path.isfile(path):
+            with open(path) as state_file:
+                state = json.load(state_file)
+            self.stages = state.get('stages', {})
+            self.files = state.get('files', {})
+
+    def completed(self, name, key):
+        record = self.stages.get(name)
+        return record is not None and record['key'] == key
+
+    def digest(self, name):
+        return self.stages[name]['digest']
+
+    def input_digest(self, path):
+        """
+        path_digest of a pipeline input with the digest cache. Stage threads hash with a copy of the cache,
+        which is merged back under the lock, so save() never sees the cache change while writing it.
+        """
+        with self.lock:
+            cache = dict(self.files)
+        digest = path_digest(path, cache)
+        with self.lock:
+            self.files.update(cache)
+        return digest
+
+    def finish(self, name, key, digest):
+        with self.lock:
+            self.stages[name] = {'key': key, 'digest': digest}
+            self.save()
+
+    def save(self):
+        """Writes the state, call with the lock held"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as state_file:
+            json.dump({'version': PIPELINE_VERSION, 'stages': self.stages, 'files': self.files}, state_file,
+                      indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+"""
+Stages
+"""
+
+
+class Stage:
+    """
+    One step of the DAG: run(out_dir, **inputs, **params, **options) writes its results into out_dir.
+    inputs: {argument: (upstream stage name or None, path)}, a path relative to the upstream stage's directory
+    or a file/directory outside the pipeline. The upstream stages are the dependencies of the stage.
+    options are passed like params but are not part of the key, e.g. the number of processes.
+    """
+
+    def __init__(self, name, run, out_dir, inputs, params=None, options=None):
+        self.name = name
+        self.run = run
+        self.out_dir = out_dir
+        self.inputs = inputs
+        self.params = params or {}
+        self.options = options or {}
+        self.deps = sorted({upstream for upstream, _ in inputs.values() if upstream is not None})
+
+    def input_paths(self, stages):
+        return {arg: os.path.join(stages[upstream].out_dir, path) if upstream else path
+                for arg, (upstream, path) in self.inputs.items()}
+
+    def key(self, state, stages):
+        inputs = {}
+        for arg, (upstream, path) in self.inputs.items():
+            if upstream is None:
+                inputs[arg] = state.input_digest(path)
+            else:
+                inputs[arg] = [state.digest(upstream), path]
+        description = {'version': PIPELINE_VERSION, 'run': self.run.__name__, 'inputs': inputs, 'params': self.params}
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _convert_yago(out_dir, source, processes):
+    summary = yago_taxonomy_to_conceptnet_format(source, os.path.join(out_dir, 'graph.csv'), processes=processes)
+    with open(os.path.join(out_dir, 'convert_summary.json'), 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+
+
+def _sentences(out_dir, graph, kind, streaming):
+    out_txt = os.path.join(out_dir, 'sentences.txt')
+    out_csv = os.path.join(out_dir, 'sentences.csv')
+    if streaming:
+        stream_sentences(graph, out_txt, out_csv, columns=CN_COLUMNS)
+    else:
+        graph_df = load_df(graph, columns=CN_COLUMNS)
+        # the YAGO taxonomy is English only, as in yago_to_sentence
+        indices = get_en_idx(graph_df) if kind == 'conceptnet' else graph_df.index.values
+        get_all_sentences(graph_df, indices, out_txt, out_csv)
+
+
+def _chunk(out_dir, sentences, num_chunks, max_len):
+    prepare_lm_chunks(sentences, out_dir, num_chunks, max_len=max_len)
+
+
+def _score(out_dir, chunks, processes, batch_size):
+    score_prepared_chunks(chunks, out_dir, batch_size=batch_size, processes=processes)
+
+
+def _inject(out_dir, sentences, graph, perplexities, score_type, streaming, out_name):
+    out_file = os.path.join(out_dir, out_name)
+    tmp_file = out_file + '.tmp'  # only complete graphs get the final name
+    if streaming:
+        stream_reweight(sentences, graph, perplexities, tmp_file, score_type,
+                        diagnostics_dir=os.path.join(out_dir, 'diagnostics'))
+    else:
+        apply_reweight(sentences, graph, perplexities, tmp_file, score_type,
+                       diagnostics_dir=os.path.join(out_dir, 'diagnostics'))
+    os.replace(tmp_file, out_file)
+
+
+def graph_stages(graph_path, kind, work_dir, name=None, score_type='reweight', num_chunks=8, max_len=43,
+                 lm_results=None, streaming=False, processes=None, batch_size=64):
+    """
+    The stages for one graph. kind 'yago' adds the conversion to ConceptNet format.
+    lm_results: perplexities of an external LM run on the sentences, replaces the chunk and score stages.
+    """
+    if kind not in GRAPH_KINDS:
+        raise ValueError('Unknown graph kind {}, use one of {}'.format(kind, GRAPH_KINDS))
+    name = name or os.path.splitext(os.path.basename(graph_path.rstrip('/')))[0]
+    graph_dir = os.path.join(work_dir, name)
+    stages = []
+    graph = (None, graph_path)
+    if kind == 'yago':
+        stages.append(Stage(name + '/convert', _convert_yago, os.path.join(graph_dir, 'convert'),
+                            {'source': graph}, options={'processes': processes}))
+        graph = (name + '/convert', 'graph.csv')
+    stages.append(Stage(name + '/sentences', _sentences, os.path.join(graph_dir, 'sentences'),
+                        {'graph': graph}, {'kind': kind, 'streaming': streaming}))
+    if lm_results:
+        perplexities = (None, lm_results)
+    else:
+        stages.append(Stage(name + '/chunk', _chunk, os.path.join(graph_dir, 'chunk'),
+                            {'sentences': (name + '/sentences', 'sentences.txt')},
+                            {'num_chunks': num_chunks, 'max_len': max_len}))
+        stages.append(Stage(name + '/score', _score, os.path.join(graph_dir, 'score'),
+                            {'chunks': (name + '/chunk', '')}, {'batch_size': batch_size},
+                            {'processes': processes}))
+        perplexities = (name + '/score', '')
+    stages.append(Stage(name + '/inject', _inject, os.path.join(graph_dir, 'inject'),
+                        {'sentences': (name + '/sentences', 'sentences.csv'), 'graph': graph,
+                         'perplexities': perplexities},
+                        {'score_type': score_type, 'streaming': streaming,
+                         'out_name': '{}_{}.csv'.format(name, score_type)}))
+    return stages
+
+
+"""
+Runner
+"""
+
+
+def _check_stages(stages):
+    stages = {stage.name: stage for stage in stages}
+    for stage in stages.values():
+        missing = [dep for dep in stage.deps if dep not in stages]
+        if missing:
+            raise ValueError('Stage {} depends on unknown stages {}'.format(stage.name, missing))
+    return stages
+
+
+def _status(name, message):
+    print('{}: {}\n'.format(name, message), end='', flush=True)  # one write, stages print from several threads
+
+
+def is_up_to_date(stage, key, state):
+    return state.completed(stage.name, key) and os.path.isdir(stage.out_dir)
+
+
+def run_stage(stage, stages, state, force=False):
+    """Runs stage unless it completed with the same key before, returns whether it ran"""
+    key = stage.key(state, stages)
+    if not force and is_up_to_date(stage, key, state):
+        _status(stage.name, 'up to date, skipped')
+        return False
+    key_path = os.path.join(stage.out_dir, STAGE_KEY_FILE)
+    resume = False
+    if os.path.isdir(stage.out_dir):
+        if not force and os.path.isfile(key_path):
+            with open(key_path) as key_file:
+                resume = key_file.read().strip() == key
+        if not resume:  # results of other inputs or parameters
+            shutil.rmtree(stage.out_dir)
+    os.makedirs(stage.out_dir, exist_ok=True)
+    with open(key_path, 'w') as key_file:
+        key_file.write(key)
+    _status(stage.name, 'resuming' if resume else 'running')
+    stage.run(stage.out_dir, **stage.input_paths(stages), **stage.params, **stage.options)
+    state.finish(stage.name, key, path_digest(stage.out_dir))
+    return True
+
+
+def plan_pipeline(stages, work_dir, force=False):
+    """
+    Names of the stages run_pipeline may run: changed ones and everything downstream of them.
+    The keys of downstream stages depend on the outputs of their upstream stages, which are only known after those
+    ran, so a listed downstream stage is still skipped if its upstream stage writes the same outputs as before.
+    """
+    stages = _check_stages(stages)
+    state = PipelineState(os.path.join(work_dir, STATE_FILE))
+    to_run = []
+    done = set()
+    while len(done) < len(stages):
+        ready = [stage for name, stage in stages.items() if name not in done and all(dep in done for dep in stage.deps)]
+        if not ready:
+            raise ValueError('Stages {} have cyclic dependencies'.format(sorted(set(stages) - done)))
+        for stage in ready:
+            done.add(stage.name)
+            if force or any(dep in to_run for dep in stage.deps) or not is_up_to_date(stage, stage.key(state, stages),
+                                                                                       state):
+                to_run.append(stage.name)
+    return to_run
+
+
+def run_pipeline(stages, work_dir, jobs=1, force=False):
+    """
+    Runs the stages in dependency order, up to jobs stages at once in threads (the heavy stages start their own
+    worker processes). After a failure the running stages are finished and recorded, then the error is raised,
+    so the next run resumes from there. Returns the names of the stages that ran.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    state = PipelineState(os.path.join(work_dir, STATE_FILE))
+    stages = _check_stages(stages)
+    pending = dict(stages)
+    done = set()
+    ran = []
+    running = {}
+    error = None
+    with concurrent.futures.ThreadPoolExecutor(max(jobs, 1)) as executor:
+        while (pending and error is None) or running:
+            if error is None:
+                for name, stage in list(pending.items()):
+                    if all(dep in done for dep in stage.deps):
+                        running[executor.submit(run_stage, stage, stages, state, force)] = name
+                        del pending[name]
+            if not running:
+                raise ValueError('Stages {} have cyclic dependencies'.format(sorted(pending)))
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    if future.result():
+                        ran.append(name)
+                    done.add(name)
+                except Exception as exc:
+                    _status(name, 'failed with {!r}'.format(exc))
+                    error = error or exc
+    with state.lock:
+        state.save()  # digests of inputs that were only touched
+    if error is not None:
+        raise error
+    return ran
+
+
+def parse_graph_arg(value):
+    """'[kind:]path' of a --graph argument, kind defaults to conceptnet"""
+    kind, sep, path = value.partition(':')
+    if sep and kind in GRAPH_KINDS:
+        return kind, path
+    return 'conceptnet', value
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs REWEIGHT convert -> sentences -> chunk -> score -> inject, '
+                                                 'skipping stages whose inputs did not change')
+    parser.add_argument('--graph', action='append', required=True,
+                        help='[kind:]path, kind one of {} (default conceptnet), repeatable'.format(GRAPH_KINDS))
+    parser.add_argument('--work-dir', default='./output/pipeline/')
+    parser.add_argument('--score-type', default='reweight', choices=sorted(SCORE_FUNCTIONS))
+    parser.add_argument('--chunks', type=int, default=8, help='LM chunks with about the same number of tokens')
+    parser.add_argument('--max-len', type=int, default=43, help='split words longer than this for the LM')
+    parser.add_argument('--lm-results', default=None,
+                        help='perplexities of an external LM run on the sentences (one graph only)')
+    parser.add_argument('--streaming', action='store_true', help='stream_sentences/stream_reweight for large graphs')
+    parser.add_argument('--jobs', type=int, default=1, help='stages run at once')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes of conversion and scoring')
+    parser.add_argument('--force', action='store_true', help='rerun all stages from scratch')
+    parser.add_argument('--dry-run', action='store_true', help='only print which stages may run')
+    parser.add_argument('--json-logs', action='store_true', help='log stage records as JSON lines to stderr')
+    args = parser.parse_args()
+
+    if args.lm_results and len(args.graph) > 1:
+        parser.error('--lm-results needs exactly one --graph')
+    configure_logging(json_lines=args.json_logs)
+    start_run()
+    pipeline_stages = []
+    for graph_arg in args.graph:
+        graph_kind, path = parse_graph_arg(graph_arg)
+        pipeline_stages += graph_stages(path, graph_kind, args.work_dir, score_type=args.score_type,
+                                        num_chunks=args.chunks, max_len=args.max_len, lm_results=args.lm_results,
+                                        streaming=args.streaming, processes=args.processes)
+    if args.dry_run:
+        print('Stages that may run (downstream ones are skipped if their inputs come out unchanged):',
+              ', '.join(plan_pipeline(pipeline_stages, args.work_dir, args.force)) or 'none')
+    else:
+        try:
+            run_pipeline(pipeline_stages, args.work_dir, jobs=args.jobs, force=args.force)
+        finally:
+            write_run_report(os.path.join(args.work_dir, 'run_report.json'))
@@ -1,8 +1,12 @@
 
+import numpy as np
 import pandas as pd
 
-from sentence_construction.graph_to_sentence import concept_to_word
-from util import load_df, concatenate_files, word_to_concept, word_to_rel
+from sentence_construction.graph_to_sentence import concept_to_word, get_all_sentences
+from sentence_construction.templates import get_template_registry
+from util import load_df, concatenate_files
+from vocabulary import get_vocabulary
+from instrumentation import stage
 
 """
 Get other graphs to same format as ConceptNet
@@ -26,6 +30,19 @@ webchild_relation_type_to_sentence = {'/r/time': 'one can {} during a {}',
                                       '/r/hasSubstance': 'a {} consists of a {}',
                                       '/r/IsA': 'a {} is a {}'
                                       }
+webchild_flipped_relations = ['/r/agent', '/r/participant', '/r/next', '/r/hasMember', '/r/hasPart']
+
+"""
+Sentence templates of WebChild: fixed relations for any source file, free relations per class of source file
+('property', 'spatial', 'comparative', checked in this order) with the relation word ({2}) in the sentence
+"""
+
+for _rel, _pattern in webchild_relation_type_to_sentence.items():
+    get_template_registry('webchild').register(_pattern, relation=_rel, flip=_rel in webchild_flipped_relations)
+get_template_registry('webchild').register('a {0} is {1}', relation='/r/is', file_class='property')
+get_template_registry('webchild').register('a {0} {2} is {1}', file_class='property')
+get_template_registry('webchild').register('a {0} {2} {1}', file_class='spatial')
+get_template_registry('webchild').register('a {0} {2} a {1}', file_class='comparative')
 
 """
 Put WebChild into ConceptNet format
@@ -42,109 +59,122 @@ Changes for WebChild:
 """
 
 
+def strip_sense(words):
+    """Cuts the '#sense' suffix of each word in a Series, str() of the value like the converters did per row"""
+    words = words.astype(object).where(words.notna(), 'nan').astype(str)
+    return words.str.replace('#.*', '', regex=True)
+
+
+def words_to_concepts(words):
+    """Column-wise word_to_concept"""
+    return '/c/en/' + words.str.replace(' ', '_', regex=False)
+
+
+def words_to_rels(words):
+    """Column-wise word_to_rel"""
+    words = words.astype(object).where(words.notna(), 'nan').astype(str)
+    words = words.where(~words.isin(['', '-']), 'is')
+    return '/r/' + words.str.replace(' ', '_', regex=False)
+
+
+def _write_chunks(chunks, convert, out_path):
+    """Converts each DataFrame of chunks and writes the results one after another to out_path"""
+    if isinstance(chunks, pd.DataFrame):
+        chunks = [chunks]
+    with stage('convert', path=out_path) as record, open(out_path, 'w+', newline='') as out_file:
+        record['rows'] = 0
+        for chunk in chunks:
+            convert(chunk).to_csv(out_file, sep='\t', index=False, header=False)
+            record['rows'] += len(chunk)
+
+
+def _cn_format_df(c1, c2, score, source, rel):
+    return pd.DataFrame({0: c1.to_numpy(), 1: c2.to_numpy(), 2: score.to_numpy(),
+                         3: source.to_numpy() if isinstance(source, pd.Series) else source, 4: rel.to_numpy()})
+
+
+def webchild_vocabulary():
+    """
+    The shared vocabulary of WebChild words with their ConceptNet forms, so each distinct word is only converted once
+    across all chunks and subgraphs
+    """
+    return get_vocabulary('webchild_words', forms={
+        'sense_concept': lambda words: words_to_concepts(strip_sense(words)),
+        'sense_relation': lambda words: words_to_rels(strip_sense(words)),
+        'multi_word_concept': lambda words: words_to_concepts(strip_multi_word_senses(words)),
+        'relation': words_to_rels,
+        'spatial_relation': lambda artikels: words_to_rels('is located ' + most_frequent_artikel(artikels))})
+
+
 def webchild_to_conceptnet_format(graph_df, out_path):
     """
+    graph_df: DataFrame with columns ['#x', 'y', 'r', 'score', 'sources'] or an iterator over such DataFrames,
+    e.g. load_df(path, columns=..., chunksize=1000000) for graphs bigger than memory
     webchild_to_conceptnet_format(graph_df=webchild_df, out_path='wc_cnformat.csv')
     """
-    assertions_temp_list = []
-    i = 0
-    for index, row in graph_df.iterrows():
-        i += 1
-        w1 = str(row['#x'])
-        w2 = str(row['y'])
-        if w1.find('#') != -1:
-            w1 = w1[:w1.find('#')]
-        if w2.find('#') != -1:
-            w2 = w2[:w2.find('#')]
-        c1 = word_to_concept(w1)
-        c2 = word_to_concept(w2)
-        r = str(row['r'])
-        if r.find('#') != -1:
-            r = r[:r.find('#')]
-        rel = word_to_rel(r)
-        score = row['score']
-        source = row['sources']  # 'http://people.mpi-inf.mpg.de/~ntandon/resources/readme-partwhole.html'
-        assoc = [c1, c2, score, source, rel]
-        assertions_temp_list.append(assoc)
-    web_child_res = pd.DataFrame(assertions_temp_list, index=None)
-    web_child_res.to_csv(out_path, sep='\t', index=False, header=False)
-
-
-def webchild_action_to_conceptnet_format(path_to_tab_sep_file, out_name):
+    def convert(chunk):
+        words = webchild_vocabulary()
+        c1 = words.lookup('sense_concept', chunk['#x'])
+        c2 = words.lookup('sense_concept', chunk['y'])
+        rel = words.lookup('sense_relation', chunk['r'])
+        # sources e.g. 'http://people.mpi-inf.mpg.de/~ntandon/resources/readme-partwhole.html'
+        return _cn_format_df(c1, c2, chunk['score'], chunk['sources'], rel)
+    _write_chunks(graph_df, convert, out_path)
+
+
+def strip_multi_word_senses(words):
+    """Cuts the '#sense' suffix of every token in ';'- or ' '-separated multi-word values, ';' becomes ' '"""
+    words = words.astype(object).where(words.notna(), 'nan').astype(str)
+    return words.str.replace('#[^ ;]*', '', regex=True).str.replace(';', ' ', regex=False)
+
+
+def webchild_action_to_conceptnet_format(path_to_tab_sep_file, out_name, chunksize=None):
     """
+    chunksize: convert the file chunk by chunk, for files bigger than memory
     webchild_action_to_conceptnet_format(path_to_tab_sep_file='wc_action.csv', out_name='wc_spatial_formatted.csv')
     """
     column_names = ['action', 'attribut', 'attribut_value', 'score']
-    data = load_df(path_to_tab_sep_file, columns=column_names)
-    assertions_temp_list = []
-    i = 0
-    for index, row in data.iterrows():
-        i += 1
-        w1 = str(row['action'])
-        w2 = str(row['attribut_value'])
-        w1_split = w1.split(';')
-        w2_split = w2.split(';')
-        w1 = ''
-        w2 = ''
-        for w in w1_split:
-            w_split = w.split(' ')
-            for wt in w_split:
-                inx = wt.find('#')
-                if inx != -1:
-                    wt = wt[:inx]
-                w1 = w1 + wt + ' '
-        for w in w2_split:
-            w_split = w.split(' ')
-            for wt in w_split:
-                inx = wt.find('#')
-                if inx != -1:
-                    wt = wt[:inx]
-                w2 = w2 + wt + ' '
-        c1 = word_to_concept(w1[:-1])
-        c2 = word_to_concept(w2[:-1])
-        r = row['attribut']
-        rel = word_to_rel(r)
-        score = row['score']
+
+    def convert(chunk):
+        words = webchild_vocabulary()
+        c1 = words.lookup('multi_word_concept', chunk['action'])
+        c2 = words.lookup('multi_word_concept', chunk['attribut_value'])
+        rel = words.lookup('relation', chunk['attribut'])
         source = 'http://people.mpi-inf.mpg.de/~ntandon/resources/readme-activity.html'
-        assoc = [c1, c2, score, source, rel]
-        assertions_temp_list.append(assoc)
-    web_child_res = pd.DataFrame(assertions_temp_list, index=None)
-    web_child_res.to_csv(out_name, sep='\t', index=False, header=False)
+        return _cn_format_df(c1, c2, chunk['score'], source, rel)
+    _write_chunks(load_df(path_to_tab_sep_file, columns=column_names, chunksize=chunksize), convert, out_name)
+
+
+def most_frequent_artikel(artikels_with_counts):
+    """
+    Artikel with the highest count for each value like 'in :12,on :3' of a Series,
+    on equal counts the last one listed wins
+    """
+    artikels = artikels_with_counts.str.split(',').explode()
+    artikel_count = artikels.str.split(' :', expand=True)
+    candidates = pd.DataFrame({'row': np.arange(len(artikels_with_counts)).repeat(
+                                   artikels_with_counts.str.count(',').to_numpy() + 1),
+                               'artikel': artikel_count[0].to_numpy(),
+                               'count': artikel_count[1].astype(float).to_numpy()})
+    candidates = candidates.sort_values(['row', 'count'], kind='stable')
+    best = candidates.drop_duplicates('row', keep='last')
+    return pd.Series(best['artikel'].to_numpy(), index=artikels_with_counts.index)
 
 
-def webchild_spatial_to_conceptnet_format(path_to_tab_sep_file, out_name):
+def webchild_spatial_to_conceptnet_format(path_to_tab_sep_file, out_name, chunksize=None):
     """
+    chunksize: convert the file chunk by chunk, for files bigger than memory
     webchild_spatial_to_conceptnet_format(path_to_tab_sep_file='wc_spatial.csv', out_name='wc_spatial_formatted.csv')
     """
     column_names = ['word1', 'locationword', 'artikels_with_counts', 'score']
-    data = load_df(path_to_tab_sep_file, columns=column_names)
-    assertions_temp_list = []
-    i = 0
-    for index, row in data.iterrows():
-        i += 1
-        w1 = str(row['word1'])
-        w2 = str(row['locationword'])
-        if w1.find('#') != -1:
-            w1 = w1[:w1.find('#')]
-        if w2.find('#') != -1:
-            w2 = w2[:w2.find('#')]
-        c1 = word_to_concept(w1)
-        c2 = word_to_concept(w2)
-        r = row['artikels_with_counts']
-        rel_value_list = r.split(',')
-        rel_value_dict = {}
-        for rel_val in rel_value_list:
-            rv_split = rel_val.split(' :')
-            rel_value_dict[float(rv_split[1])] = rv_split[0]
-        maxim = max(rel_value_dict)
-        r = 'is located ' + rel_value_dict[maxim]
-        rel = word_to_rel(r)
-        score = row['score']
-        source = 'spatial'
-        assoc = [c1, c2, score, source, rel]
-        assertions_temp_list.append(assoc)
-    web_child_res = pd.DataFrame(assertions_temp_list, index=None)
-    web_child_res.to_csv(out_name, sep='\t', index=False, header=False)
+
+    def convert(chunk):
+        words = webchild_vocabulary()
+        c1 = words.lookup('sense_concept', chunk['word1'])
+        c2 = words.lookup('sense_concept', chunk['locationword'])
+        rel = words.lookup('spatial_relation', chunk['artikels_with_counts'])
+        return _cn_format_df(c1, c2, chunk['score'], 'spatial', rel)
+    _write_chunks(load_df(path_to_tab_sep_file, columns=column_names, chunksize=chunksize), convert, out_name)
 
 
 """
@@ -152,31 +182,75 @@ Preprocessing
 """
 
 
-def reduce_webchild(graph_df, out_path=None):
+WEBCHILD_FILES_TO_REDUCE = ['WebChild/ConceptNet_Format/webchild_comparative_concepntnetFormat.csv',
+                            'WebChild/ConceptNet_Format/webchild_spatial_concepntnetFormat.csv',
+                            'WebChild/ConceptNet_Format/webchild_property_concepntnetFormat.csv']
+
+
+def _max_score_edges(reduce_df):
+    """
+    Row with the maximum score for each (filename, word1, word2), the first one on equal scores.
+    NaN scores rank below all others, a group with only NaN scores keeps its first row.
+    """
+    reduce_df = reduce_df.reset_index(drop=True)
+    scores = reduce_df['score'].astype(float).fillna(-np.inf)
+    best_idx = scores.groupby([reduce_df['filename'], reduce_df['word1'], reduce_df['word2']], sort=False,
+                              observed=True, dropna=False).idxmax()
+    return reduce_df.iloc[best_idx.to_numpy()]
+
+
+def _order_reduced(best_df, filenames_to_reduce):
+    """Reduced edges after each other in the order of filenames_to_reduce, each sorted by descending score"""
+    file_order = best_df['filename'].map({name: i for i, name in enumerate(filenames_to_reduce)})
+    order = np.lexsort((-best_df['score'].to_numpy(), file_order.to_numpy()))
+    return best_df.iloc[order]
+
+
+def reduce_webchild(graph_df, out_path=None, filenames_to_reduce=None):
     """
     Take only maximum scoring edge for relation-subgraphs that contain free relation weights
     map all 'comparative'-Relations to /r/comparative
+    One groupby over the edges of all filenames_to_reduce, the other edges keep their order, followed by the reduced
+    edges of each file sorted by descending score.
+    The number of edges before and after are logged with the 'reduce_webchild' stage record.
     reduce_webchild(graph_df=wc_cnformat, out_path='wc_cnformat_reduced.csv')
     """
-    print('Shape full: ', graph_df.shape)
-    filenames_to_reduce = ['WebChild/ConceptNet_Format/webchild_comparative_concepntnetFormat.csv',
-                           'WebChild/ConceptNet_Format/webchild_spatial_concepntnetFormat.csv',
-                           'WebChild/ConceptNet_Format/webchild_property_concepntnetFormat.csv']
-    for filename in filenames_to_reduce:
-        reduce_index = graph_df['filename'] == filename
-        reduce_df = graph_df[reduce_index]
-        reduce_df = reduce_df.sort_values(['score'], ascending=False)  # sort to keep max score only
-        reduce_df = reduce_df.drop_duplicates(['word1', 'word2'], keep='first')  # only keeps max score
-        graph_df = graph_df[~reduce_index]  # drop all comparative relations
-        graph_df = graph_df.append(reduce_df, ignore_index=True)
-        graph_df = graph_df.reset_index(drop=True)
-        print('Shape after {}: '.format(filename), graph_df.shape)
-    print('Shape final: ', graph_df.shape)
-    if out_path:
-        graph_df.to_csv(out_path, sep='\t', index=False, header=False)
+    filenames_to_reduce = filenames_to_reduce or WEBCHILD_FILES_TO_REDUCE
+    with stage('reduce_webchild', path=out_path, rows=len(graph_df)) as record:
+        reduce_index = graph_df['filename'].isin(filenames_to_reduce)
+        best_df = _max_score_edges(graph_df[reduce_index])
+        graph_df = pd.concat([graph_df[~reduce_index], _order_reduced(best_df, filenames_to_reduce)],
+                             ignore_index=True)
+        record['rows_out'] = len(graph_df)
+        if out_path:
+            graph_df.to_csv(out_path, sep='\t', index=False, header=False)
     return graph_df
 
 
+def reduce_webchild_file(graph_path, out_path, columns, chunksize=1000000, filenames_to_reduce=None):
+    """
+    Out-of-core reduce_webchild on a headerless csv, read in chunks of chunksize rows.
+    Only the current maximum scoring edges of the reduced files are kept in memory.
+    The number of edges before and after are logged with the 'reduce_webchild' stage record, as in reduce_webchild.
+    reduce_webchild_file(graph_path='wc_cnformat.csv', out_path='wc_cnformat_reduced.csv',
+                         columns=['word1', 'word2', 'score', 'sources', 'relation', 'filename'])
+    """
+    filenames_to_reduce = filenames_to_reduce or WEBCHILD_FILES_TO_REDUCE
+    best_df = None
+    with stage('reduce_webchild', path=out_path) as record, open(out_path, 'w+', newline='') as out_file:
+        record['rows'] = record['rows_out'] = 0
+        for chunk in load_df(graph_path, columns=columns, chunksize=chunksize):
+            record['rows'] += len(chunk)
+            reduce_index = chunk['filename'].isin(filenames_to_reduce)
+            chunk[~reduce_index].to_csv(out_file, sep='\t', index=False, header=False)
+            record['rows_out'] += int((~reduce_index).sum())
+            reduce_df = chunk[reduce_index]
+            best_df = _max_score_edges(reduce_df if best_df is None else pd.concat([best_df, reduce_df]))
+        if best_df is not None:
+            _order_reduced(best_df, filenames_to_reduce).to_csv(out_file, sep='\t', index=False, header=False)
+            record['rows_out'] += len(best_df)
+
+
 """
 Generate sentences from WebChild
 """
@@ -193,55 +267,30 @@ def relation_to_word(relation):
         return sp[2]
 
 
+def webchild_templates():
+    return get_template_registry('webchild')
+
+
 def webchild_rel_to_sentence(wd1, wd2, rel, _, file, logging=True):
-    if logging:
-        missed_rel_file = open("./output/sentences/missed_relation_types.txt", "w+")
     w1 = concept_to_word(wd1).replace('_', ' ')
     w2 = concept_to_word(wd2).replace('_', ' ')
-    if rel in webchild_relation_type_to_sentence.keys():  # fixed rel, replace according to dict & set article
-        if rel in ['/r/agent', '/r/participant', '/r/next', '/r/hasMember', '/r/hasPart']:  # flip words in sentence
-            w_t = w2
-            w2 = w1
-            w1 = w_t
-        sentence = webchild_relation_type_to_sentence[rel].format(w1, w2)
-    else:  # sentence composed with rel
-        if 'property' in file:  # adds relation to sentence
-            if rel == '/r/is':
-                sentence = 'a {} is {}'.format(w1, w2)  # special case for 'is' relation
-            else:
-                sentence = 'a {} {} is {}'.format(w1, relation_to_word(rel).replace('_', ' '), w2)
-        elif 'spatial' in file:
-            sentence = 'a {} {} {}'.format(w1, relation_to_word(rel).replace('_', ' '), w2)
-        elif 'comparative' in file:
-            sentence = 'a {} {} a {}'.format(w1, relation_to_word(rel).replace('_', ' '), w2)
-        else:  # unknown rel
-            sentence = None
-            if logging:
-                missed_rel_file.write(rel)
+    sentence = webchild_templates().sentence(w1, w2, rel, file)
+    if sentence is None and logging:  # unknown rel
+        with open("./output/sentences/missed_relation_types.txt", "a+") as missed_rel_file:
+            missed_rel_file.write(rel + '\n')
     return sentence
 
 
-def webchild_get_all_sentences(graph_df, indices, out_txt, out_csv):
+def webchild_get_all_sentences(graph_df, indices, out_txt, out_csv, missed_path=None):
     """
-    WebChild cnformat relations to sentences
+    WebChild cnformat relations to sentences, rendered in bulk per template like get_all_sentences.
+    graph_df needs the columns ['word1', 'word2', 'relation', 'file'], 'file' is the source file of each edge.
+    Relations without a sentence template are counted and written to missed_path
+    (default: 'missed_relation_types.txt' next to out_txt).
     webchild_get_all_sentences(graph_df=wc_cnformat, indices=wc_cnformat.index.values, out_txt='wc_sentences.txt', out_csv='wc_sentences.csv')
     """
-    text_file = open(out_txt, "w+")
-    inx_sentence_list = []
-    s_count = 0
-    for inx in indices:
-        row = graph_df.loc[inx]
-        w1 = row['word1']
-        w2 = row['word2']
-        rel = row['relation']
-        file = row['file']
-        rel_sentence = webchild_rel_to_sentence(w1, w2, rel, None, file)
-        if rel_sentence:
-            text_file.write(rel_sentence + '\n')
-            s_count += 1
-            inx_sentence_list.append([inx, rel_sentence])
-    sent_df = pd.DataFrame.from_dict(inx_sentence_list)
-    sent_df.to_csv(out_csv, sep='\t')
+    get_all_sentences(graph_df, indices, out_txt, out_csv, missed_path=missed_path, templates=webchild_templates(),
+                      file_column='file')
 
 
 if __name__ == '__main__':
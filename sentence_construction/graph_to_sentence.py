@@ -1,6 +1,15 @@
+import os
+import re
+import json
+import array
+import itertools
+import numpy as np
 import pandas as pd
 
 from util import load_df, get_en_idx
+from vocabulary import Vocabulary, get_vocabulary, MAX_VOCABULARY_SIZE
+from sentence_construction.templates import get_template_registry
+from instrumentation import stage
 
 relation_types_to_sentence = {'/r/RelatedTo': 'is related to', '/r/FormOf': 'is a form of',
                               '/r/IsA': 'is', '/r/PartOf': 'is a part of', '/r/HasA': 'is a part of',
@@ -22,6 +31,20 @@ relation_types_to_sentence = {'/r/RelatedTo': 'is related to', '/r/FormOf': 'is
                               '/r/ReceivesAction': 'can be', '/r/ExternalURL': 'External URL',
                               '/r/NotDesires': 'does not want', '/r/InstanceOf': 'is instance of',
                               '/r/subClassOf': 'is'}
+CONCEPTNET_FLIPPED_RELATIONS = ['/r/Causes', '/r/HasA']  # e.g. 'a cold is caused by a virus'
+
+for _rel, _text in relation_types_to_sentence.items():
+    get_template_registry('conceptnet').register('a {0} ' + _text.replace('_', ' ') + ' a {1}', relation=_rel,
+                                                 flip=_rel in CONCEPTNET_FLIPPED_RELATIONS)
+
+
+def conceptnet_templates():
+    """
+    The sentence templates of ConceptNet and graphs converted to its format (YAGO),
+    'a <word1> <relation text> a <word2>' for each relation of relation_types_to_sentence
+    """
+    return get_template_registry('conceptnet')
+
 
 """
 Sentence construction
@@ -40,44 +63,85 @@ def concept_to_word(concept):
 
 
 def rel_to_sentence(wd1, wd2, rel, logging=True):
-    if logging:
-        missing_rel_file = open("./output/sentences/missed_relation_types.txt", "w+")
     w1 = concept_to_word(wd1).replace('_', ' ')
     w2 = concept_to_word(wd2).replace('_', ' ')
-    if rel in relation_types_to_sentence.keys():
-        sentence = "a " + w1 + " " + (relation_types_to_sentence[rel]).replace('_', ' ') + " a " + w2
-        if rel in ['/r/Causes', '/r/HasA']:
-            w_t = w2
-            w2 = w1
-            w1 = w_t
-            sentence = "a " + w1 + " " + (relation_types_to_sentence[rel]).replace('_', ' ') + " a " + w2
-        return sentence
-    elif logging:
-        missing_rel_file.write(rel)
-    return None
+    sentence = conceptnet_templates().sentence(w1, w2, rel)
+    if sentence is None and logging:
+        with open("./output/sentences/missed_relation_types.txt", "a+") as missing_rel_file:
+            missing_rel_file.write(rel + '\n')
+    return sentence
+
+
+def concepts_to_words(concepts):
+    """
+    Column-wise concept_to_word on a Series of ConceptNet concepts, with '_' already replaced by ' '.
+    concepts_to_words(conceptnet['word1'])
+    """
+    words = concepts.str.split('/', n=4).str[3]
+    no_word = words.isna()
+    if no_word.any():
+        words = words.where(~no_word, concepts.where(concepts == 'pseudo_root', ''))
+    return words.str.replace('_', ' ', regex=False)
+
+
+def concept_vocabulary():
+    """A new vocabulary of concepts with their words, e.g. for the chunks of one graph"""
+    return Vocabulary(forms={'word': concepts_to_words}, max_size=MAX_VOCABULARY_SIZE)
+
+
+def relations_to_sentences(graph_df, templates=None, file_column=None, concepts=None):
+    """
+    Column-wise rel_to_sentence for all rows of graph_df with columns ['word1', 'word2', 'relation'].
+    Concepts are interned in the vocabulary concepts (default: the shared 'concepts' vocabulary), so their words
+    are only built once per distinct concept, the sentences are rendered in bulk per template of templates
+    (default: the ConceptNet templates).
+    file_column: column with the source file of each edge, for templates per file class (WebChild)
+    Returns the sentences (indexed like graph_df, rows with unknown relations dropped)
+    and the number of rows per unknown relation.
+    sentences, missed = relations_to_sentences(conceptnet.loc[get_en_idx(conceptnet)])
+    """
+    if templates is None:
+        templates = conceptnet_templates()
+    if concepts is None:  # not `or`: an empty Vocabulary is falsy
+        concepts = get_vocabulary('concepts', forms={'word': concepts_to_words})
+    w1 = concepts.form('word', concepts.encode(graph_df['word1']))
+    w2 = concepts.form('word', concepts.encode(graph_df['word2']))
+    files = graph_df[file_column] if file_column else None
+    sentences = templates.render(w1, w2, graph_df['relation'], files)
+    known = pd.notna(sentences)
+    missed = graph_df['relation'][~known].value_counts(dropna=False)
+    return pd.Series(sentences[known], index=graph_df.index[known]).astype(str), missed
 
 
-def get_all_sentences(graph_df, indices, out_txt, out_csv):
+def write_missed_relations(missed, out_path):
+    """Writes the unknown relations with their number of edges, one tab-separated pair per line"""
+    with open(out_path, 'w+') as missed_file:
+        for rel, count in missed.items():
+            missed_file.write('{}\t{}\n'.format(rel, count))
+
+
+def get_all_sentences(graph_df, indices, out_txt, out_csv, missed_path=None, templates=None, file_column=None):
     """
     Takes graph_df with columns ['word1', 'word2', 'relation'] as input and constructs sentences for all indices.
     Saves sentences as .txt for BERT inputs and sentence + index as .csv for mapping back new weights to the graph.
+    Relations without a sentence template are counted and written to missed_path
+    (default: 'missed_relation_types.txt' next to out_txt).
+    templates, file_column: see relations_to_sentences
+    The concepts are interned in a vocabulary of this call only, which is freed when it returns.
     get_all_sentences(graph_df=conceptnet, indices=get_en_idx(conceptnet), out_txt='cn_en_sentences.txt', out_csv='cn_en_sentences.csv')
     """
-    text_file = open(out_txt, "w+")
-    inx_sentence_list = []
-    s_count = 0
-    for inx in indices:
-        row = graph_df.loc[inx]
-        w1 = row['word1']
-        w2 = row['word2']
-        rel = row['relation']
-        rel_sentence = rel_to_sentence(w1, w2, rel)
-        if rel_sentence:
-            text_file.write(rel_sentence + '\n')
-            s_count += 1
-            inx_sentence_list.append([inx, rel_sentence])
-    sent_df = pd.DataFrame.from_dict(inx_sentence_list)
-    sent_df.to_csv(out_csv, sep='\t')
+    with stage('sentences', path=out_txt) as record:
+        columns = ['word1', 'word2', 'relation'] + ([file_column] if file_column else [])
+        sentences, missed = relations_to_sentences(graph_df.loc[indices, columns], templates, file_column,
+                                                   concepts=concept_vocabulary())
+        with open(out_txt, "w+") as text_file:
+            text_file.writelines(sentence + '\n' for sentence in sentences)
+        sent_df = pd.DataFrame({0: sentences.index.to_numpy(), 1: sentences.to_numpy()})
+        sent_df.to_csv(out_csv, sep='\t')
+        record['rows'] = len(sentences)
+    if missed_path is None:
+        missed_path = os.path.join(os.path.dirname(out_txt), 'missed_relation_types.txt')
+    write_missed_relations(missed, missed_path)
 
 
 """
@@ -87,19 +151,46 @@ Preprocessing for BERT LMs
 
 def split_text_file(file_path, out_template, chunk_size):
     """
-    split large txt file in many small txt files of same size for multiprocessing on LMs
+    split large txt file in many small txt files of same size (chunk_size lines) for multiprocessing on LMs
     split_text_file(file_path='sentences.txt', out_template='sentences_chunk{}.txt', chunk_size=200000)
     """
-    file_to_split = open(file_path, 'r')
-    file_name_inx = 0
-    file_to_write = open(out_template.format(file_name_inx), 'w+')
-    for i, line in enumerate(file_to_split):
-        if (i + 1) % chunk_size == 0:
-            print(i)
-            file_to_write.close()
-            file_name_inx += 1
-            file_to_write = open(out_template.format(file_name_inx), 'w+')
-        file_to_write.write(line)
+    with stage('chunking', path=file_path) as record, open(file_path, 'r') as file_to_split:
+        record['rows'] = 0
+        for file_name_inx in itertools.count():
+            lines = list(itertools.islice(file_to_split, chunk_size))
+            if not lines:
+                break
+            with open(out_template.format(file_name_inx), 'w+') as file_to_write:
+                file_to_write.writelines(lines)
+            record['rows'] += len(lines)
+
+
+def _split_long_word(word, max_len):
+    return ' '.join(word[i:i + max_len] for i in range(0, len(word), max_len))
+
+
+def split_long_words_in_sentences(sentences, max_len):
+    """
+    Column-wise long word splitting for a Series of sentences (without line breaks),
+    words longer than max_len are split into pieces of max_len characters.
+    """
+    has_long_word = sentences.str.contains('[^ ]{{{}}}'.format(max_len + 1))
+    if not has_long_word.any():
+        return sentences
+    split = sentences[has_long_word].map(
+        lambda sentence: ' '.join(_split_long_word(word, max_len) for word in sentence.split(' ')))
+    return sentences.where(~has_long_word, split)
+
+
+def _split_long_words_in_lines(lines, max_len):
+    """Long word splitting for lines of a file, lines without long words are passed through as they are"""
+    long_word = re.compile('[^ \n]{{{}}}'.format(max_len + 1))
+    for line in lines:
+        if long_word.search(line):
+            words = line.rstrip('\n').split(' ')
+            line = ' '.join(_split_long_word(word, max_len) if len(word) > max_len else word
+                            for word in words) + '\n'
+        yield line
 
 
 def split_long_words(file_path, out_path, max_len):
@@ -107,23 +198,55 @@ def split_long_words(file_path, out_path, max_len):
     Split very long words so BERT doesnt crash
     split_long_words(file_path='sentences_chunk0.txt', out_path='sentences_chunk0_split.txt', max_len=43)
     """
-    print("Start Split")
-    file_to_split = open(file_path, 'r')
-    file_to_write = open(out_path, 'w+')
-    for line in file_to_split:
-        line_split = line.split(' ')
-        sentence_new = ''
-        for split in line_split:
-            if len(split) > max_len:
-                print(split)
-                w_split = (split[0 + i:max_len + i] for i in range(0, len(split), max_len))
-                sentence_new = sentence_new + (' '.join(word for word in w_split)) + ' '
-            else:
-                sentence_new = sentence_new + split + ' '
-
-        new_line = sentence_new[:-1]
-        file_to_write.write(new_line)
-    print("End Split")
+    with open(file_path, 'r') as file_to_split, open(out_path, 'w+') as file_to_write:
+        file_to_write.writelines(_split_long_words_in_lines(file_to_split, max_len))
+
+
+def prepare_lm_chunks(file_path, out_dir, num_chunks, max_len=None):
+    """
+    Prepares the sentence .txt for parallel LM runs: splits words longer than max_len and writes num_chunks
+    consecutive chunks out_dir/chunk{i}/sentences.txt with about the same number of tokens,
+    so LM workers finish at the same time. num_chunks is capped at the number of sentences, no chunk is empty.
+    out_dir/manifest.json lists the sentences and tokens of each chunk,
+    pass it to get_perplexity_from_multiple_files to check the LM results against it.
+    prepare_lm_chunks(file_path='cn_sentences.txt', out_dir='cn_lm_input/', num_chunks=16, max_len=43)
+    """
+    with stage('chunking', path=file_path, chunks=num_chunks) as record:
+        # first pass: tokens per sentence after splitting long words, second pass: write the split sentences
+        token_counts = array.array('q')
+        with open(file_path, 'r') as sentence_file:
+            lines = _split_long_words_in_lines(sentence_file, max_len) if max_len else sentence_file
+            token_counts.extend(len(line.split()) for line in lines)
+
+        # chunk i ends at the first sentence where the cumulated tokens reach (i + 1) / num_chunks of all tokens
+        cum_tokens = np.cumsum(np.frombuffer(token_counts, dtype=np.int64)) if token_counts else np.zeros(0, np.int64)
+        total_tokens = cum_tokens[-1] if len(cum_tokens) else 0
+        num_chunks = min(num_chunks, len(cum_tokens))
+        targets = total_tokens * np.arange(1, num_chunks) / num_chunks
+        ends = np.append(np.searchsorted(cum_tokens, targets, side='left') + 1, len(cum_tokens))
+        # strictly increasing: every chunk gets at least one sentence
+        shift = np.arange(num_chunks)
+        ends = np.minimum(np.maximum.accumulate(ends - shift), len(cum_tokens) - num_chunks + 1) + shift
+        starts = np.append(0, ends[:-1])
+
+        os.makedirs(out_dir, exist_ok=True)
+        chunks = []
+        with open(file_path, 'r') as sentence_file:
+            lines = _split_long_words_in_lines(sentence_file, max_len) if max_len else sentence_file
+            for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+                name = 'chunk{}'.format(i)
+                os.makedirs(os.path.join(out_dir, name), exist_ok=True)
+                with open(os.path.join(out_dir, name, 'sentences.txt'), 'w+') as chunk_file:
+                    chunk_file.writelines(line if line.endswith('\n') else line + '\n'
+                                          for line in itertools.islice(lines, end - start))
+                tokens = int(cum_tokens[end - 1] - (cum_tokens[start - 1] if start else 0))
+                chunks.append({'name': name, 'sentences': end - start, 'tokens': tokens})
+        manifest = {'source': file_path, 'max_len': max_len, 'sentences': len(token_counts),
+                    'tokens': int(total_tokens), 'chunks': chunks}
+        with open(os.path.join(out_dir, 'manifest.json'), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        record['rows'] = len(token_counts)
+    return manifest
 
 
 if __name__ == '__main__':
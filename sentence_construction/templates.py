@@ -0,0 +1,171 @@
+import string
+import numpy as np
+import pandas as pd
+
+"""
+Sentence templates
+
+Sentence rules of all KGs as declarative templates: a pattern per relation (optionally per class of source file),
+compiled once into its literal parts and the argument of each slot, with flipped word order and articles
+resolved when the template is registered. TemplateRegistry.render looks the template up once per distinct
+(relation, file class) and renders all edges of a template in bulk, so there is no branching per edge.
+New KGs register their templates without touching the sentence builders:
+templates = get_template_registry('mykg', file_classes=['property'])
+templates.register('a {} is part of a {}', relation='/r/partOf')
+templates.register('a {0} {2} is {1}', file_class='property')  # free relations: {2} is the relation word
+"""
+
+WORD1, WORD2, RELATION_WORD = 0, 1, 2  # slot numbers in the patterns
+
+
+def relations_to_words(relations):
+    """Column-wise word of relations like '/r/is_located_in' -> 'is located in' ('' without one)"""
+    relations = pd.Series(relations, dtype=object)
+    words = relations.astype(str).str.split('/', n=3).str[2]
+    no_word = words.isna()
+    if no_word.any():
+        words = words.where(~no_word, relations.where(relations == 'pseudo_root', ''))
+    return words.str.replace('_', ' ', regex=False)
+
+
+class SentenceTemplate:
+    """
+    A sentence pattern compiled into literal parts and slots. Slots are {0} (first word), {1} (second word)
+    and {2} (word of the relation), '{}' slots count up from {0}.
+    flip swaps the two words, e.g. 'a {} is caused by a {}' for /r/Causes reads 'a <word2> is caused by a <word1>'.
+    """
+
+    def __init__(self, pattern, flip=False):
+        self.pattern = pattern
+        self.flip = flip
+        self.literals = ['']
+        self.slots = []
+        auto_slot = 0
+        for literal, field, _, _ in string.Formatter().parse(pattern):
+            self.literals[-1] += literal
+            if field is None:
+                continue
+            if field == '':
+                slot, auto_slot = auto_slot, auto_slot + 1
+            else:
+                slot = int(field)
+            if slot not in (WORD1, WORD2, RELATION_WORD):
+                raise ValueError('Slots of sentence templates are {0}, {1} and {2}, but got: ' + pattern)
+            if flip and slot in (WORD1, WORD2):
+                slot = WORD2 if slot == WORD1 else WORD1
+            self.slots.append(slot)
+            self.literals.append('')
+        self.uses_relation = RELATION_WORD in self.slots
+
+    def __repr__(self):
+        return 'SentenceTemplate({!r}, flip={})'.format(self.pattern, self.flip)
+
+    def format(self, word1, word2, relation_word=None):
+        """Sentence of one edge"""
+        return self.render(word1, word2, relation_word)
+
+    def render(self, words1, words2, relation_words=None):
+        """Sentences of many edges from object arrays of words (works on single strings as well)"""
+        args = (words1, words2, relation_words)
+        sentences = self.literals[0]
+        for slot, literal in zip(self.slots, self.literals[1:]):
+            sentences = sentences + args[slot] + literal if literal else sentences + args[slot]
+        return sentences
+
+
+class TemplateRegistry:
+    """
+    Sentence templates of a KG by relation and class of source file.
+    file_classes: substrings of the source file names, the first one contained in a file name is its class.
+    A relation uses its template for any file if registered without file_class, then the template of the relation
+    for its file class, then the free-relation template of the file class (registered without relation).
+    """
+
+    def __init__(self, file_classes=None):
+        self.file_classes = list(file_classes or [])
+        self.templates = {}
+
+    def register(self, pattern, relation=None, file_class=None, flip=False):
+        if relation is None and file_class is None:
+            raise ValueError('Templates need a relation, a file_class or both')
+        if file_class is not None and file_class not in self.file_classes:
+            self.file_classes.append(file_class)
+        self.templates[(relation, file_class)] = SentenceTemplate(pattern, flip=flip)
+
+    def file_class(self, file):
+        file = str(file)
+        for file_class in self.file_classes:
+            if file_class in file:
+                return file_class
+        return None
+
+    def resolve(self, relation, file=None):
+        """The template of an edge, None if there is none"""
+        template = self.templates.get((relation, None))
+        if template is None and file is not None:
+            file_class = self.file_class(file)
+            template = self.templates.get((relation, file_class)) or self.templates.get((None, file_class))
+        return template
+
+    def sentence(self, word1, word2, relation, file=None):
+        """Sentence of one edge, None without template"""
+        template = self.resolve(relation, file)
+        if template is None:
+            return None
+        relation_word = relations_to_words([relation])[0] if template.uses_relation else None
+        return template.format(word1, word2, relation_word)
+
+    def render(self, words1, words2, relations, files=None):
+        """
+        Sentences of all edges: words1, words2 arrays of words, relations and files (the source file of each edge,
+        only needed for file-class templates) arrays or Series of the same length.
+        Templates are resolved once per distinct (relation, file), each template renders its edges in bulk.
+        Returns an object array of the sentences, None for edges without template.
+        sentences = get_template_registry('conceptnet').render(words1, words2, conceptnet['relation'])
+        """
+        words1 = np.asarray(words1, dtype=object)
+        words2 = np.asarray(words2, dtype=object)
+        relation_codes, relation_values = pd.factorize(np.asarray(relations, dtype=object), use_na_sentinel=False)
+        if files is None:
+            file_codes, file_values = np.zeros(len(relation_codes), dtype=np.int64), [None]
+        else:
+            file_codes, file_values = pd.factorize(np.asarray(files, dtype=object), use_na_sentinel=False)
+        pair_codes, pairs = pd.factorize(relation_codes.astype(np.int64) * len(file_values) + file_codes)
+
+        templates = []
+        pair_templates = np.full(len(pairs), -1, dtype=np.int64)
+        for i, pair in enumerate(pairs.tolist()):
+            template = self.resolve(relation_values[pair // len(file_values)], file_values[pair % len(file_values)])
+            if template is not None:
+                if template not in templates:
+                    templates.append(template)
+                pair_templates[i] = templates.index(template)
+        edge_templates = pair_templates[pair_codes]
+
+        relation_words = None
+        if any(template.uses_relation for template in templates):
+            relation_words = relations_to_words(relation_values).to_numpy(dtype=object)[relation_codes]
+        sentences = np.full(len(edge_templates), None, dtype=object)
+        order = np.argsort(edge_templates, kind='stable')
+        offsets = np.r_[0, np.bincount(edge_templates + 1, minlength=len(templates) + 1).cumsum()]
+        for i, template in enumerate(templates):
+            rows = order[offsets[i + 1]:offsets[i + 2]]  # offsets[0]:offsets[1] are the edges without template
+            sentences[rows] = template.render(words1[rows], words2[rows],
+                                              relation_words[rows] if template.uses_relation else None)
+        return sentences
+
+
+TEMPLATE_REGISTRIES = {}
+
+
+def get_template_registry(kg, file_classes=None):
+    """
+    The template registry of kg (e.g. 'conceptnet', 'webchild'), created on first use, file_classes are added
+    """
+    registry = TEMPLATE_REGISTRIES.get(kg)
+    if registry is None:
+        registry = TEMPLATE_REGISTRIES[kg] = TemplateRegistry()
+    for file_class in file_classes or []:
+        if file_class not in registry.file_classes:
+            registry.file_classes.append(file_class)
+    return registry
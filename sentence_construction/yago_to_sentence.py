@@ -1,6 +1,12 @@
 
+import os
+import shutil
+import functools
+import multiprocessing
+
 from sentence_construction.graph_to_sentence import get_all_sentences
 from util import load_df, word_to_concept, word_to_rel
+from instrumentation import stage
 
 """
 Get other graphs to same format as ConceptNet
@@ -16,6 +22,8 @@ Changes for YAGO:
 After conversion, applying sentence-generation like with ConceptNet (graph_to_sentence.get_all_sentences)
 """
 
+YAGO_ENTITY_CACHE_SIZE = 1 << 20
+
 
 def get_yago_word(word):
     """column_names 0=subject, 1=object, 2=relation"""
@@ -39,47 +47,118 @@ def get_yago_source(concept):
     return concept_split[0]
 
 
-def yago_taxonomy_to_conceptnet_format(yago_path, out_file):
+@functools.lru_cache(maxsize=YAGO_ENTITY_CACHE_SIZE)
+def yago_entity_forms(entity):
+    """
+    ConceptNet concept and source of a YAGO entity like '<wordnet_dog_102084071>', (None, None) if it has no word.
+    Cached, the taxonomy names the same classes over and over.
+    """
+    word = get_yago_word(entity)
+    if not word:
+        return None, None
+    return word_to_concept(word), get_yago_source(entity)
+
+
+def yago_line_to_conceptnet_format(line):
+    """
+    Converts one line [id, word1, relation, word2] of the YAGO taxonomy.
+    Returns the ConceptNet-format line and None, or None and the kind of error ('relation', 'words' or 'fields').
     """
+    line_split = line.split('\t')
+    if len(line_split) < 4 or ':' not in line_split[2]:
+        return None, 'fields'
+    relation = line_split[2].split(':')[1]
+    word1, source1 = yago_entity_forms(line_split[1])
+    word2, source2 = yago_entity_forms(line_split[3])
+    if word1 and word2:
+        if relation != 'subClassOf':
+            return None, 'relation'
+        source = source1 + ';' + source2
+        relation = word_to_rel(relation)
+        return word1 + '\t' + word2 + '\t' + '1' + '\t' + source + '\t' + relation + '\n', None
+    return None, 'words'
+
+
+def get_line_shards(path, num_shards):
+    """Splits the file into num_shards byte ranges (start, end) that begin and end on line boundaries"""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as in_file:
+        for i in range(1, num_shards):
+            in_file.seek(max(size * i // num_shards, bounds[-1]))
+            if in_file.tell() > 0:
+                in_file.seek(in_file.tell() - 1)
+                in_file.readline()  # move to the start of the next line
+            bounds.append(in_file.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def _convert_yago_shard(args):
+    yago_path, start, end, shard_path, max_samples = args
+    lines = 0
+    converted = 0
+    errors = {}
+    samples = []
+    with open(yago_path, 'rb') as graph, open(shard_path, 'w+') as result_file:
+        graph.seek(start)
+        while graph.tell() < end:
+            line = graph.readline().decode('utf-8').replace('\r\n', '\n')
+            lines += 1
+            if start == 0 and lines == 1:
+                continue  # header
+            line_to_write, error = yago_line_to_conceptnet_format(line)
+            if error:
+                errors[error] = errors.get(error, 0) + 1
+                if len(samples) < max_samples:
+                    samples.append({'line': lines, 'error': error, 'text': line.rstrip('\n')})
+            else:
+                result_file.write(line_to_write)
+                converted += 1
+    return {'lines': lines, 'converted': converted, 'errors': errors, 'samples': samples}
+
+
+def yago_taxonomy_to_conceptnet_format(yago_path, out_file, processes=None, max_samples=20):
+    """
+    Converts the YAGO taxonomy in shards of whole lines, one per process, and merges them in order into out_file.
+    Returns a summary: number of lines (incl. header), converted facts, error counts by kind and the first
+    max_samples malformed lines with their line number.
     yago_taxonomy_to_conceptnet_format(yago_path='yago_taxonomy.tsv', out_file='yago_cnformat.csv')
     """
     # columns names [id, word1, relation, word2]
-    graph = open(yago_path, "r")
-    result_file = open(out_file, "w+")
-    counter = 0
-    errors = 0
-    for line in graph:
-        if counter == 0:
-            counter += 1
-            continue
-        counter += 1
-        if counter % 10000 == 0:
-            print('Counter: ', counter)
-        line_split = line.split('\t')
-        relation = line_split[2].split(':')[1]
-        word1 = get_yago_word(line_split[1])
-        word2 = get_yago_word(line_split[3])
-        if word1 and word2:
-            word1 = word_to_concept(word1)
-            word2 = word_to_concept(word2)
-            source = '' + get_yago_source(line_split[1]) + ';' + get_yago_source(line_split[3])
-            if relation == 'subClassOf':
-                relation = word_to_rel(relation)
-                line_to_write = word1 + '\t' + word2 + '\t' + '1' + '\t' + source + '\t' + relation + '\n'
-                result_file.write(line_to_write)
-            else:
-                print("Wrong Relation Format: ", line)
-                errors += 1
+    if processes is None:
+        processes = os.cpu_count()
+    with stage('convert', path=out_file, processes=processes) as record:
+        shards = get_line_shards(yago_path, max(processes, 1))
+        tasks = [(yago_path, start, end, '{}.shard{}'.format(out_file, i), max_samples)
+                 for i, (start, end) in enumerate(shards)]
+        if len(tasks) > 1:
+            with multiprocessing.Pool(min(processes, len(tasks))) as pool:
+                results = pool.map(_convert_yago_shard, tasks, chunksize=1)
         else:
-            print(counter, ' : Wrong Format of words : ', line)
-            errors += 1
-    print("Total facts transformed to CN Format: ", counter)
-    print('Total Errors : ', errors)
+            results = [_convert_yago_shard(task) for task in tasks]
+
+        summary = {'lines': 0, 'converted': 0, 'errors': {}, 'error_samples': []}
+        with open(out_file, 'w+') as result_file:
+            for task, result in zip(tasks, results):
+                with open(task[3]) as shard_file:
+                    shutil.copyfileobj(shard_file, result_file)
+                os.remove(task[3])
+                for sample in result['samples']:
+                    if len(summary['error_samples']) < max_samples:
+                        summary['error_samples'].append(dict(sample, line=sample['line'] + summary['lines']))
+                summary['lines'] += result['lines']
+                summary['converted'] += result['converted']
+                for error, count in result['errors'].items():
+                    summary['errors'][error] = summary['errors'].get(error, 0) + count
+        record['rows'] = summary['lines']
+    return summary
 
 
 if __name__ == '__main__':
-    yago_taxonomy_to_conceptnet_format(yago_path='./data/examples/yago_taxonomy.tsv',
-                                       out_file='./output/kgs/yago_cnformat.csv')
+    summary = yago_taxonomy_to_conceptnet_format(yago_path='./data/examples/yago_taxonomy.tsv',
+                                                 out_file='./output/kgs/yago_cnformat.csv')
+    print('Total facts transformed to CN Format: {converted} of {lines} lines, errors: {errors}'.format(**summary))
     yago_df = load_df('./output/kgs/yago_cnformat.csv', columns=['word1', 'word2', 'weight', 'source', 'relation'])
     get_all_sentences(graph_df=yago_df, indices=yago_df.index.values,
                       out_txt='./output/sentences/yago_sentences.txt', out_csv='./output/sentences/yago_sentences.csv')
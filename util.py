@@ -1,14 +1,137 @@
 
 import os
 import io
+import itertools
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
+from graph_store import is_graph_store, load_graph_store
+
+
+class LanguageIndex:
+    """
+    Language of both endpoints (from the '/c/<language>/' concept prefix) and relation of every edge
+    as integer codes, so filters are comparisons of small int arrays instead of string scans.
+    Queries return boolean NumPy masks over the rows of the graph.
+    The index is a snapshot: build it once and pass it to the functions that accept one to share it,
+    build a new one after modifying the word1, word2 or relation columns.
+    LanguageIndex(conceptnet).both('en')
+    """
+
+    def __init__(self, dataframe):
+        self.num_edges = len(dataframe)
+        language_ids = {}
+        self.lang1 = _concept_language_codes(dataframe['word1'], language_ids)
+        self.lang2 = _concept_language_codes(dataframe['word2'], language_ids)
+        self.languages = pd.Index(list(language_ids), dtype=object)
+        self.relation_codes, self.relations = pd.factorize(dataframe['relation'], use_na_sentinel=False)
+
+    def _language_code(self, language):
+        found = np.flatnonzero(self.languages == language)
+        return found[0] if len(found) else -2  # -2 matches no edge
+
+    def pair(self, lang1=None, lang2=None):
+        """Edges from lang1 to lang2, None matches any language: pair('en', None), pair('de', 'en')"""
+        mask = np.ones(self.num_edges, dtype=bool)
+        if lang1 is not None:
+            mask &= self.lang1 == self._language_code(lang1)
+        if lang2 is not None:
+            mask &= self.lang2 == self._language_code(lang2)
+        return mask
+
+    def both(self, language='en'):
+        """Edges with both endpoints in language"""
+        return self.pair(language, language)
+
+    def relation_in(self, relations):
+        """Edges whose relation is one of relations, e.g. ['/r/IsA', '/r/Synonym']"""
+        return np.isin(self.relation_codes, np.flatnonzero(self.relations.isin(relations)))
+
+    def relation_contains(self, pattern):
+        """Edges whose relation contains pattern, evaluated once per distinct relation"""
+        matches = self.relations.astype(str).str.contains(pattern, regex=False)
+        return np.isin(self.relation_codes, np.flatnonzero(matches))
+
+
+def _concept_language_codes(concepts, language_ids):
+    """
+    Codes of the language part of '/c/<language>/...' for each concept ('' for concepts without it),
+    string operations only run once per distinct concept. language_ids maps languages to codes and is extended.
+    """
+    codes, uniques = pd.factorize(concepts, use_na_sentinel=False)
+    uniques = pd.Series(uniques, dtype=object).astype(str)
+    has_language = uniques.str.startswith('/c/') & (uniques.str.count('/') >= 3)
+    languages = uniques.str.split('/', n=3).str[2].where(has_language, '')
+    unique_codes, unique_languages = pd.factorize(languages)
+    ids = np.array([language_ids.setdefault(language, len(language_ids)) for language in unique_languages],
+                   dtype=np.int32)
+    return ids[unique_codes][codes]
+
+
+SOURCE_SEPARATORS = r'[,;|\s]+'  # between the parts of compound sources
+
+
+class SourceIndex:
+    """
+    Inverted index from the sources of the edges to their rows. The 'sources' column is factorized once:
+    string matching only runs on the distinct (compound) values, and the rows of each value are kept grouped.
+    Queries return boolean masks over the distinct values, which combine with &, | and ~ into set operations
+    on the edges without scanning strings again, rows() turns a mask into sorted row positions.
+    Like LanguageIndex a snapshot of the column, build a new one after modifying it.
+    source_index = SourceIndex(conceptnet)
+    source_index.rows(source_index.prefix('/d/wordnet/') | source_index.token('/d/verbosity'))
+    source_index.rows(source_index.contains('/d/wiktionary/') & ~source_index.token('/d/wiktionary/en'))
+    """
+
+    def __init__(self, dataframe, column='sources'):
+        self.num_edges = len(dataframe)
+        codes, values = pd.factorize(dataframe[column], use_na_sentinel=False)
+        self.values = pd.Series(values, dtype=object)
+        self.missing = self.values.isna().to_numpy()
+        # rows of value i are value_rows[value_offsets[i]:value_offsets[i + 1]], in ascending order
+        self.value_rows = np.argsort(codes, kind='stable')
+        self.value_offsets = np.r_[0, np.bincount(codes, minlength=len(values)).cumsum()]
+        tokens = self.values.astype(str).str.split(SOURCE_SEPARATORS, regex=True).explode()  # index: value code
+        self.token_values = {token: np.unique(value_codes.to_numpy())
+                             for token, value_codes in pd.Series(tokens.index.to_numpy()).groupby(tokens.to_numpy())}
+        self.tokens = np.array(sorted(self.token_values), dtype=object)  # for prefix queries
+
+    def contains(self, pattern):
+        """Values that contain pattern (plain substring, like a source prefix '/d/wordnet/')"""
+        return self.values.astype(str).str.contains(pattern, regex=False).to_numpy() & ~self.missing
+
+    def token(self, source):
+        """Values with source as one of their parts, e.g. '/d/wiktionary/en'"""
+        mask = np.zeros(len(self.values), dtype=bool)
+        mask[self.token_values.get(source, [])] = True
+        return mask & ~self.missing
+
+    def prefix(self, prefix):
+        """
+        Values with a part that starts with prefix, e.g. '/d/wordnet/' for all WordNet versions. Looks up the range
+        of parts in the sorted index, no string matching.
+        """
+        start = np.searchsorted(self.tokens, prefix, side='left')
+        stop = np.searchsorted(self.tokens, prefix + '\U0010ffff', side='left')
+        mask = np.zeros(len(self.values), dtype=bool)
+        for token in self.tokens[start:stop].tolist():
+            mask[self.token_values[token]] = True
+        return mask & ~self.missing
+
+    def rows(self, value_mask):
+        """Sorted row positions of the edges whose value is in value_mask"""
+        matched = np.flatnonzero(value_mask)
+        if not len(matched):
+            return np.empty(0, dtype=np.int64)
+        if len(matched) == 1:
+            return self.value_rows[self.value_offsets[matched[0]]:self.value_offsets[matched[0] + 1]]
+        return np.sort(np.concatenate([self.value_rows[self.value_offsets[i]:self.value_offsets[i + 1]]
+                                       for i in matched.tolist()]))
+
 
 def get_en_idx(dataframe):
-    pattern = "\/c\/en\/"
-    index = dataframe.index[
-        (dataframe['word1'].str.contains(pattern) & dataframe['word2'].str.contains(pattern))].tolist()
+    index = dataframe.index[LanguageIndex(dataframe).both('en')].tolist()
     return index
 
 
@@ -16,23 +139,61 @@ def concatenate_files(files_to_merge, out_path):
     with io.open(out_path, 'w+', encoding='utf8') as outfile:
         for fname in files_to_merge:
             print(fname)
-            with open(fname, 'r') as infile:
+            with open(fname, 'r', encoding='utf-8', errors='ignore') as infile:
                 for line in infile:
-                    line = line.decode('utf-8', 'ignore')
                     outfile.write(line.strip() + '\t' + fname + '\n')
     print('Merge Done')
 
 
-def load_df(path_to_data_csv, sep="\t", columns=None, index=None, nrows=None):
-    """g_orig = load_df(path_orig, columns=['word1', 'word2', 'score', 'sources', 'relation'])"""
+def load_df(path_to_data_csv, sep="\t", columns=None, index=None, nrows=None, chunksize=None):
+    """
+    g_orig = load_df(path_orig, columns=['word1', 'word2', 'score', 'sources', 'relation'])
+    With chunksize, returns an iterator over DataFrames of chunksize rows that keep the index of the full file.
+    """
     if columns:
-        data_df = pd.read_csv(path_to_data_csv, sep, index_col=index, names=columns, nrows=nrows)
+        data_df = pd.read_csv(path_to_data_csv, sep=sep, index_col=index, names=columns, nrows=nrows,
+                              chunksize=chunksize)
         return data_df
     else:
-        data_df = pd.read_csv(path_to_data_csv, sep, index_col=index, nrows=nrows)
+        data_df = pd.read_csv(path_to_data_csv, sep=sep, index_col=index, nrows=nrows, chunksize=chunksize)
         return data_df
 
 
+def load_graph(path_to_graph, columns=None):
+    """
+    Loads a graph from a graph store directory (see graph_store.tsv_to_graph_store) or else from a csv via load_df.
+    conceptnet = load_graph('conceptnet_store/')
+    """
+    if is_graph_store(path_to_graph):
+        return load_graph_store(path_to_graph)
+    return load_df(path_to_graph, columns=columns)
+
+
+def load_graph_text(path_to_graph_csv, sep="\t", chunksize=None):
+    """
+    Loads a headerless graph file line by line with every field as str, keeping the fields exactly as written
+    (no quoting, no NaN). Row i is line i of the file, also for blank lines, rows with fewer fields are padded
+    with None like rows with more fields are kept, so the row numbers stay the line numbers sentence indices refer to.
+    Columns are numbered like the fields, e.g. 2 is the score of a ConceptNet-format graph.
+    With chunksize, returns an iterator over DataFrames of chunksize lines that keep the line numbers as index.
+    """
+    if chunksize:
+        return _graph_text_chunks(path_to_graph_csv, sep, chunksize)
+    with open(path_to_graph_csv) as graph_file:
+        return pd.DataFrame([line.rstrip().split(sep) for line in graph_file])
+
+
+def _graph_text_chunks(path_to_graph_csv, sep, chunksize):
+    with open(path_to_graph_csv) as graph_file:
+        start = 0
+        while True:
+            rows = [line.rstrip().split(sep) for line in itertools.islice(graph_file, chunksize)]
+            if not rows:
+                return
+            yield pd.DataFrame(rows, index=pd.RangeIndex(start, start + len(rows)))
+            start += len(rows)
+
+
 def plot_hist(input_data, bins=200, log_scale=False, title=None, out_folder=None, cut_title=True):
     """Plots input data histogram"""
     plt.hist(input_data, bins=bins)
@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+
+"""
+Interned vocabularies of concepts and words
+
+A Vocabulary gives every distinct string an integer id once and caches derived forms per id
+(e.g. the surface word of a concept), so string work runs once per distinct
+value instead of once per edge. A handful of high-degree concepts cover a large share of ConceptNet's edges.
+Forms are column-wise functions from a Series of values to a Series of results, computed once per id.
+concepts = get_vocabulary('concepts', forms={'word': concepts_to_words})
+ids = concepts.encode(conceptnet['word1'])
+words = concepts.form('word', ids)
+"""
+
+MAX_VOCABULARY_SIZE = 20000000  # shared vocabularies are cleared when they grow beyond this many values
+
+
+class Vocabulary:
+    """
+    Distinct values with integer ids in order of first occurrence, and cached forms of each value.
+    Forms are only computed for the ids they are asked for, so values of different kinds can share a vocabulary.
+    max_size: clear the vocabulary (ids and cached forms) before it grows beyond max_size values,
+    ids encoded before are then no longer valid, so look up their forms before encoding more values.
+    """
+
+    def __init__(self, forms=None, max_size=None):
+        self.ids = {}
+        self.values = []
+        self.forms = dict(forms or {})
+        self.max_size = max_size
+        self._value_array = np.empty(0, dtype=object)
+        self._form_arrays = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def add_form(self, name, convert):
+        """Registers a form unless one with that name exists, e.g. by another module sharing the vocabulary"""
+        self.forms.setdefault(name, convert)
+
+    def clear(self):
+        self.ids = {}
+        self.values = []
+        self._value_array = np.empty(0, dtype=object)
+        self._form_arrays = {}
+
+    def encode(self, values):
+        """int32 ids of the values of a Series or array, new values are added. Dict lookups run per distinct value."""
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object), use_na_sentinel=False)
+        if self.max_size is not None and len(self.values) + len(uniques) > self.max_size:
+            self.clear()
+        ids = self.ids
+        unique_ids = np.empty(len(uniques), dtype=np.int32)
+        for i, value in enumerate(uniques.tolist()):
+            value_id = ids.get(value)
+            if value_id is None:
+                value_id = ids[value] = len(self.values)
+                self.values.append(value)
+            unique_ids[i] = value_id
+        return unique_ids[codes]
+
+    def decode(self, ids):
+        if len(self._value_array) < len(self.values):
+            self._value_array = np.concatenate([self._value_array,
+                                                np.array(self.values[len(self._value_array):], dtype=object)])
+        return self._value_array[ids]
+
+    def form(self, name, ids):
+        """Form name of each id, computed once per id when it is first asked for"""
+        array, done = self._form_arrays.get(name, (np.empty(0, dtype=object), np.empty(0, dtype=bool)))
+        if len(array) < len(self.values):
+            grow = len(self.values) - len(array)
+            array = np.concatenate([array, np.empty(grow, dtype=object)])
+            done = np.concatenate([done, np.zeros(grow, dtype=bool)])
+            self._form_arrays[name] = array, done
+        missing = np.unique(ids[~done[ids]])
+        if len(missing):
+            array[missing] = np.asarray(self.forms[name](pd.Series(self.decode(missing), dtype=object)), dtype=object)
+            done[missing] = True
+        return array[ids]
+
+    def lookup(self, name, values):
+        """Form name of each value of a Series, indexed like values"""
+        return pd.Series(self.form(name, self.encode(values)), index=values.index, dtype=object)
+
+    def memory_usage(self):
+        """Approximate bytes held: the id dict, the values and the cached form arrays"""
+        strings = sum(len(value) + 49 for value in self.values if isinstance(value, str))
+        return (strings + 104 * len(self.ids) + self._value_array.nbytes +
+                sum(array.nbytes + done.nbytes for array, done in self._form_arrays.values()))
+
+
+_vocabularies = {}
+
+
+def get_vocabulary(name, forms=None):
+    """
+    The vocabulary shared under name (e.g. 'concepts', 'webchild_words') in this process, created on first use.
+    forms are added to it if missing, so modules can share one vocabulary with their own forms.
+    """
+    vocabulary = _vocabularies.get(name)
+    if vocabulary is None:
+        vocabulary = _vocabularies[name] = Vocabulary(max_size=MAX_VOCABULARY_SIZE)
+    for form_name, convert in (forms or {}).items():
+        vocabulary.add_form(form_name, convert)
+    return vocabulary
+
+
+def clear_vocabularies():
+    """Frees all shared vocabularies, e.g. after converting a graph"""
+    for vocabulary in _vocabularies.values():
+        vocabulary.clear()